@@ -0,0 +1,42 @@
+import os, time, shutil, argparse
+
+import numpy as np
+
+from constants import Constants
+from regret_table import RegretTable
+
+
+def timed(fn):
+  t0 = time.time()
+  out = fn()
+  return out, time.time() - t0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Times saving and loading a random regret table in each "
+                                               "checkpoint format.")
+  parser.add_argument("--rows", type=int, default=500000, help="Number of rows in the table")
+  parser.add_argument("--lookups", type=int, default=10000, help="Number of random rows read after loading")
+  parser.add_argument("--folder", type=str, default="./memory/benchmark_regret_tables/",
+                      help="Where to write the files (removed afterwards)")
+  parser.add_argument("--formats", type=str, nargs="+", default=[".pkl", ".npz", ".rtab"])
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  keys = rng.choice(2**25, size=args.rows, replace=False).astype(np.int64)
+  table = RegretTable(Constants.NUM_ACTIONS, capacity=args.rows)
+  table.add_rows(keys, rng.rand(args.rows, Constants.NUM_ACTIONS).astype(np.float32))
+  lookups = rng.choice(keys, size=args.lookups).tolist()
+
+  print("{:>6} | {:>10} | {:>10} | {:>10} | {:>14}".format("format", "MB", "save sec", "load sec",
+                                                           "lookups sec"))
+  for ext in args.formats:
+    filename = os.path.join(args.folder, "table" + ext)
+    _, save_sec = timed(lambda: table.save(filename))
+    loaded, load_sec = timed(lambda: RegretTable.load(filename))
+    _, lookup_sec = timed(lambda: [loaded.get(key) for key in lookups])
+    print("{:>6} | {:>10.1f} | {:>10.3f} | {:>10.3f} | {:>14.3f}".format(
+          ext, os.path.getsize(filename) / 2**20, save_sec, load_sec, lookup_sec))
+    del loaded
+
+  shutil.rmtree(args.folder)
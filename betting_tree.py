@@ -0,0 +1,187 @@
+import os, time
+
+import numpy as np
+import torch
+
+from constants import Constants
+from engine import *
+from cfr import make_actions, make_bet_history_vec
+
+
+class BettingTree(object):
+  def __init__(self, arrays):
+    """
+    The public betting tree for the action abstraction in cfr.make_actions. Its shape doesn't depend
+    on the cards, so it is enumerated once and then walked with TreeRoundState. There is one root
+    for each choice of small blind player, since the engine doesn't treat the two seats the same
+    (after the flop, it takes three checks to end a street when player 1 is the small blind).
+
+    Every node (including terminals) is a row of these flat arrays:
+      button (int16) : The engine's button counter, so button % 2 is the acting player.
+      street (int8) : 0, 3, 4, or 5.
+      terminal (int8) : 0 if the node is not terminal, 1 for a fold, and 2 for a showdown.
+      pips, stacks (float64, 2) : Chips in front of / behind each player.
+      pot (float64) : Chips in the middle.
+      mask (float32, NUM_ACTIONS) : The action mask from make_actions.
+      raise_amounts (float64, NUM_ACTIONS) : Resolved RaiseAction amounts (0 for other actions).
+      children (int32, NUM_ACTIONS) : Child node ids, or -1 if the action is masked out.
+      fold_delta (float64) : Payoff for player 0 at a fold terminal.
+      bet_history_vec (float32, 2 + BET_HISTORY_SIZE) : Same as cfr.make_bet_history_vec.
+      roots (int32, 2) : The root node when player 0 or player 1 is the small blind.
+    """
+    self.button = arrays["button"]
+    self.street = arrays["street"]
+    self.terminal = arrays["terminal"]
+    self.pips = arrays["pips"]
+    self.stacks = arrays["stacks"]
+    self.pot = arrays["pot"]
+    self.mask = arrays["mask"]
+    self.raise_amounts = arrays["raise_amounts"]
+    self.children = arrays["children"]
+    self.fold_delta = arrays["fold_delta"]
+    self.bet_history_vec = arrays["bet_history_vec"]
+    self.roots = arrays["roots"]
+
+    # NOTE: FoldAction(), CallAction() and CheckAction() are all equal to (), so match on type.
+    self._action_types = [type(a) for a in Constants.ALL_ACTIONS]
+    self._raise_offset = self._action_types.index(RaiseAction)
+
+  ARRAY_NAMES = ("button", "street", "terminal", "pips", "stacks", "pot", "mask", "raise_amounts", "children",
+                 "fold_delta", "bet_history_vec", "roots")
+
+  def size(self):
+    return len(self.button)
+
+  def actions(self, node):
+    """
+    Returns the same (actions, mask) as make_actions does for this node.
+    """
+    actions = list(Constants.ALL_ACTIONS[:self._raise_offset])
+    for amount in self.raise_amounts[node, self._raise_offset:].tolist():
+      actions.append(RaiseAction(amount))
+    return actions, torch.from_numpy(self.mask[node])
+
+  def action_index(self, node, action):
+    """
+    Returns the column of action in this node's arrays.
+    """
+    if not isinstance(action, RaiseAction):
+      return self._action_types.index(type(action))
+    amounts = self.raise_amounts[node]
+    for i in range(self._raise_offset, Constants.NUM_ACTIONS):
+      if amounts[i] == action.amount:
+        return i
+    raise ValueError("RaiseAction({}) is not in the betting tree at node {}".format(action.amount, node))
+
+  def root_state(self, round_state):
+    """
+    Puts the cards from a newly created round_state (see cfr.create_new_round) at the root.
+    """
+    return TreeRoundState(self, int(self.roots[round_state.sb_player]), round_state.hands, round_state.deck,
+                          round_state.sb_player, round_state.showdown_winner)
+
+  def save(self, folder):
+    """
+    Saves each array as an uncompressed .npy file in folder, so that load can memory-map them.
+    """
+    os.makedirs(folder, exist_ok=True)
+    # roots is written last, so a folder that has it is complete (see load_or_build).
+    for name in BettingTree.ARRAY_NAMES:
+      np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+    print("Saved BettingTree with {} nodes to {}".format(self.size(), folder))
+
+  @staticmethod
+  def load(folder):
+    """
+    Memory-maps the arrays from save. They are read-only, and every process that loads the same tree
+    shares their pages instead of reading its own copy.
+    """
+    tree = BettingTree({name: np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+                        for name in BettingTree.ARRAY_NAMES})
+    print("Loaded BettingTree with {} nodes from {}".format(tree.size(), folder))
+    return tree
+
+  @staticmethod
+  def build():
+    """
+    Enumerates the tree depth-first from both preflop roots.
+    """
+    t0 = time.time()
+    rows = []
+
+    def add_node(round_state, terminal, fold_delta):
+      node = len(rows)
+      # Terminal states are stored with the state that led to them.
+      state = round_state if terminal == 0 else round_state.previous_state
+      rows.append({
+        "button": state.button if terminal == 0 else -1,
+        "street": state.street,
+        "terminal": terminal,
+        "pips": state.pips,
+        "stacks": state.stacks,
+        "fold_delta": fold_delta,
+        "bet_history_vec": make_bet_history_vec(state.bet_history).numpy(),
+        "mask": np.zeros(Constants.NUM_ACTIONS, dtype=np.float32),
+        "raise_amounts": np.zeros(Constants.NUM_ACTIONS),
+        "children": -np.ones(Constants.NUM_ACTIONS, dtype=np.int32)
+      })
+      if terminal > 0:
+        return node
+
+      actions, mask = make_actions(round_state)
+      rows[node]["mask"] = mask.numpy()
+      for i, a in enumerate(actions):
+        if isinstance(a, RaiseAction):
+          rows[node]["raise_amounts"][i] = a.amount
+        if mask[i] <= 0:
+          continue
+        child = round_state.proceed(a)
+        if isinstance(child, TerminalState):
+          is_fold = isinstance(a, FoldAction)
+          rows[node]["children"][i] = add_node(child, 1 if is_fold else 2, child.deltas[0] if is_fold else 0)
+        else:
+          rows[node]["children"][i] = add_node(child, 0, 0)
+      return node
+
+    sb = Constants.SMALL_BLIND_AMOUNT
+    bb = 2 * Constants.SMALL_BLIND_AMOUNT
+    roots = []
+    for sb_player in (0, 1):
+      pips = [sb, bb]
+      stacks = [Constants.INITIAL_STACK - sb, Constants.INITIAL_STACK - bb]
+      if sb_player == 1:
+        pips.reverse()
+        stacks.reverse()
+      root = CompactRoundState(sb_player, 0, pips, stacks, None, None, None, [[sb, bb]], sb_player,
+                               showdown_winner=0)
+      roots.append(add_node(root, 0, 0))
+
+    arrays = {
+      "button": np.array([r["button"] for r in rows], dtype=np.int16),
+      "street": np.array([r["street"] for r in rows], dtype=np.int8),
+      "terminal": np.array([r["terminal"] for r in rows], dtype=np.int8),
+      "pips": np.array([r["pips"] for r in rows], dtype=np.float64),
+      "stacks": np.array([r["stacks"] for r in rows], dtype=np.float64),
+      "fold_delta": np.array([r["fold_delta"] for r in rows], dtype=np.float64),
+      "bet_history_vec": np.stack([r["bet_history_vec"] for r in rows]).astype(np.float32),
+      "mask": np.stack([r["mask"] for r in rows]).astype(np.float32),
+      "raise_amounts": np.stack([r["raise_amounts"] for r in rows]),
+      "children": np.stack([r["children"] for r in rows]).astype(np.int32),
+    }
+    arrays["pot"] = 2 * Constants.INITIAL_STACK - arrays["stacks"].sum(axis=1)
+    arrays["roots"] = np.array(roots, dtype=np.int32)
+
+    tree = BettingTree(arrays)
+    print("Built BettingTree with {} nodes in {} sec".format(tree.size(), time.time() - t0))
+    return tree
+
+  @staticmethod
+  def load_or_build(folder):
+    """
+    Loads the tree from folder if it has been built before, and otherwise builds and saves it.
+    """
+    if os.path.exists(os.path.join(folder, "roots.npy")):
+      return BettingTree.load(folder)
+    tree = BettingTree.build()
+    tree.save(folder)
+    return BettingTree.load(folder)
@@ -1,63 +1,163 @@
-import pickle, os
+import pickle, os, threading, contextlib
 
 import torch
 import eval7
+import numpy as np
 
 from constants import Constants
 from engine import *
 from utils import apply_mask_and_normalize, apply_mask_and_uniform
-from infoset import bucket_small, bucket_small_join, EvInfoSet
-from pbots_calc import calc, CalcWithLookup
+from infoset import bucket_small_key, bucket_small_pack, bucket_small_split, EvInfoSet, \
+                    BUCKET_SMALL_HS_THRESHOLDS
+from pbots_calc import calc, CalcWithLookup, set_calc_threads
+from regret_table import RegretTable, SharedRegretTable, convert_bucket_keys, save_delta, apply_delta_files, \
+                         shard_filenames, split_table, save_sharded, load_sharded, find_checkpoint
 
 
 EV_CALCULATOR = CalcWithLookup()
 
 
+def configure_ev_calculator(opt):
+  """
+  Applies the equity options (preflop table, cache, threads, and adaptive Monte Carlo) to EV_CALCULATOR.
+  """
+  if opt.PREFLOP_TABLE_PATH is not None:
+    EV_CALCULATOR.set_preflop_path(opt.PREFLOP_TABLE_PATH)
+  if opt.EQUITY_CACHE_PATH is not None:
+    EV_CALCULATOR.open_cache(opt.EQUITY_CACHE_PATH, opt.EQUITY_CACHE_SLOTS)
+  set_calc_threads(opt.EV_CALC_THREADS)
+  EV_CALCULATOR.set_adaptive(opt.EV_TARGET_SE, BUCKET_SMALL_HS_THRESHOLDS)
+
+
 def get_street_0123(s):
   return 0 if s == 0 else s - 2
 
 
-def make_precomputed_ev(round_state):
-  out = {}
-  for s in (0, 3, 4, 5):
-    if s == 3:
-      iters = 5000
-    elif s == 4:
-      iters = 5000
-    elif s == 5:
-      iters = 1326
-    else:
-      iters = 1
+# Monte Carlo iters used for each street's equities (the river is exact, see pbots_calc.river_equity).
+PRECOMPUTED_EV_ITERS = {0: 1, 3: 5000, 4: 5000, 5: 1326}
+
+
+class _StreetEv(object):
+  def __init__(self, precomputed_ev, street):
+    self._precomputed_ev = precomputed_ev
+    self._street = street
+
+  def __getitem__(self, player_idx):
+    return self._precomputed_ev.get(self._street, player_idx)
+
+  def __len__(self):
+    return 2
+
+
+class PrecomputedEv(object):
+  NUM_ENTRIES = 2 * len(PRECOMPUTED_EV_ITERS)
+
+  def __init__(self, round_state):
+    """
+    The ev of each player's hand on each street of a deal, computed the first time it's needed.
+    Many traversals never reach the turn or river, so their Monte Carlo is skipped entirely.
+    Supports the same precomputed_ev[street][player_idx] access as the dict make_infoset used to get.
+    """
+    self.hands = [[str(round_state.hands[i][0]), str(round_state.hands[i][1])] for i in (0, 1)]
+    self.boards = {s: str.encode("".join([str(c) for c in round_state.deck.peek(s)])) for s in PRECOMPUTED_EV_ITERS}
+    self._ev = {}
+    self.num_computed = 0
+
+  def get(self, street, player_idx):
+    ev = self._ev.get((street, player_idx))
+    if ev is None:
+      ev = EV_CALCULATOR.calc(self.hands[player_idx], self.boards[street], b"", PRECOMPUTED_EV_ITERS[street])
+      self._ev[(street, player_idx)] = ev
+      self.num_computed += 1
+    return ev
+
+  def compute_all(self):
+    """
+    Computes every street for both players that isn't known yet, in one batch so that the equity
+    calls run in parallel (see CalcWithLookup.calc_many).
+    """
+    todo = [(s, i) for s in PRECOMPUTED_EV_ITERS for i in (0, 1) if (s, i) not in self._ev]
+    evs = EV_CALCULATOR.calc_many([(self.hands[i], self.boards[s], b"") for s, i in todo],
+                                  [PRECOMPUTED_EV_ITERS[s] for s, _ in todo])
+    for (s, i), ev in zip(todo, evs):
+      self._ev[(s, i)] = float(ev)
+    self.num_computed += len(todo)
+    return self
+
+  def num_skipped(self):
+    return self.NUM_ENTRIES - self.num_computed
+
+  def to_array(self):
+    """
+    Returns: (np.ndarray) of shape (4, 2), the ev of each street (in PRECOMPUTED_EV_ITERS order) and
+             player. Computes anything missing first.
+    """
+    self.compute_all()
+    return np.array([[self._ev[(s, i)] for i in (0, 1)] for s in PRECOMPUTED_EV_ITERS])
+
+  @staticmethod
+  def from_array(round_state, evs):
+    """
+    Makes a PrecomputedEv that's already filled in from to_array (i.e a row of a DealCorpus).
+    """
+    precomputed_ev = PrecomputedEv(round_state)
+    for k, s in enumerate(PRECOMPUTED_EV_ITERS):
+      for i in (0, 1):
+        precomputed_ev._ev[(s, i)] = float(evs[k][i])
+    return precomputed_ev
+
+  def __getitem__(self, street):
+    return _StreetEv(self, street)
+
 
-    h1 = [str(round_state.hands[0][0]), str(round_state.hands[0][1])]
-    h2 = [str(round_state.hands[1][0]), str(round_state.hands[1][1])]
-    board = str.encode("".join([str(c) for c in round_state.deck.peek(s)]))
+def make_precomputed_ev(round_state, lazy=True):
+  """
+  Returns a PrecomputedEv for the round. With lazy=False, every street is computed up front.
+  """
+  precomputed_ev = PrecomputedEv(round_state)
+  return precomputed_ev if lazy else precomputed_ev.compute_all()
 
-    ev1 = EV_CALCULATOR.calc(h1, board, b"", iters)
-    ev2 = EV_CALCULATOR.calc(h2, board, b"", iters)
-    out[s] = [ev1, ev2]
 
-  return out
+def bet_history_slot(street, i):
+  """
+  The index in make_bet_history_vec where the i-th action of a street (0, 1, 2, or 3) goes. Actions
+  past the end of a street's slots wrap around onto the last two slots.
+  """
+  offset = street * Constants.BET_ACTIONS_PER_STREET + (2 if street > 0 else 0)
+  if street > 0:
+    i = min(i, Constants.BET_ACTIONS_PER_STREET - 2 + i % 2)
+  else:
+    bet_actions_preflop = Constants.BET_ACTIONS_PER_STREET + 2
+    i = min(i, bet_actions_preflop - 2 + i % 2)
+  return offset + i
+
+
+def make_bet_history_vec(bet_history):
+  """
+  Flattens a per-street bet history into the fixed size vector used by infosets.
+  """
+  h = [0] * (2 + Constants.BET_HISTORY_SIZE)
+  for street, actions in enumerate(bet_history):
+    for i, add_amt in enumerate(actions):
+      h[bet_history_slot(street, i)] += add_amt
+  return torch.Tensor(h)
 
 
-def make_infoset(round_state, player_idx, player_is_sb, precomputed_ev=None):
+def make_infoset(round_state, player_idx, player_is_sb, precomputed_ev=None, bet_history_vec=None):
   """
   Make an information set representation of the game state.
 
   round_state (RoundState) : From MIT game engine.
   player_idx (int) : 0 if P1 is acting, 1 if P2 is acting.
   player_is_sb (bool) : Is the acting player the SB?
+  bet_history_vec (torch.Tensor) : Optional, the already computed make_bet_history_vec for this state.
   """
-  h = torch.zeros(2 + Constants.BET_HISTORY_SIZE)
-  for street, actions in enumerate(round_state.bet_history):
-    offset = street * Constants.BET_ACTIONS_PER_STREET + (2 if street > 0 else 0)
-    for i, add_amt in enumerate(actions):
-      if street > 0:
-        i = min(i, Constants.BET_ACTIONS_PER_STREET - 2 + i % 2)
-      else:
-        bet_actions_preflop = Constants.BET_ACTIONS_PER_STREET + 2
-        i = min(i, bet_actions_preflop - 2 + i % 2)
-      h[offset + i] += add_amt
+  if bet_history_vec is not None:
+    h = bet_history_vec
+  elif isinstance(round_state, TreeRoundState):
+    h = torch.from_numpy(round_state.tree.bet_history_vec[round_state.node])
+  else:
+    h = make_bet_history_vec(round_state.bet_history)
 
   if precomputed_ev is not None:
     ev = precomputed_ev[round_state.street][player_idx]
@@ -84,13 +184,77 @@ def make_infoset(round_state, player_idx, player_is_sb, precomputed_ev=None):
     return EvInfoSet(ev, h, 0 if player_is_sb else 1, get_street_0123(round_state.street))
 
 
+class InfoSetBuilder(object):
+  def __init__(self, round_state):
+    """
+    Keeps make_bet_history_vec up to date while a traversal applies and undoes actions, so that
+    each action costs one update instead of replaying the whole bet history at every node. Use
+    apply() and undo() in place of round_state.apply() and round_state.undo().
+
+    NOTE: Infosets from make_infoset() share the builder's bet history vector. Its contents are
+    only changed by a child apply(), and undo() puts them back before control returns to the parent.
+    NOTE: A TreeRoundState already has its vectors precomputed, so nothing is tracked for it.
+    """
+    self._is_tree = isinstance(round_state, TreeRoundState)
+    self._bet_history_vec = None if self._is_tree else make_bet_history_vec(round_state.bet_history)
+    self._undo_stack = []
+
+  def apply(self, round_state, action):
+    """
+    Updates the bet history vector for action, then applies it to round_state.
+    """
+    if self._is_tree or isinstance(action, FoldAction):
+      self._undo_stack.append(None)
+      return round_state.apply(action)
+
+    active = round_state.button % 2
+    if isinstance(action, CallAction):
+      add_amt = round_state.pips[1 - active] - round_state.pips[active]
+    elif isinstance(action, RaiseAction):
+      add_amt = action.amount - round_state.pips[active]
+    else:
+      add_amt = 0
+
+    slot = bet_history_slot(len(round_state.bet_history) - 1, len(round_state.bet_history[-1]))
+    self._bet_history_vec[slot] += add_amt
+    self._undo_stack.append((slot, add_amt))
+    return round_state.apply(action)
+
+  def undo(self, round_state):
+    """
+    Undoes the last apply() on round_state and the bet history vector.
+    """
+    round_state.undo()
+    last = self._undo_stack.pop()
+    if last is not None:
+      self._bet_history_vec[last[0]] -= last[1]
+
+  @property
+  def bet_history_vec(self):
+    """
+    The make_bet_history_vec for the current state (None for a TreeRoundState).
+    """
+    return self._bet_history_vec
+
+  def make_infoset(self, round_state, player_idx, player_is_sb, precomputed_ev=None):
+    """
+    Same as make_infoset(), using the tracked bet history vector.
+    """
+    return make_infoset(round_state, player_idx, player_is_sb, precomputed_ev,
+                        bet_history_vec=self._bet_history_vec)
+
+
 def make_actions(round_state):
   """
   Makes the actions that our network can take (Fold, Call, Check, PotRaise, TwoPotRaise, ThreePotRaise).
   NOTE: A pot BET means adding chips to the pot equal to the current pot size.
   NOTE: A pot RAISE means calling and THEN adding chips equal to the called pot size.
   NOTE: If the current pot is x, then a pot raise puts the pip at 3x, two pot raise puts the pip at 5x, three pot at 7x.
+  NOTE: A TreeRoundState reads these from its precompiled BettingTree instead.
   """
+  if isinstance(round_state, TreeRoundState):
+    return round_state.tree.actions(round_state.node)
+
   valid_action_set = round_state.legal_actions()
   min_raise, max_raise = round_state.raise_bounds()
   pot_size = 2*Constants.INITIAL_STACK - (round_state.stacks[0] + round_state.stacks[1])
@@ -118,15 +282,28 @@ def make_actions(round_state):
   return actions_unscaled, actions_mask
 
 
-def create_new_round(button_player):
+def create_new_round(button_player, state_type="namedtuple", betting_tree=None):
   """
   Randomly generate a round_state to start a new round.
   button_player (int) : 0 if PLAYER1 should be button (small blind), 1 if PLAYER2.
+  state_type (str) : "namedtuple" for a RoundState, "mutable" for a MutableRoundState, "compact"
+                     for a CompactRoundState (without the previous_state chain), or "tree" for a
+                     TreeRoundState at the root of betting_tree.
+  betting_tree (BettingTree) : Only needed for the "tree" state type.
   NOTE: Button should alternate every time.
   """
   deck = eval7.Deck()
   deck.shuffle()
   hands = [deck.deal(2), deck.deal(2)]
+  return make_new_round(hands, deck, button_player, state_type=state_type, betting_tree=betting_tree)
+
+
+def make_new_round(hands, deck, button_player, state_type="namedtuple", betting_tree=None):
+  """
+  Makes the round_state at the start of a round with the given cards (see create_new_round).
+  hands (list) : Two eval7.Card hole cards for each player.
+  deck (eval7.Deck) : The remaining deck, with the board as its first 5 cards.
+  """
   sb = Constants.SMALL_BLIND_AMOUNT
   bb = 2*Constants.SMALL_BLIND_AMOUNT
   pips = [sb, bb]
@@ -134,10 +311,50 @@ def create_new_round(button_player):
   if button_player == 1:
     pips.reverse()
     stacks.reverse()
-  round_state = RoundState(button_player, 0, pips, stacks, hands, deck, None, [[1, 2]], button_player)
+  # The hands and board are fixed for the whole round, so evaluate the showdown once up front.
+  showdown_winner = get_showdown_winner(hands, deck.peek(5))
+  round_state = RoundState(button_player, 0, pips, stacks, hands, deck, None, [[1, 2]], button_player,
+                           showdown_winner)
+  if state_type == "mutable":
+    return MutableRoundState.from_round_state(round_state)
+  elif state_type == "compact":
+    return CompactRoundState.from_round_state(round_state)
+  elif state_type == "tree":
+    return betting_tree.root_state(round_state)
   return round_state
 
 
+# Cards in the same rank-major order as utils.encode_cards (2c 2d 2h 2s ... Ac Ad Ah As).
+DECK_CARDS = [eval7.Card(rank + suit) for rank in "23456789TJQKA" for suit in "cdhs"]
+
+
+def create_deals(num_deals, seed):
+  """
+  Deals num_deals rounds at once with a single vectorized draw.
+
+  seed (int or list of int) : Anything np.random.default_rng accepts. Passing the same seed always
+                              gives the same deals, so use e.g [seed, t, worker_id] to give each
+                              traverse worker its own reproducible stream.
+
+  Returns: (np.ndarray) with shape (num_deals, 9) of card indices into DECK_CARDS. Columns 0-1 are
+           the hole cards for PLAYER1, 2-3 for PLAYER2, and 4-8 are the board.
+  """
+  rng = np.random.default_rng(seed)
+  return np.argsort(rng.random((num_deals, 52)), axis=1)[:,:9].astype(np.int8)
+
+
+def round_state_from_deal(deal, button_player, state_type="namedtuple", betting_tree=None):
+  """
+  Makes the round_state for one row of create_deals (see create_new_round for the other args).
+  """
+  cards = [DECK_CARDS[i] for i in deal.tolist()]
+  dealt = set(cards)
+  deck = eval7.Deck()
+  deck.cards = cards[4:] + [c for c in deck.cards if c not in dealt]
+  return make_new_round([cards[0:2], cards[2:4]], deck, button_player, state_type=state_type,
+                        betting_tree=betting_tree)
+
+
 class TreeNodeInfo(object):
   def __init__(self):
     """
@@ -155,7 +372,22 @@ class TreeNodeInfo(object):
 
 class RegretMatchedStrategy(object):
   def __init__(self):
-    self._regrets = {}
+    self._regrets = RegretTable(Constants.NUM_ACTIONS)
+
+  def share(self, capacity, lock):
+    """
+    Moves the table into shared memory (see SharedRegretTable), so that processes this object is
+    passed to update it in place.
+    """
+    self._regrets = SharedRegretTable.from_table(self._regrets, capacity, lock)
+
+  def close(self):
+    """
+    Detaches from the shared memory from share(), and frees it in the process that called share()
+    (does nothing for a private table).
+    """
+    if isinstance(self._regrets, SharedRegretTable):
+      self._regrets.close()
 
   def size(self):
     return len(self._regrets)
@@ -165,85 +397,114 @@ class RegretMatchedStrategy(object):
     Adds an instantaneous regret to total regret.
     """
     assert(len(r) == Constants.NUM_ACTIONS)
+    self.add_regret_for_key(bucket_small_key(infoset), r.numpy())
 
-    # t0 = time.time()
-    bucket = bucket_small(infoset)
-    bstring = bucket_small_join(bucket)
-    # elapsed = time.time() - t0
-    # print("Bucket=", elapsed)
-
-    if bstring not in self._regrets:
-      self._regrets[bstring] = torch.zeros(Constants.NUM_ACTIONS)
-
-    # CFR+ regret matching.
+  def add_regret_for_key(self, bkey, r):
+    """
+    Same as add_regret, with the bucket key of the infoset and r as a float32 np.ndarray.
+    """
+    # CFR+ regret matching (clips the total regret at zero in place).
     # https://arxiv.org/pdf/1407.5042.pdf
-    self._regrets[bstring] = torch.max(torch.zeros(Constants.NUM_ACTIONS), self._regrets[bstring] + r)
-    # self._regrets[bstring] += r
+    self._regrets.add(bkey, r, clip=True)
 
   def get_strategy(self, infoset, valid_mask):
     """
     Does regret matching to return a probabilistic strategy.
     """
-    bucket = bucket_small(infoset)
-    bstring = bucket_small_join(bucket)
-
-    if bstring not in self._regrets:
-      self._regrets[bstring] = torch.zeros(Constants.NUM_ACTIONS)
-    total_regret = self._regrets[bstring]
+    return torch.from_numpy(self.get_strategy_for_key(bucket_small_key(infoset)))
 
-    with torch.no_grad():
-      r_plus = torch.clamp(total_regret, min=0)
+  def get_strategy_for_key(self, bkey):
+    """
+    Same as get_strategy, with the bucket key of the infoset, returning a float32 np.ndarray.
+    """
+    total_regret = self._regrets.get(bkey, create=True)
+    r_plus = np.maximum(total_regret, 0)
+    r_plus_sum = r_plus.sum()
 
-    if r_plus.sum() < 1e-3:
-      return torch.ones(Constants.NUM_ACTIONS) / Constants.NUM_ACTIONS
+    if r_plus_sum < 1e-3:
+      return np.full(Constants.NUM_ACTIONS, 1.0 / Constants.NUM_ACTIONS, dtype=np.float32)
     else:
-      return r_plus / r_plus.sum()
+      return r_plus / r_plus_sum
+
+  def _table(self):
+    # Shared tables are copied out of shared memory to be saved.
+    return self._regrets.to_table() if isinstance(self._regrets, SharedRegretTable) else self._regrets
 
-  def save(self, filename):
-    os.makedirs(os.path.abspath(os.path.dirname(filename)), exist_ok=True)
-    with open(filename, "wb") as f:
-      pickle.dump(self._regrets, f)
+  def save(self, filename, num_shards=1):
+    """
+    Saves as arrays if filename ends in .npz, as a memory mapped table if it ends in .rtab, or
+    otherwise as the legacy pickle (see RegretTable.save).
+    With num_shards > 1, the keys are split by hash into that many files (see save_sharded).
+    """
+    save_sharded(self._table(), filename, num_shards)
     print("Saved RegretMatchedStrategy to {}".format(filename))
 
-  def load(self, filename):
-    with open(filename, "rb") as f:
-      self._regrets = pickle.load(f)
+  def load(self, filename, num_shards=1):
+    self._regrets = load_sharded(filename, num_shards, Constants.NUM_ACTIONS)
     print("Loaded {} items from {}".format(self.size(), filename))
 
-  def merge_and_save(self, filename, lock):
-    lock.acquire()
+  def track_changes(self):
+    """
+    Starts recording which rows change, for save_delta (see RegretTable.track_changes).
+    """
+    self._regrets.track_changes()
 
-    existing_regrets = {}
-    if os.path.exists(filename):
-      print("[MERGE] File already exists, loading and combining with myself")
-      with open(filename, "rb") as f:
-        existing_regrets = pickle.load(f)
-    
-    print("[MERGE] Merging {} existing with my {}".format(len(existing_regrets), self.size()))
-    for key in self._regrets:
-      if key not in existing_regrets:
-        existing_regrets[key] = torch.zeros(Constants.NUM_ACTIONS)
-      existing_regrets[key] += self._regrets[key]
+  def save_delta(self, filename):
+    """
+    Saves only the change to each row since track_changes, for apply_deltas to add to the master table.
+    """
+    keys, values = self._regrets.delta()
+    save_delta(filename, keys, values)
+    print("Saved a delta of {} rows to {}".format(len(keys), filename))
 
-    print("[MERGE] Total of {} regrets after merge".format(len(existing_regrets)))
+  def apply_deltas(self, filenames):
+    """
+    Adds up the deltas from save_delta (e.g one per worker) and applies them once.
+    """
+    num_rows = apply_delta_files(self._regrets, filenames)
+    print("[MERGE] Applied {} rows from {} deltas, total of {} now".format(num_rows, len(filenames), self.size()))
 
-    os.makedirs(os.path.abspath(os.path.dirname(filename)), exist_ok=True)
-    with open(filename, "wb") as f:
-      pickle.dump(existing_regrets, f)
+  def merge_and_save(self, filename, lock, num_shards=1, first_shard=0):
+    """
+    Adds this table into the one saved at filename. When sharded, lock is a list with one lock per
+    shard, and the shards are merged in turn starting from first_shard, so that workers starting at
+    different shards merge concurrently.
+    """
+    filenames = shard_filenames(filename, num_shards)
+    locks = lock if num_shards > 1 else [lock]
+    shards = split_table(self._table(), num_shards) if num_shards > 1 else [self._table()]
 
-    print("[MERGE] Done with merge, releasing lock")
-    lock.release()
+    for j in range(num_shards):
+      k = (first_shard + j) % num_shards
+      with locks[k]:
+        existing_regrets = RegretTable(Constants.NUM_ACTIONS)
+        if os.path.exists(filenames[k]):
+          print("[MERGE] File already exists, loading and combining with myself")
+          existing_regrets = RegretTable.load(filenames[k], Constants.NUM_ACTIONS)
+
+        print("[MERGE] Merging {} existing with my {}".format(len(existing_regrets), len(shards[k])))
+        existing_regrets.add_rows(shards[k].keys(), shards[k].values())
+        print("[MERGE] Total of {} regrets after merge".format(len(existing_regrets)))
+
+        existing_regrets.save(filenames[k])
+
+    print("[MERGE] Done with merge")
 
 
 def traverse_cfr(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies, t,
                  reach_probabilities, precomputed_ev, rctr=[0], allow_updates=True,
-                 do_external_sampling=True, skip_unreachable_actions=False):
+                 do_external_sampling=True, skip_unreachable_actions=False, infoset_builder=None):
   """
   Traverse the game tree with external and chance sampling.
 
   NOTE: Only the traverse player updates their regrets. When the non-traverse player acts,
   they add their strategy to the average strategy.
+  NOTE: Children are visited with round_state.apply() and round_state.undo() (through the
+  InfoSetBuilder), so a MutableRoundState is walked in place and a RoundState is copied at every node.
   """
+  if infoset_builder is None:
+    infoset_builder = InfoSetBuilder(round_state)
+
   with torch.no_grad():
     node_info = TreeNodeInfo()
     rctr[0] += 1
@@ -258,7 +519,7 @@ def traverse_cfr(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies, t
     inactive_plyr_idx = (1 - active_plyr_idx)
 
     # t0 = time.time()
-    infoset = make_infoset(round_state, active_plyr_idx, (active_plyr_idx == sb_plyr_idx), precomputed_ev)
+    infoset = infoset_builder.make_infoset(round_state, active_plyr_idx, (active_plyr_idx == sb_plyr_idx), precomputed_ev)
     # elapsed = time.time() - t0
     # print("Make infoset=", elapsed)
     # t0 = time.time()
@@ -289,13 +550,15 @@ def traverse_cfr(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies, t
       action_probs += 0.05 * mask # Small chance of choosing every action.
       action_probs /= action_probs.sum()
       action = actions[torch.multinomial(action_probs, 1).item()]
-      next_round_state = round_state.copy().proceed(action)
-      next_reach_prob = reach_probabilities.clone()
-      return traverse_cfr(next_round_state, traverse_plyr, sb_plyr_idx, regrets,
-                          strategies, t, reach_probabilities, precomputed_ev,
-                          rctr=rctr, allow_updates=allow_updates,
-                          do_external_sampling=do_external_sampling,
-                          skip_unreachable_actions=skip_unreachable_actions)
+      next_round_state = infoset_builder.apply(round_state, action)
+      child_node_info = traverse_cfr(next_round_state, traverse_plyr, sb_plyr_idx, regrets,
+                                     strategies, t, reach_probabilities, precomputed_ev,
+                                     rctr=rctr, allow_updates=allow_updates,
+                                     do_external_sampling=do_external_sampling,
+                                     skip_unreachable_actions=skip_unreachable_actions,
+                                     infoset_builder=infoset_builder)
+      infoset_builder.undo(round_state)
+      return child_node_info
     
     else:
       for i, a in enumerate(actions):
@@ -303,14 +566,15 @@ def traverse_cfr(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies, t
           continue
 
         assert(mask[i] > 0)
-        next_round_state = round_state.copy().proceed(a)
+        next_round_state = infoset_builder.apply(round_state, a)
         next_reach_prob = reach_probabilities.clone()
         next_reach_prob[active_plyr_idx] *= action_probs[i]
         child_node_info = traverse_cfr(
             next_round_state, traverse_plyr, sb_plyr_idx, regrets,
             strategies, t, next_reach_prob, precomputed_ev,
             rctr=rctr, allow_updates=allow_updates, do_external_sampling=do_external_sampling,
-            skip_unreachable_actions=skip_unreachable_actions)
+            skip_unreachable_actions=skip_unreachable_actions, infoset_builder=infoset_builder)
+        infoset_builder.undo(round_state)
 
         action_values[:,i] = child_node_info.strategy_ev
         br_values[:,i] = child_node_info.best_response_ev
@@ -333,3 +597,229 @@ def traverse_cfr(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies, t
         regrets[active_plyr_idx].add_regret(infoset, reach_probabilities[inactive_plyr_idx] * immediate_regrets_tp)
 
       return node_info
+
+
+class TraverseScratch(object):
+  def __init__(self, max_depth=32):
+    """
+    Per-depth arrays for traverse_cfr_iterative, allocated once and reused by every node at the same
+    depth (and by every traversal), instead of a TreeNodeInfo and value tensors at each node.
+
+    NOTE: Sums go through torch views of the arrays (the t_ attributes), because torch adds up a row
+    in a different order than numpy, and traverse_cfr has to be matched to the last bit.
+
+    NOTE: A scratch can only be used by one traversal at a time (see use()). By default, each thread
+    gets its own (see thread_scratch).
+    """
+    self.max_depth = 0
+    self.in_use = False
+    self._grow(max_depth)
+
+  @contextlib.contextmanager
+  def use(self):
+    """
+    Holds the scratch for one traversal.
+    """
+    assert not self.in_use, "TraverseScratch is already used by another traversal"
+    self.in_use = True
+    try:
+      yield self
+    finally:
+      self.in_use = False
+
+  def _grow(self, max_depth):
+    old = self.max_depth
+    def grow_array(name, shape):
+      array = np.zeros((max_depth,) + shape, dtype=np.float32)
+      if old > 0:
+        array[:old] = getattr(self, name)
+      setattr(self, name, array)
+      setattr(self, "t_" + name, torch.from_numpy(array))
+
+    grow_array("action_values", (2, Constants.NUM_ACTIONS))
+    grow_array("br_values", (2, Constants.NUM_ACTIONS))
+    grow_array("weighted", (2, Constants.NUM_ACTIONS))
+    grow_array("action_probs", (Constants.NUM_ACTIONS,))
+    grow_array("reach", (2,))
+    grow_array("strategy_ev", (2,))
+    grow_array("best_response_ev", (2,))
+    grow_array("exploitability", (2,))
+    for name in ("states", "actions", "masks", "bkeys", "active", "next_action", "passthrough"):
+      setattr(self, name, getattr(self, name, []) + [None] * (max_depth - old))
+    self.max_depth = max_depth
+
+  def ensure_depth(self, depth):
+    if depth >= self.max_depth:
+      self._grow(2 * self.max_depth)
+
+
+_thread_local = threading.local()
+
+
+def thread_scratch():
+  """
+  The TraverseScratch for the current thread, created on first use.
+  """
+  scratch = getattr(_thread_local, "scratch", None)
+  if scratch is None:
+    scratch = _thread_local.scratch = TraverseScratch()
+  return scratch
+
+
+def traverse_cfr_iterative(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies, t,
+                           reach_probabilities, precomputed_ev, rctr=[0], allow_updates=True,
+                           do_external_sampling=True, skip_unreachable_actions=False, infoset_builder=None,
+                           scratch=None):
+  """
+  Same traversal, arguments, and result as traverse_cfr, with an explicit stack instead of recursion.
+  Each depth of the stack has preallocated float32 scratch arrays (see TraverseScratch), and regret
+  matching, values, and updates are done with numpy on them. Nodes are visited, and regrets and
+  strategies are updated, in the same order as traverse_cfr, so both produce the same tables.
+
+  scratch (TraverseScratch) : The arrays to use. Defaults to this thread's (see thread_scratch).
+  """
+  if infoset_builder is None:
+    infoset_builder = InfoSetBuilder(round_state)
+  if scratch is None:
+    scratch = thread_scratch()
+
+  with scratch.use() as s, torch.no_grad():
+    rctr[0] += 1
+    if isinstance(round_state, TerminalState):
+      node_info = TreeNodeInfo()
+      node_info.strategy_ev = torch.Tensor(round_state.deltas)
+      node_info.best_response_ev = node_info.strategy_ev
+      return node_info
+
+    s.reach[0] = np.asarray(reach_probabilities, dtype=np.float32)
+
+    def enter(d, state):
+      """
+      Does regret matching at a non-terminal node, and pushes it at depth d.
+      """
+      active_plyr_idx = state.button % 2
+      infoset = infoset_builder.make_infoset(state, active_plyr_idx, (active_plyr_idx == sb_plyr_idx), precomputed_ev)
+      bkey = bucket_small_key(infoset)
+      actions, mask = make_actions(state)
+      mask = mask.numpy()
+
+      # Same as apply_mask_and_uniform.
+      action_probs = s.action_probs[d]
+      np.multiply(regrets[active_plyr_idx].get_strategy_for_key(bkey), mask, out=action_probs)
+      if np.float32(s.t_action_probs[d].sum().item()) <= np.float32(1e-3):
+        action_probs[:] = mask
+      action_probs /= np.float32(s.t_action_probs[d].sum().item())
+      if abs(action_probs.sum() - 1.0) > 2e-3:
+        print("WARNING: action_probs did not sum to 1.0 (sum={})".format(action_probs.sum()))
+        print("action_probs =", action_probs)
+        assert(False)
+
+      s.states[d], s.actions[d], s.masks[d] = state, actions, mask
+      s.bkeys[d], s.active[d] = bkey, active_plyr_idx
+      s.passthrough[d] = active_plyr_idx != traverse_plyr and do_external_sampling
+      if s.passthrough[d]:
+        # EXTERNAL SAMPLING: choose only ONE action for the non-traversal player.
+        sample_probs = torch.from_numpy(action_probs.copy())
+        sample_probs += 0.05 * torch.from_numpy(mask) # Small chance of choosing every action.
+        sample_probs /= sample_probs.sum()
+        s.next_action[d] = torch.multinomial(sample_probs, 1).item()
+      else:
+        s.action_values[d] = 0
+        s.br_values[d] = 0
+        s.next_action[d] = -1
+
+    def next_action(d):
+      """
+      Returns the index of the next child to visit at depth d, or -1 when they've all been visited.
+      """
+      i = s.next_action[d]
+      if s.passthrough[d]:
+        s.next_action[d] = len(s.actions[d])
+        return i if i < len(s.actions[d]) else -1
+      mask, action_probs = s.masks[d], s.action_probs[d]
+      for i in range(i + 1, len(s.actions[d])):
+        if mask[i] <= 0 or (skip_unreachable_actions and action_probs[i] <= 0):
+          continue
+        s.next_action[d] = i
+        return i
+      s.next_action[d] = len(s.actions[d])
+      return -1
+
+    def child_done(d, i):
+      """
+      Stores the values of child i (at depth d + 1) in the node at depth d.
+      """
+      if s.passthrough[d]:
+        s.strategy_ev[d] = s.strategy_ev[d + 1]
+        s.best_response_ev[d] = s.best_response_ev[d + 1]
+        s.exploitability[d] = s.exploitability[d + 1]
+      else:
+        s.action_values[d, :, i] = s.strategy_ev[d + 1]
+        s.br_values[d, :, i] = s.best_response_ev[d + 1]
+
+    def finish(d):
+      """
+      Computes the values at depth d once its children are done, and updates the tables.
+      """
+      if s.passthrough[d]:
+        return
+      active_plyr_idx, action_probs, mask = s.active[d], s.action_probs[d], s.masks[d]
+      inactive_plyr_idx = 1 - active_plyr_idx
+      action_values, br_values = s.action_values[d], s.br_values[d]
+
+      # Sum along every action multiplied by its probability of occurring.
+      np.multiply(action_values, action_probs, out=s.weighted[d])
+      torch.sum(s.t_weighted[d], dim=1, out=s.t_strategy_ev[d])
+      strategy_ev = s.strategy_ev[d]
+
+      # Best response strategy: the acting player chooses the BEST action with probability 1.
+      best_response_ev = s.best_response_ev[d]
+      best_response_ev[active_plyr_idx] = br_values[active_plyr_idx, mask > 0].max()
+      np.multiply(action_probs, br_values[inactive_plyr_idx], out=s.weighted[d, 0])
+      best_response_ev[inactive_plyr_idx] = s.t_weighted[d, 0].sum().item()
+      np.subtract(best_response_ev, strategy_ev, out=s.exploitability[d])
+
+      if allow_updates and active_plyr_idx == traverse_plyr:
+        immediate_regrets_tp = mask * (action_values[active_plyr_idx] - strategy_ev[active_plyr_idx])
+        opponent_reach = s.reach[d, inactive_plyr_idx]
+        strategies[active_plyr_idx].add_regret_for_key(s.bkeys[d], opponent_reach * action_probs)
+        regrets[active_plyr_idx].add_regret_for_key(s.bkeys[d], opponent_reach * immediate_regrets_tp)
+
+    enter(0, round_state)
+    d = 0
+    while d >= 0:
+      i = next_action(d)
+      if i < 0:
+        finish(d)
+        if d > 0:
+          infoset_builder.undo(s.states[d - 1])
+          child_done(d - 1, s.next_action[d - 1] if not s.passthrough[d - 1] else None)
+        d -= 1
+        continue
+
+      child = infoset_builder.apply(s.states[d], s.actions[d][i])
+      rctr[0] += 1
+      s.ensure_depth(d + 1)
+      s.reach[d + 1] = s.reach[d]
+      if not s.passthrough[d]:
+        s.reach[d + 1, s.active[d]] *= s.action_probs[d, i]
+
+      if isinstance(child, TerminalState):
+        # There are no choices to make here; the best response payoff is the outcome.
+        s.strategy_ev[d + 1] = child.deltas
+        s.best_response_ev[d + 1] = child.deltas
+        s.exploitability[d + 1] = 0
+        infoset_builder.undo(s.states[d])
+        child_done(d, i)
+      else:
+        enter(d + 1, child)
+        d += 1
+
+    node_info = TreeNodeInfo()
+    node_info.strategy_ev = torch.from_numpy(s.strategy_ev[0].copy())
+    node_info.best_response_ev = torch.from_numpy(s.best_response_ev[0].copy())
+    node_info.exploitability = torch.from_numpy(s.exploitability[0].copy())
+    return node_info
+
+
+TRAVERSE_ENGINES = {"recursive": traverse_cfr, "iterative": traverse_cfr_iterative}
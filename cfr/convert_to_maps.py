@@ -1,22 +1,28 @@
 import pickle
-import os
+import os, sys
 import argparse
 import torch
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from infoset import bucket_small_unpack, bucket_small_join
+from regret_table import RegretTable
+
 if __name__ == "__main__":
   filename = "./07/avg_strategy_0.pkl"
   # filename = "./total_regrets_0.pkl"
 
-  d = {}
-  with open(filename, "rb") as f:
-    d = pickle.load(f)
+  # Handles both the legacy .pkl and the .npz format.
+  d = RegretTable.load(filename).to_dict()
 
-  print("Loaded {} items from pickle file {}".format(len(d), filename))
+  print("Loaded {} items from {}".format(len(d), filename))
 
   folder = os.path.abspath(os.path.dirname(filename))
   with open(os.path.join(folder, "avg_strategy.txt"), "w") as f:
     for key in d:
       space_sep = " ".join([str(v) for v in list(d[key].numpy())])
+      # The C++ bot looks strategies up by the readable string key.
+      if isinstance(key, int):
+        key = bucket_small_join(bucket_small_unpack(key))
       f.write("{} {}\n".format(key, space_sep))
 
   print("Done.")
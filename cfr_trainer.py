@@ -7,53 +7,90 @@ from tensorboardX import SummaryWriter
 from constants import Constants
 from utils import *
 from cfr import *
-from infoset import EvInfoSet
+from infoset import EvInfoSet, bucket_small_cache_info
+from betting_tree import BettingTree
+from deal_corpus import WorkerDeals
 
 
-def traverse_worker(worker_id, traverse_plyr, regret_filenames, strategy_filenames, r_lock, s_lock, opt, t):
+def traverse_worker(worker_id, traverse_plyr, regret_filenames, strategy_filenames, r_lock, s_lock, opt, t,
+                    shared_tables=None):
   """
   A worker that traverses the game tree K times. Each worker gets a copy of the regret buffers,
   and we merge all the results at the end.
+
+  If shared_tables (regrets, strategies) are given, they're in shared memory (--SHARED_REGRET_TABLES),
+  so the worker updates them in place and doesn't load or merge anything.
   """
   num_traversals_per_worker = int(opt.NUM_TRAVERSALS_PER_ITER / opt.NUM_TRAVERSE_WORKERS)
 
   # Load everything in from disk to make sure that every worker has identical initialization.
   t0 = time.time()
-  regrets = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
-  strategies = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
-  for i in (0, 1):
-    regrets[i].load(regret_filenames[i])
-    strategies[i].load(strategy_filenames[i])
+  if shared_tables is not None:
+    regrets, strategies = shared_tables
+  else:
+    regrets = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
+    strategies = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
+    for i in (0, 1):
+      regrets[i].load(regret_filenames[i], opt.CHECKPOINT_SHARDS)
+      strategies[i].load(strategy_filenames[i], opt.CHECKPOINT_SHARDS)
+      if opt.MERGE_MODE == "delta":
+        regrets[i].track_changes()
+        strategies[i].track_changes()
+  betting_tree = BettingTree.load(opt.BETTING_TREE_PATH) if opt.ROUND_STATE_TYPE == "tree" else None
+  configure_ev_calculator(opt)
   elapsed = time.time() - t0
   print("[WORKER #{}] Loaded everything from disk in {} sec".format(worker_id, elapsed))
   
+  traverse = TRAVERSE_ENGINES[opt.TRAVERSE_ENGINE]
   t0 = time.time()
-  for k in range(num_traversals_per_worker):
-    ctr = [0]
-
-    # Generate a random initialization, alternating the SB player each time.
-    sb_plyr_idx = 1 - (k % 2)
-    round_state = create_new_round(sb_plyr_idx)
-
-    precomputed_ev = make_precomputed_ev(round_state)
-    info = traverse_cfr(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies,
+  ev_computed = 0
+  # Attached shared tables are closed even if a traversal raises (the trainer frees them).
+  try:
+    # Generate a random initialization, alternating the SB player each time (player 1 first).
+    with WorkerDeals(opt, worker_id, t, traverse_plyr, num_traversals_per_worker, first_sb_player=1,
+                     betting_tree=betting_tree) as rounds:
+      for k, (sb_plyr_idx, round_state, precomputed_ev) in enumerate(rounds):
+        ctr = [0]
+        info = traverse(round_state, traverse_plyr, sb_plyr_idx, regrets, strategies,
                         t, torch.ones(2), precomputed_ev, rctr=ctr, allow_updates=True,
                         do_external_sampling=False, skip_unreachable_actions=True)
-
-    if (k % opt.TRAVERSE_DEBUG_PRINT_HZ) == 0:
-      elapsed = time.time() - t0
-      print("[WORKER #{}] Finished {}/{} traversals | exploit={} | explored={} | R1={} R2={} | S1={} S2={} | elapsed={} sec".format(
-            worker_id, k, num_traversals_per_worker, info.exploitability.sum(), ctr[0], regrets[0].size(),
-            regrets[1].size(), strategies[0].size(), strategies[1].size(), elapsed))
+        ev_computed += precomputed_ev.num_computed
+
+        if (k % opt.TRAVERSE_DEBUG_PRINT_HZ) == 0:
+          elapsed = time.time() - t0
+          cache_info = bucket_small_cache_info()
+          print("[WORKER #{}] Finished {}/{} traversals | exploit={} | explored={} | R1={} R2={} | S1={} S2={} | bucket_cache hits={} misses={} | ev computed={}/{} | ev queue={} stall={} sec | elapsed={} sec".format(
+                worker_id, k, num_traversals_per_worker, info.exploitability.sum(), ctr[0], regrets[0].size(),
+                regrets[1].size(), strategies[0].size(), strategies[1].size(), cache_info.hits, cache_info.misses,
+                ev_computed, (k + 1) * PrecomputedEv.NUM_ENTRIES, rounds.queue_depth(), rounds.stall_time(), elapsed))
+  finally:
+    if shared_tables is not None:
+      for i in (0, 1):
+        regrets[i].close()
+        strategies[i].close()
 
   # Save all the buffers one last time.
+
+  if shared_tables is not None:
+    print('[WORKER #{}] Done!'.format(worker_id))
+    return
+
   print("[WORKER #{}] Doing final save".format(worker_id))
   for i in (0, 1):
-    regrets[i].merge_and_save(regret_filenames[i], r_lock)
-    strategies[i].merge_and_save(strategy_filenames[i], s_lock)
+    if opt.MERGE_MODE == "delta":
+      regrets[i].save_delta(delta_filename(regret_filenames[i], worker_id))
+      strategies[i].save_delta(delta_filename(strategy_filenames[i], worker_id))
+    else:
+      # With a sharded checkpoint, workers start at different shards so that they merge concurrently.
+      regrets[i].merge_and_save(regret_filenames[i], r_lock, opt.CHECKPOINT_SHARDS, worker_id)
+      strategies[i].merge_and_save(strategy_filenames[i], s_lock, opt.CHECKPOINT_SHARDS, worker_id)
   print('[WORKER #{}] Done!'.format(worker_id))
 
 
+def delta_filename(filename, worker_id):
+  return "{}.delta_{}.npz".format(filename, worker_id)
+
+
 class Trainer(object):
   def __init__(self, opt):
     self.opt = opt
@@ -71,56 +108,86 @@ class Trainer(object):
     self.writers = {}
     self.writers["cfr"] = SummaryWriter(os.path.join(opt.TRAIN_LOG_FOLDER, "cfr"))
 
-    r0_exists = os.path.exists(os.path.dirname(opt.REGRETS_FMT.format(0)))
-    r1_exists = os.path.exists(os.path.dirname(opt.REGRETS_FMT.format(1)))
-    s0_exists = os.path.exists(os.path.dirname(opt.STRATEGIES_FMT.format(0)))
-    s1_exists = os.path.exists(os.path.dirname(opt.STRATEGIES_FMT.format(1)))
+    # Build the betting tree up front so that the traverse workers only have to load it.
+    self.betting_tree = BettingTree.load_or_build(opt.BETTING_TREE_PATH) if opt.ROUND_STATE_TYPE == "tree" else None
+    configure_ev_calculator(opt)
+
+    # A sharded checkpoint is only resumed from if every one of its shard files exists. Checkpoints
+    # in the legacy .pkl format are resumed from too.
+    checkpoints = [find_checkpoint(fmt.format(i), opt.CHECKPOINT_SHARDS)
+                   for fmt in (opt.REGRETS_FMT, opt.STRATEGIES_FMT) for i in (0, 1)]
 
-    if r0_exists and r1_exists and s0_exists and s1_exists:
+    if all(c is not None for c in checkpoints):
       print("\n*** WARNING: Found existing files, resuming from where we left off")
-      for i in (0, 1):
-        self.regrets[i].load(opt.REGRETS_FMT.format(i))
-        self.strategies[i].load(opt.STRATEGIES_FMT.format(i))
+      self.load()
+      # The workers read and write the tables in the current format, so convert legacy files now.
+      if any(not c.endswith(opt.REGRET_TABLE_EXT) for c in checkpoints):
+        print("NOTE: Converting the legacy checkpoint to {}".format(opt.REGRET_TABLE_EXT))
+        self.save()
     else:
       # Save to create these initial files.
       print("\n*** NOTE: Doing initial save so that stuff exists")
+      self.save()
+
+    # The workers are spawned, so the lock has to come from the spawn context to be passed to them.
+    if opt.SHARED_REGRET_TABLES:
+      lock = mp.get_context("spawn").Lock()
       for i in (0, 1):
-        self.regrets[i].save(opt.REGRETS_FMT.format(i))
-        self.strategies[i].save(opt.STRATEGIES_FMT.format(i))
+        self.regrets[i].share(opt.SHARED_TABLE_CAPACITY, lock)
+        self.strategies[i].share(opt.SHARED_TABLE_CAPACITY, lock)
 
   def main(self):
     cfr_steps = 0
     for t in range(self.opt.NUM_CFR_ITERS):
       for traverse_plyr in (0, 1):
         # Accumulate regrets/strategy profiles for the traverse player. At the end, all of this data
-        # is saved to disk and then lost from memory, so we should reload it.
+        # is saved to disk and then lost from memory, so we should reload it. Shared tables, and
+        # tables that the worker deltas were applied to, are already up to date, so they're just saved.
         self.accumulate_regret(traverse_plyr, t)
-        self.load()
+        if self.opt.SHARED_REGRET_TABLES or self.opt.MERGE_MODE == "delta":
+          self.save()
+        else:
+          self.load()
 
       # Evaluate after each CFR iteration.
       self.evaluate(cfr_steps)
       cfr_steps += 1
 
+    for i in (0, 1):
+      self.regrets[i].close()
+      self.strategies[i].close()
+
+  def save(self):
+    for plyr in (0, 1):
+      self.regrets[plyr].save(self.opt.REGRETS_FMT.format(plyr), self.opt.CHECKPOINT_SHARDS)
+      self.strategies[plyr].save(self.opt.STRATEGIES_FMT.format(plyr), self.opt.CHECKPOINT_SHARDS)
+
   def load(self, regrets_to_load=[0, 1], strategies_to_load=[0, 1]):
     """
     Load regrets and average strategy if files already exist.
     """
     for plyr in (0, 1):
       if plyr in regrets_to_load:
-        filename = self.opt.REGRETS_FMT.format(plyr)
+        filename = find_checkpoint(self.opt.REGRETS_FMT.format(plyr), self.opt.CHECKPOINT_SHARDS) or \
+                   self.opt.REGRETS_FMT.format(plyr)
         print("NOTE: Reloading regrets for player {} from {}".format(plyr, filename))
-        self.regrets[plyr].load(filename)
+        self.regrets[plyr].load(filename, self.opt.CHECKPOINT_SHARDS)
       if plyr in strategies_to_load:
-        filename = self.opt.STRATEGIES_FMT.format(plyr)
+        filename = find_checkpoint(self.opt.STRATEGIES_FMT.format(plyr), self.opt.CHECKPOINT_SHARDS) or \
+                   self.opt.STRATEGIES_FMT.format(plyr)
         print('NOTE: Reloading average strategy for player {} from {}'.format(plyr, filename))
-        self.strategies[plyr].load(filename)
+        self.strategies[plyr].load(filename, self.opt.CHECKPOINT_SHARDS)
   
   def accumulate_regret(self, traverse_plyr, t):
     print("\nAccumulating regrets for player {} (t={})".format(traverse_plyr, t))
 
     manager = mp.Manager()
-    r_lock = manager.Lock()
-    s_lock = manager.Lock()
+    if self.opt.CHECKPOINT_SHARDS > 1:
+      r_lock = [manager.Lock() for _ in range(self.opt.CHECKPOINT_SHARDS)]
+      s_lock = [manager.Lock() for _ in range(self.opt.CHECKPOINT_SHARDS)]
+    else:
+      r_lock = manager.Lock()
+      s_lock = manager.Lock()
 
     regret_filenames = [self.opt.REGRETS_FMT.format(plyr) for plyr in (0, 1)]
     strategy_filenames = [self.opt.STRATEGIES_FMT.format(plyr) for plyr in (0, 1)]
@@ -131,27 +198,55 @@ class Trainer(object):
     t0 = time.time()
     mp.spawn(
       traverse_worker,
-      args=(traverse_plyr, regret_filenames, strategy_filenames, r_lock, s_lock, self.opt, t),
+      args=(traverse_plyr, regret_filenames, strategy_filenames, r_lock, s_lock, self.opt, t,
+            (self.regrets, self.strategies) if self.opt.SHARED_REGRET_TABLES else None),
       nprocs=self.opt.NUM_TRAVERSE_WORKERS, join=True, daemon=False)
     elapsed = time.time() - t0
     print("Time for {} traversals across {} workers: {} sec".format(
       self.opt.NUM_TRAVERSALS_PER_ITER, self.opt.NUM_TRAVERSE_WORKERS, elapsed))
 
+    if self.opt.MERGE_MODE == "delta" and not self.opt.SHARED_REGRET_TABLES:
+      self.apply_worker_deltas()
+
+  def apply_worker_deltas(self):
+    """
+    Sums the deltas that the traverse workers saved and applies them to the tables in memory.
+    """
+    t0 = time.time()
+    for plyr in (0, 1):
+      for table, fmt in ((self.regrets[plyr], self.opt.REGRETS_FMT), (self.strategies[plyr], self.opt.STRATEGIES_FMT)):
+        filenames = [delta_filename(fmt.format(plyr), w) for w in range(self.opt.NUM_TRAVERSE_WORKERS)]
+        table.apply_deltas(filenames)
+        for filename in filenames:
+          os.remove(filename)
+    print("Time to apply worker deltas: {} sec".format(time.time() - t0))
+
   def evaluate(self, step):
     print("\nEvaluating average strategy after {} steps".format(step))
 
     t0 = time.time()
     exploits = torch.zeros(self.opt.NUM_TRAVERSALS_EVAL)
+    traverse = TRAVERSE_ENGINES[self.opt.TRAVERSE_ENGINE]
+
+    # When seeded, every evaluation uses the same deals so that steps are directly comparable.
+    deals = None
+    if self.opt.DEAL_SEED is not None:
+      deals = create_deals(self.opt.NUM_TRAVERSALS_EVAL, self.opt.DEAL_SEED)
   
     for k in range(self.opt.NUM_TRAVERSALS_EVAL):
       sb_plyr_idx = k % 2
-      round_state = create_new_round(sb_plyr_idx)
+      if deals is not None:
+        round_state = round_state_from_deal(deals[k], sb_plyr_idx, state_type=self.opt.ROUND_STATE_TYPE,
+                                            betting_tree=self.betting_tree)
+      else:
+        round_state = create_new_round(sb_plyr_idx, state_type=self.opt.ROUND_STATE_TYPE,
+                                       betting_tree=self.betting_tree)
       precomputed_ev = make_precomputed_ev(round_state)
 
       ctr = [0]
-      info = traverse_cfr(round_state, 0, sb_plyr_idx, self.strategies, self.strategies,
-                          1234, torch.ones(2), precomputed_ev, rctr=ctr, allow_updates=False,
-                          do_external_sampling=False, skip_unreachable_actions=True)
+      info = traverse(round_state, 0, sb_plyr_idx, self.strategies, self.strategies,
+                      1234, torch.ones(2), precomputed_ev, rctr=ctr, allow_updates=False,
+                      do_external_sampling=False, skip_unreachable_actions=True)
       print("exploitability=", info.exploitability)
       print("strategy_ev=", info.strategy_ev)
       print("best_response_ev=", info.best_response_ev)
@@ -189,4 +284,4 @@ class Trainer(object):
 
     # Save the strategies because the eval traversals might have introduced some new keys.
     for i in (0, 1):
-      self.strategies[i].save(self.opt.STRATEGIES_FMT.format(i))
+      self.strategies[i].save(self.opt.STRATEGIES_FMT.format(i), self.opt.CHECKPOINT_SHARDS)
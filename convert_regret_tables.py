@@ -0,0 +1,23 @@
+import os, argparse
+
+from regret_table import RegretTable
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Converts total_regrets_* and avg_strategy_* files between the "
+                                               ".pkl, .npz and .rtab formats (chosen by extension).")
+  parser.add_argument("filenames", nargs="+", help="Files to convert")
+  parser.add_argument("--to", type=str, choices=[".pkl", ".npz", ".rtab"], default=".rtab",
+                      help="Format to convert to (written next to each file with this extension)")
+  args = parser.parse_args()
+
+  for filename in args.filenames:
+    out = os.path.splitext(filename)[0] + args.to
+    if out == filename:
+      print("{} is already {}, skipping".format(filename, args.to))
+      continue
+    table = RegretTable.load(filename)
+    table.save(out)
+    print("Converted {} items from {} to {}".format(len(table), filename, out))
+
+  print("Done.")
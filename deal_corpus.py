@@ -0,0 +1,266 @@
+import os, time, argparse, queue, threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cfr import create_deals, round_state_from_deal, create_new_round, make_precomputed_ev, PrecomputedEv, \
+                PRECOMPUTED_EV_ITERS, EV_CALCULATOR
+
+
+# One row per deal: the card indices from create_deals and PrecomputedEv.to_array for the deal.
+CORPUS_DTYPE = np.dtype([("deal", np.int8, (9,)), ("ev", np.float32, (len(PRECOMPUTED_EV_ITERS), 2))])
+
+
+def deal_evs(deal):
+  """
+  PrecomputedEv.to_array for one row of create_deals.
+  """
+  # The hole cards don't depend on the button, so any button player gives the same equities.
+  return PrecomputedEv(round_state_from_deal(deal, 0)).to_array()
+
+
+def compute_corpus_rows(deals):
+  """
+  Computes the equities for every street and both players of each deal (a create_deals array).
+  """
+  rows = np.zeros(len(deals), dtype=CORPUS_DTYPE)
+  rows["deal"] = deals
+  for i, deal in enumerate(deals):
+    rows["ev"][i] = deal_evs(deal)
+  return rows
+
+
+def _corpus_chunk_worker(args):
+  filename, chunk_idx, start, count, seed, equity_cache_path = args
+  if equity_cache_path is not None:
+    EV_CALCULATOR.open_cache(equity_cache_path)
+  rows = compute_corpus_rows(create_deals(count, [seed, chunk_idx]))
+
+  # Each chunk writes straight into its own rows of the shared file.
+  corpus = np.load(filename, mmap_mode="r+")
+  corpus[start:start+count] = rows
+  corpus.flush()
+  return count
+
+
+def build_deal_corpus(filename, num_deals, seed=0, num_procs=None, chunk_size=10000, equity_cache_path=None):
+  """
+  Deals num_deals rounds and computes all of their equities ahead of time, using num_procs processes
+  (all cores by default). The result is a .npy of CORPUS_DTYPE rows that traverse workers memory-map
+  with DealCorpus, so training doesn't spend any time on Monte Carlo equity.
+
+  filename (str) : Where to write the corpus.
+  num_deals (int) : The number of rows.
+  seed (int) : Chunk i of the corpus is create_deals(chunk_size, [seed, i]).
+  equity_cache_path (str) : Optional EquityCache shared by the processes.
+  """
+  if os.path.dirname(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+  corpus = np.lib.format.open_memmap(filename, mode="w+", dtype=CORPUS_DTYPE, shape=(num_deals,))
+  del corpus
+
+  jobs = []
+  for chunk_idx, start in enumerate(range(0, num_deals, chunk_size)):
+    jobs.append((filename, chunk_idx, start, min(chunk_size, num_deals - start), seed, equity_cache_path))
+
+  t0 = time.time()
+  done = 0
+  with mp.Pool(num_procs or os.cpu_count()) as pool:
+    for count in pool.imap_unordered(_corpus_chunk_worker, jobs):
+      done += count
+      print(">> [DealCorpus] {}/{} deals | elapsed={} sec".format(done, num_deals, time.time() - t0))
+
+
+class DealCorpus(object):
+  def __init__(self, filename):
+    """
+    Read-only, memory-mapped view of a corpus from build_deal_corpus.
+    """
+    self.rows = np.load(filename, mmap_mode="r")
+    assert self.rows.dtype == CORPUS_DTYPE, "Expected a corpus from build_deal_corpus"
+
+  def __len__(self):
+    return len(self.rows)
+
+  def worker_slice(self, worker_id, num_workers):
+    """
+    The contiguous range of rows that belongs to a worker, so that workers never read the same deals.
+    """
+    return (len(self) * worker_id // num_workers, len(self) * (worker_id + 1) // num_workers)
+
+  def read(self, worker_id, num_workers, start, count):
+    """
+    Reads count rows in order from a worker's slice, starting start rows in and wrapping around to the
+    beginning of the slice when it runs out (with a warning, since those deals are then reused).
+
+    Returns: (np.ndarray) of CORPUS_DTYPE rows (in memory).
+    """
+    lo, hi = self.worker_slice(worker_id, num_workers)
+    assert hi > lo, "The corpus has fewer rows than there are workers"
+    if start + count > hi - lo:
+      print("WARNING: Worker {} read past the end of its {} corpus rows (rows {} to {}), reusing deals. "
+            "Build a bigger corpus to avoid this.".format(worker_id, hi - lo, start, start + count))
+    idx = lo + (start + np.arange(count)) % (hi - lo)
+    return np.array(self.rows[idx])
+
+
+class DealProducer(object):
+  def __init__(self, deals, num_threads, queue_size):
+    """
+    Computes the equities of upcoming deals on background threads while the traversal runs, so that
+    Monte Carlo and tree walking overlap (pbots_calc releases the GIL). Results come out of a bounded
+    queue in the same order as the deals.
+
+    deals (np.ndarray) : Rows from create_deals.
+    num_threads (int) : The number of threads computing equities.
+    queue_size (int) : How many deals can be computed ahead of the traversal.
+    """
+    self.deals = deals
+    self.stall_time = 0.0
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._pool = ThreadPoolExecutor(num_threads)
+    self._stop = threading.Event()
+    self._feeder = threading.Thread(target=self._feed, daemon=True)
+    self._feeder.start()
+
+  def _feed(self):
+    for deal in self.deals:
+      if self._stop.is_set():
+        return
+      future = self._pool.submit(deal_evs, deal)
+      # Waits for room in the queue, but gives up as soon as close() is called.
+      while True:
+        try:
+          self._queue.put(future, timeout=0.1)
+          break
+        except queue.Full:
+          if self._stop.is_set():
+            return
+
+  def queue_depth(self):
+    """
+    The number of deals waiting in the queue (computed or in progress).
+    """
+    return self._queue.qsize()
+
+  def get(self):
+    """
+    Returns: (np.ndarray) the evs of the next deal, like PrecomputedEv.to_array. Time spent waiting
+             for them is added to stall_time.
+    """
+    t0 = time.time()
+    evs = self._queue.get().result()
+    self.stall_time += time.time() - t0
+    return evs
+
+  def _drain(self):
+    while True:
+      try:
+        self._queue.get_nowait().cancel()
+      except queue.Empty:
+        return
+
+  def close(self):
+    """
+    Stops the feeder thread, drops the queued deals, and shuts down the threads. Safe to call at any
+    point, i.e when a traversal raised before every deal was used.
+    """
+    self._stop.set()
+    self._drain()
+    self._feeder.join()
+    self._drain()
+    self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+class WorkerDeals(object):
+  def __init__(self, opt, worker_id, t, traverse_player_idx, num_deals, first_sb_player=0, betting_tree=None,
+               use_corpus=True, seed_extra=()):
+    """
+    The rounds a traverse worker plays in one (t, traverse_player_idx) pass, with their equities. They
+    come from the corpus when there is one (--DEAL_CORPUS_PATH), and otherwise are dealt here (seeded
+    with --DEAL_SEED) and have their equities computed by a DealProducer (--EV_PRODUCER_THREADS) or by
+    the traversal itself. Use it with a with statement, so that the producer's threads are stopped even
+    if a traversal raises.
+
+    first_sb_player (int) : The SB player of the first round. It alternates after that.
+    use_corpus (bool) : False to deal new rounds even if there is a corpus (i.e for evaluation).
+    seed_extra (tuple) : Appended to the --DEAL_SEED seed, to tell apart passes with the same t.
+    """
+    self.opt = opt
+    self.num_deals = num_deals
+    self.first_sb_player = first_sb_player
+    self.betting_tree = betting_tree
+
+    # Each pass reads its own corpus rows, like the seeded deals below.
+    self.corpus_rows = None
+    if use_corpus and opt.DEAL_CORPUS_PATH is not None:
+      self.corpus_rows = DealCorpus(opt.DEAL_CORPUS_PATH).read(worker_id, opt.NUM_TRAVERSE_WORKERS,
+                                                               (2 * t + traverse_player_idx) * num_deals, num_deals)
+
+    # Deal all of the rounds up front when seeded, so that runs are reproducible.
+    self.deals = None
+    if opt.DEAL_SEED is not None:
+      self.deals = create_deals(num_deals, [opt.DEAL_SEED, t, traverse_player_idx, worker_id] + list(seed_extra))
+
+    # Compute the equities of upcoming deals in the background while the worker traverses.
+    self.producer = None
+    if self.corpus_rows is None and opt.EV_PRODUCER_THREADS > 0:
+      if self.deals is None:
+        self.deals = create_deals(num_deals, None)
+      self.producer = DealProducer(self.deals, opt.EV_PRODUCER_THREADS, opt.EV_QUEUE_SIZE)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+    return False
+
+  def close(self):
+    if self.producer is not None:
+      self.producer.close()
+
+  def queue_depth(self):
+    return self.producer.queue_depth() if self.producer is not None else 0
+
+  def stall_time(self):
+    return self.producer.stall_time if self.producer is not None else 0
+
+  def __iter__(self):
+    """
+    Yields (sb_player_idx, round_state, precomputed_ev) for each round.
+    """
+    state_type = self.opt.ROUND_STATE_TYPE
+    for k in range(self.num_deals):
+      sb_player_idx = (self.first_sb_player + k) % 2
+      if self.corpus_rows is not None:
+        round_state = round_state_from_deal(self.corpus_rows["deal"][k], sb_player_idx, state_type=state_type,
+                                            betting_tree=self.betting_tree)
+        precomputed_ev = PrecomputedEv.from_array(round_state, self.corpus_rows["ev"][k])
+      else:
+        if self.deals is not None:
+          round_state = round_state_from_deal(self.deals[k], sb_player_idx, state_type=state_type,
+                                              betting_tree=self.betting_tree)
+        else:
+          round_state = create_new_round(sb_player_idx, state_type=state_type, betting_tree=self.betting_tree)
+        if self.producer is not None:
+          precomputed_ev = PrecomputedEv.from_array(round_state, self.producer.get())
+        else:
+          precomputed_ev = make_precomputed_ev(round_state)
+      yield sb_player_idx, round_state, precomputed_ev
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Precomputes deals and their equities for traverse workers "
+                                               "(use with --DEAL_CORPUS_PATH).")
+  parser.add_argument("filename", type=str, help="Where to write the corpus (.npy)")
+  parser.add_argument("--num_deals", type=int, default=1000000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--num_procs", type=int, default=None, help="Defaults to every core")
+  parser.add_argument("--chunk_size", type=int, default=10000)
+  parser.add_argument("--equity_cache_path", type=str, default=None)
+  args = parser.parse_args()
+
+  build_deal_corpus(args.filename, args.num_deals, seed=args.seed, num_procs=args.num_procs,
+                    chunk_size=args.chunk_size, equity_cache_path=args.equity_cache_path)
@@ -31,21 +31,34 @@ PVALUE = lambda name, value: ', {} ({})'.format(name, value)
 STATUS = lambda players: ''.join([PVALUE(p.name, p.bankroll) for p in players])
 
 
-class RoundState(namedtuple('_RoundState', ['button', 'street', 'pips', 'stacks', 'hands', 'deck', 'previous_state', 'bet_history', 'sb_player'])):
+def get_showdown_winner(hands, board):
+    '''
+    Returns 1 if player 0 has the better hand on this board, -1 if player 1 does, and 0 for a split.
+    '''
+    # score0 = eval7.evaluate(list(map(PERM.get, board + hands[0])))
+    # score1 = eval7.evaluate(list(map(PERM.get, board + hands[1])))
+    score0 = eval7.evaluate(board + hands[0])
+    score1 = eval7.evaluate(board + hands[1])
+    return (score0 > score1) - (score0 < score1)
+
+
+class RoundState(namedtuple('_RoundState', ['button', 'street', 'pips', 'stacks', 'hands', 'deck', 'previous_state', 'bet_history', 'sb_player', 'showdown_winner'], defaults=[None])):
     '''
     Encodes the game tree for one round of poker.
+
+    showdown_winner is the result of get_showdown_winner() for this deal. It can be filled in when
+    the deal is created so that showdown() never has to evaluate the hands.
     '''
     def showdown(self):
         '''
         Compares the players' hands and computes payoffs.
         '''
-        # score0 = eval7.evaluate(list(map(PERM.get, self.deck.peek(5) + self.hands[0])))
-        # score1 = eval7.evaluate(list(map(PERM.get, self.deck.peek(5) + self.hands[1])))
-        score0 = eval7.evaluate(self.deck.peek(5) + self.hands[0])
-        score1 = eval7.evaluate(self.deck.peek(5) + self.hands[1])
-        if score0 > score1:
+        winner = self.showdown_winner
+        if winner is None:
+            winner = get_showdown_winner(self.hands, self.deck.peek(5))
+        if winner > 0:
             delta = STARTING_STACK - self.stacks[1]
-        elif score0 < score1:
+        elif winner < 0:
             delta = self.stacks[0] - STARTING_STACK
         else:  # split the pot
             delta = (self.stacks[0] - self.stacks[1]) // 2
@@ -89,7 +102,7 @@ class RoundState(namedtuple('_RoundState', ['button', 'street', 'pips', 'stacks'
         new_street = 3 if self.street == 0 else self.street + 1
 
         # NOTE: The MIT engine starts all new streets with button = 1 (2nd player always).
-        return RoundState(1 - self.sb_player, new_street, [0, 0], self.stacks, self.hands, self.deck, self, self.bet_history, self.sb_player)
+        return RoundState(1 - self.sb_player, new_street, [0, 0], self.stacks, self.hands, self.deck, self, self.bet_history, self.sb_player, self.showdown_winner)
 
     def proceed(self, action):
         '''
@@ -104,14 +117,14 @@ class RoundState(namedtuple('_RoundState', ['button', 'street', 'pips', 'stacks'
         if isinstance(action, CallAction):
             if (self.button == self.sb_player) and self.street == 0:
                 self.bet_history[-1].append(1)
-                return RoundState(self.button + 1, 0, [BIG_BLIND] * 2, [STARTING_STACK - BIG_BLIND] * 2, self.hands, self.deck, self, self.bet_history, self.sb_player)
+                return RoundState(self.button + 1, 0, [BIG_BLIND] * 2, [STARTING_STACK - BIG_BLIND] * 2, self.hands, self.deck, self, self.bet_history, self.sb_player, self.showdown_winner)
             # both players acted
             new_pips = list(self.pips)
             new_stacks = list(self.stacks)
             contribution = new_pips[1-active] - new_pips[active]
             new_stacks[active] -= contribution
             new_pips[active] += contribution
-            state = RoundState(self.button + 1, self.street, new_pips, new_stacks, self.hands, self.deck, self, self.bet_history, self.sb_player)
+            state = RoundState(self.button + 1, self.street, new_pips, new_stacks, self.hands, self.deck, self, self.bet_history, self.sb_player, self.showdown_winner)
 
             # Update the betting history.
             self.bet_history[-1].append(contribution)
@@ -125,7 +138,7 @@ class RoundState(namedtuple('_RoundState', ['button', 'street', 'pips', 'stacks'
         
             # let opponent act
             self.bet_history[-1].append(0)
-            return RoundState(self.button + 1, self.street, self.pips, self.stacks, self.hands, self.deck, self, self.bet_history, self.sb_player)
+            return RoundState(self.button + 1, self.street, self.pips, self.stacks, self.hands, self.deck, self, self.bet_history, self.sb_player, self.showdown_winner)
         # isinstance(action, RaiseAction)
         new_pips = list(self.pips)
         new_stacks = list(self.stacks)
@@ -136,8 +149,341 @@ class RoundState(namedtuple('_RoundState', ['button', 'street', 'pips', 'stacks'
 
         new_stacks[active] -= contribution
         new_pips[active] += contribution
-        return RoundState(self.button + 1, self.street, new_pips, new_stacks, self.hands, self.deck, self, self.bet_history, self.sb_player)
+        return RoundState(self.button + 1, self.street, new_pips, new_stacks, self.hands, self.deck, self, self.bet_history, self.sb_player, self.showdown_winner)
 
     def copy(self):
         return RoundState(self.button, self.street, deepcopy(self.pips), deepcopy(self.stacks),
-                          self.hands, self.deck, self.previous_state, deepcopy(self.bet_history), self.sb_player)
+                          self.hands, self.deck, self.previous_state, deepcopy(self.bet_history), self.sb_player,
+                          self.showdown_winner)
+
+    def apply(self, action):
+        '''
+        Returns the next state without modifying this one. Mirrors MutableRoundState.apply() so that
+        traversals can use either type of state.
+        '''
+        return self.copy().proceed(action)
+
+    def undo(self):
+        '''
+        Nothing to roll back, since apply() leaves this state untouched.
+        '''
+        pass
+
+
+class MutableRoundState(object):
+    '''
+    A RoundState that is advanced in place by apply() and rolled back by undo(). A depth-first
+    traversal can walk the whole game tree with one of these instead of allocating a state per node.
+
+    NOTE: The TerminalState returned by apply() points back at this object, so its previous_state
+    is only valid until the next undo().
+    '''
+    def __init__(self, button, street, pips, stacks, hands, deck, bet_history, sb_player, showdown_winner=None):
+        self.button = button
+        self.street = street
+        self.pips = list(pips)
+        self.stacks = list(stacks)
+        self.hands = hands
+        self.deck = deck
+        self.previous_state = None
+        self.bet_history = [list(actions) for actions in bet_history]
+        self.sb_player = sb_player
+        self.showdown_winner = showdown_winner
+        self._undo_stack = []
+
+    @staticmethod
+    def from_round_state(round_state):
+        '''
+        Makes a mutable state from a RoundState. The bet history is copied, so the original is safe.
+        '''
+        return MutableRoundState(round_state.button, round_state.street, round_state.pips, round_state.stacks,
+                                 round_state.hands, round_state.deck, round_state.bet_history, round_state.sb_player,
+                                 round_state.showdown_winner)
+
+    def to_round_state(self):
+        '''
+        Returns an immutable RoundState snapshot of the current state.
+        '''
+        return RoundState(self.button, self.street, list(self.pips), list(self.stacks), self.hands,
+                          self.deck, None, deepcopy(self.bet_history), self.sb_player, self.showdown_winner)
+
+    showdown = RoundState.showdown
+    legal_actions = RoundState.legal_actions
+    raise_bounds = RoundState.raise_bounds
+
+    def proceed_street(self):
+        '''
+        Resets the players' pips and advances to the next round of betting in place.
+        '''
+        if self.street == 5:
+            return self.showdown()
+        self.bet_history.append([])
+        self.street = 3 if self.street == 0 else self.street + 1
+        self.button = 1 - self.sb_player
+        self.pips[0] = 0
+        self.pips[1] = 0
+        return self
+
+    def apply(self, action):
+        '''
+        Advances this state in place by one action performed by the active player. Returns a
+        TerminalState if the action ends the round, and this state otherwise. Every call must be
+        matched by a call to undo() once the caller is done with the child.
+        '''
+        self._undo_stack.append((self.button, self.street, self.pips[0], self.pips[1], self.stacks[0],
+                                 self.stacks[1], len(self.bet_history), len(self.bet_history[-1])))
+        active = self.button % 2
+        if isinstance(action, FoldAction):
+            delta = self.stacks[0] - STARTING_STACK if active == 0 else STARTING_STACK - self.stacks[1]
+            return TerminalState([delta, -delta], self)
+
+        if isinstance(action, CallAction):
+            if (self.button == self.sb_player) and self.street == 0:
+                self.bet_history[-1].append(1)
+                self.button += 1
+                self.pips[0] = self.pips[1] = BIG_BLIND
+                self.stacks[0] = self.stacks[1] = STARTING_STACK - BIG_BLIND
+                return self
+            # both players acted
+            contribution = self.pips[1-active] - self.pips[active]
+            self.stacks[active] -= contribution
+            self.pips[active] += contribution
+            self.bet_history[-1].append(contribution)
+            return self.proceed_street()
+
+        if isinstance(action, CheckAction):
+            self.bet_history[-1].append(0)
+            if (self.street == 0 and self.button > 0) or self.button > 1:  # both players acted
+                return self.proceed_street()
+            # let opponent act
+            self.button += 1
+            return self
+
+        # isinstance(action, RaiseAction)
+        contribution = action.amount - self.pips[active]
+        self.bet_history[-1].append(contribution)
+        self.stacks[active] -= contribution
+        self.pips[active] += contribution
+        self.button += 1
+        return self
+
+    def undo(self):
+        '''
+        Rolls back the most recent apply().
+        '''
+        (self.button, self.street, self.pips[0], self.pips[1], self.stacks[0], self.stacks[1],
+         num_streets, num_actions) = self._undo_stack.pop()
+        del self.bet_history[num_streets:]
+        del self.bet_history[-1][num_actions:]
+
+
+class CompactRoundState(object):
+    '''
+    A small immutable RoundState for training. Pips and stacks are tuples and the bet history is a
+    tuple of per-street tuples, so a child shares everything it does not change and copy() is free.
+    The previous_state back-pointer is only kept when keep_previous is set.
+
+    Hashing and equality only look at the public betting state (not the cards). Since
+    showdown_winner comes from the cards, two states with the same betting but different deals
+    (and so possibly different showdown winners) are equal, i.e they're the same node of the
+    betting tree. Compare hands and deck as well to tell deals apart.
+    '''
+    __slots__ = ('button', 'street', 'pips', 'stacks', 'hands', 'deck', 'previous_state', 'bet_history',
+                 'sb_player', 'showdown_winner', 'keep_previous')
+
+    def __init__(self, button, street, pips, stacks, hands, deck, previous_state, bet_history, sb_player,
+                 showdown_winner=None, keep_previous=False):
+        self.button = button
+        self.street = street
+        self.pips = tuple(pips)
+        self.stacks = tuple(stacks)
+        self.hands = hands
+        self.deck = deck
+        self.previous_state = previous_state if keep_previous else None
+        self.bet_history = tuple(tuple(actions) for actions in bet_history)
+        self.sb_player = sb_player
+        self.showdown_winner = showdown_winner
+        self.keep_previous = keep_previous
+
+    @staticmethod
+    def from_round_state(round_state, keep_previous=False):
+        '''
+        Makes a compact state from a RoundState (or any state with the same fields).
+        '''
+        return CompactRoundState(round_state.button, round_state.street, round_state.pips, round_state.stacks,
+                                 round_state.hands, round_state.deck, None, round_state.bet_history,
+                                 round_state.sb_player, round_state.showdown_winner, keep_previous=keep_previous)
+
+    def to_round_state(self):
+        '''
+        Returns an equivalent RoundState (without its previous_state chain).
+        '''
+        return RoundState(self.button, self.street, list(self.pips), list(self.stacks), self.hands, self.deck,
+                          None, [list(actions) for actions in self.bet_history], self.sb_player,
+                          self.showdown_winner)
+
+    def _key(self):
+        return (self.button, self.street, self.pips, self.stacks, self.bet_history, self.sb_player)
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __eq__(self, other):
+        return isinstance(other, CompactRoundState) and self._key() == other._key()
+
+    def _child(self, button, street, pips, stacks, bet_history):
+        # Skip __init__, since everything passed in here is already a tuple.
+        child = CompactRoundState.__new__(CompactRoundState)
+        child.button = button
+        child.street = street
+        child.pips = pips
+        child.stacks = stacks
+        child.hands = self.hands
+        child.deck = self.deck
+        child.previous_state = self if self.keep_previous else None
+        child.bet_history = bet_history
+        child.sb_player = self.sb_player
+        child.showdown_winner = self.showdown_winner
+        child.keep_previous = self.keep_previous
+        return child
+
+    def _add_bet(self, amount):
+        return self.bet_history[:-1] + (self.bet_history[-1] + (amount,),)
+
+    showdown = RoundState.showdown
+    legal_actions = RoundState.legal_actions
+    raise_bounds = RoundState.raise_bounds
+
+    def proceed_street(self):
+        '''
+        Resets the players' pips and advances the game tree to the next round of betting.
+        '''
+        if self.street == 5:
+            return self.showdown()
+        new_street = 3 if self.street == 0 else self.street + 1
+        return self._child(1 - self.sb_player, new_street, (0, 0), self.stacks, self.bet_history + ((),))
+
+    def proceed(self, action):
+        '''
+        Advances the game tree by one action performed by the active player.
+        '''
+        active = self.button % 2
+        if isinstance(action, FoldAction):
+            delta = self.stacks[0] - STARTING_STACK if active == 0 else STARTING_STACK - self.stacks[1]
+            return TerminalState([delta, -delta], self)
+
+        if isinstance(action, CallAction):
+            if (self.button == self.sb_player) and self.street == 0:
+                return self._child(self.button + 1, 0, (BIG_BLIND, BIG_BLIND),
+                                   (STARTING_STACK - BIG_BLIND, STARTING_STACK - BIG_BLIND), self._add_bet(1))
+            # both players acted
+            contribution = self.pips[1-active] - self.pips[active]
+            new_pips = list(self.pips)
+            new_stacks = list(self.stacks)
+            new_stacks[active] -= contribution
+            new_pips[active] += contribution
+            state = self._child(self.button + 1, self.street, tuple(new_pips), tuple(new_stacks),
+                                self._add_bet(contribution))
+            return state.proceed_street()
+
+        if isinstance(action, CheckAction):
+            state = self._child(self.button + 1, self.street, self.pips, self.stacks, self._add_bet(0))
+            if (self.street == 0 and self.button > 0) or self.button > 1:  # both players acted
+                return state.proceed_street()
+            # let opponent act
+            return state
+
+        # isinstance(action, RaiseAction)
+        contribution = action.amount - self.pips[active]
+        new_pips = list(self.pips)
+        new_stacks = list(self.stacks)
+        new_stacks[active] -= contribution
+        new_pips[active] += contribution
+        return self._child(self.button + 1, self.street, tuple(new_pips), tuple(new_stacks),
+                           self._add_bet(contribution))
+
+    def copy(self):
+        return self
+
+    def apply(self, action):
+        '''
+        Same as proceed(), since this state is never modified. Mirrors MutableRoundState.apply().
+        '''
+        return self.proceed(action)
+
+    def undo(self):
+        pass
+
+
+class TreeRoundState(object):
+    '''
+    A node of a precompiled BettingTree (see betting_tree.py) together with the cards for one deal.
+    Moving to a child is an array lookup, so traversals never re-run legal_actions() or
+    raise_bounds().
+    '''
+    __slots__ = ('tree', 'node', 'hands', 'deck', 'sb_player', 'showdown_winner', 'previous_state')
+
+    def __init__(self, tree, node, hands, deck, sb_player, showdown_winner=None):
+        self.tree = tree
+        self.node = node
+        self.hands = hands
+        self.deck = deck
+        self.sb_player = sb_player
+        self.showdown_winner = showdown_winner
+        self.previous_state = None
+
+    @property
+    def button(self):
+        return int(self.tree.button[self.node])
+
+    @property
+    def street(self):
+        return int(self.tree.street[self.node])
+
+    @property
+    def pips(self):
+        return self.tree.pips[self.node].tolist()
+
+    @property
+    def stacks(self):
+        return self.tree.stacks[self.node].tolist()
+
+    def _child(self, node):
+        terminal = self.tree.terminal[node]
+        if terminal == 0:
+            return TreeRoundState(self.tree, node, self.hands, self.deck, self.sb_player, self.showdown_winner)
+
+        if terminal == 1:  # fold
+            delta = float(self.tree.fold_delta[node])
+            return TerminalState([delta, -delta], self)
+
+        # showdown
+        winner = self.showdown_winner
+        if winner is None:
+            winner = get_showdown_winner(self.hands, self.deck.peek(5))
+        stacks = self.tree.stacks[node].tolist()
+        if winner > 0:
+            delta = STARTING_STACK - stacks[1]
+        elif winner < 0:
+            delta = stacks[0] - STARTING_STACK
+        else:  # split the pot
+            delta = (stacks[0] - stacks[1]) // 2
+        return TerminalState([delta, -delta], self)
+
+    def proceed(self, action):
+        '''
+        Advances the game tree by one action performed by the active player.
+        '''
+        return self._child(int(self.tree.children[self.node, self.tree.action_index(self.node, action)]))
+
+    def copy(self):
+        return self
+
+    def apply(self, action):
+        '''
+        Same as proceed(), since this state is never modified. Mirrors MutableRoundState.apply().
+        '''
+        return self.proceed(action)
+
+    def undo(self):
+        pass
@@ -1,4 +1,7 @@
+import functools
+
 import torch
+import numpy as np
 
 from constants import Constants
 
@@ -23,6 +26,7 @@ class EvInfoSet(object):
     self.bet_history_vec = bet_history_vec
     self.player_position = player_position
     self.street = street
+    self.bucket_key = None # Memoized by bucket_small_key.
   
   def get_ev_input_tensors(self):
     """
@@ -42,12 +46,13 @@ class EvInfoSet(object):
   
   def pack(self):
     """
-    Packs the infoset into a compact torch.Tensor of size:
-      (1 player position, 1 ev, BET_HISTORY_SIZE)
+    Packs the infoset into a compact torch.Tensor of size INFO_SET_SIZE:
+      (1 player position, 1 ev, 1 street, 2 + BET_HISTORY_SIZE)
     """
     return torch.cat([
       torch.Tensor([self.player_position]),
       torch.Tensor([self.ev]),
+      torch.Tensor([self.street]),
       self.bet_history_vec])
 
 
@@ -55,14 +60,103 @@ def unpack_ev_infoset(tensor):
   """
   Unpack a compactified infoset tensor into an Infoset object.
   """
-  player_position = tensor[0]
-  player_ev = tensor[1]
-  bet_history_vec = tensor[2:]
+  if len(tensor) != Constants.INFO_SET_SIZE:
+    raise IncompatibleInfosetException()
+
+  player_position = int(tensor[0])
+  player_ev = float(tensor[1])
+  street = int(tensor[2])
+  bet_history_vec = tensor[3:]
+
+  return EvInfoSet(player_ev, bet_history_vec, player_position, street)
+
+
+class EvInfoSetBatch(object):
+  def __init__(self, ev, bet_history_vec, player_position, street):
+    """
+    A batch of EvInfoSets stored as contiguous columns instead of one object per infoset.
+
+    ev (torch.Tensor) : Shape (N,), EV of each hand and board.
+    bet_history_vec (torch.Tensor) : Shape (N, 2 + BET_HISTORY_SIZE).
+    player_position (torch.Tensor) : Shape (N,), 0 if the acting player is the SB and 1 if they are BB.
+    street (torch.Tensor) : Shape (N,), 0, 1, 2, or 3.
+    """
+    self.ev = ev
+    self.bet_history_vec = bet_history_vec
+    self.player_position = player_position
+    self.street = street
+
+  def __len__(self):
+    return self.ev.shape[0]
+
+  def __getitem__(self, idx):
+    """
+    Selects rows with an int, slice, or index tensor, returning another EvInfoSetBatch.
+    """
+    if isinstance(idx, int):
+      idx = slice(idx, idx + 1)
+    return EvInfoSetBatch(self.ev[idx], self.bet_history_vec[idx], self.player_position[idx], self.street[idx])
+
+  @staticmethod
+  def from_infosets(infosets):
+    """
+    Stacks a list of EvInfoSets into a batch.
+    """
+    return EvInfoSetBatch(
+      torch.Tensor([float(infoset.ev) for infoset in infosets]),
+      torch.stack([infoset.bet_history_vec for infoset in infosets]),
+      torch.Tensor([int(infoset.player_position) for infoset in infosets]),
+      torch.Tensor([int(infoset.street) for infoset in infosets]))
+
+  def get_ev_input_tensors(self):
+    """
+    Returns: (torch.Tensor) with shape (N x 1).
+    """
+    return self.ev.unsqueeze(1)
+
+  def get_bet_input_tensors(self):
+    """
+    Returns: (torch.Tensor) bets and (torch.Tensor) position mask, both with shape
+             (N x 2 + BET_HISTORY_SIZE). The mask is 1 for our bets and -1 for the opponent's.
+    """
+    nbets = self.bet_history_vec.shape[1]
+    ours = (torch.arange(nbets) % 2).unsqueeze(0) == self.player_position.long().unsqueeze(1)
+    position_mask = ours.float() * 2 - 1
+    return self.bet_history_vec, position_mask
+
+  def get_normalized_bet_input_tensors(self):
+    """
+    The bets input to the network: our bets positive and the opponent's negative, each divided by
+    the pot size at the time of the bet.
+
+    Returns: (torch.Tensor) with shape (N x 2 + BET_HISTORY_SIZE).
+    """
+    bets_input, position_mask = self.get_bet_input_tensors()
+    cumul_pot = torch.cumsum(bets_input, dim=1)
+    cumul_pot[cumul_pot == 0] = 1
+    return bets_input * position_mask / cumul_pot
+
+  def pack(self):
+    """
+    Packs the batch into a torch.Tensor of shape (N x INFO_SET_SIZE), the same row format as
+    EvInfoSet.pack().
+    """
+    return torch.cat([
+      self.player_position.unsqueeze(1),
+      self.ev.unsqueeze(1),
+      self.street.unsqueeze(1),
+      self.bet_history_vec], dim=1)
+
 
-  if len(bet_history_vec) != Constants.BET_HISTORY_SIZE:
+def unpack_ev_infoset_batch(tensor):
+  """
+  Unpack a (N x INFO_SET_SIZE) tensor of packed infosets into an EvInfoSetBatch. The columns are
+  views into tensor, so no copies are made.
+  """
+  if tensor.ndim != 2 or tensor.shape[1] != Constants.INFO_SET_SIZE:
     raise IncompatibleInfosetException()
 
-  return EvInfoSet(player_ev, bet_history_vec, player_position)
+  return EvInfoSetBatch(tensor[:,1], tensor[:,3:], tensor[:,0], tensor[:,2])
 
 
 def bucket_small(infoset):
@@ -89,14 +183,7 @@ def bucket_small(infoset):
   h[0] = 'SB' if infoset.player_position == 0 else 'BB'
   h[1] = {0: 'P', 1: 'F', 2: 'T', 3: 'R'}[infoset.street]
   
-  if infoset.ev < 0.4:
-    h[2] = 'H0'
-  elif infoset.ev < 0.6:
-    h[2] = 'H1'
-  elif infoset.ev < 0.8:
-    h[2] = 'H2'
-  else:
-    h[2] = 'H3'
+  h[2] = 'H{}'.format(bucket_small_hs(infoset.ev))
 
   # NOTE: 2 extra actions at the start of preflop (adding blinds).
   assert(len(infoset.bet_history_vec) == (2 + Constants.BET_HISTORY_SIZE))
@@ -171,3 +258,174 @@ def bucket_small(infoset):
 
 def bucket_small_join(b):
   return '.'.join(b[:3]) + '|' + '.'.join(b[3:7]) + '|' + '.'.join(b[7:11]) + '|' + '.'.join(b[11:])
+
+
+def bucket_small_split(bstring):
+  """
+  Inverse of bucket_small_join.
+  """
+  return [v for group in bstring.split('|') for v in group.split('.')]
+
+
+# The values that each field of bucket_small can take, in the order they are packed into an int.
+BUCKET_SMALL_FIELDS = [('SB', 'BB'), ('P', 'F', 'T', 'R'), ('H0', 'H1', 'H2', 'H3')] + \
+                      [('x', 'R')] * 8 + \
+                      [('x', 'CK', 'CL', '?P', 'HP', '1P', '2P')] * 4
+BUCKET_SMALL_BITS = [(len(values) - 1).bit_length() for values in BUCKET_SMALL_FIELDS]
+_BUCKET_SMALL_CODES = [{v: i for i, v in enumerate(values)} for values in BUCKET_SMALL_FIELDS]
+
+# Bit offset of each bucket_small field within a packed key.
+_BUCKET_SMALL_SHIFTS = [sum(BUCKET_SMALL_BITS[i+1:]) for i in range(len(BUCKET_SMALL_BITS))]
+
+# Max number of betting histories to remember in bucket_small_key.
+BUCKET_SMALL_CACHE_SIZE = 2**18
+
+
+def bucket_small_pack(b):
+  """
+  Packs the output of bucket_small into a single int (25 bits), which is much cheaper to hash and
+  store than the string from bucket_small_join. The first field ends up in the highest bits.
+  """
+  key = 0
+  for i, v in enumerate(b):
+    key = (key << BUCKET_SMALL_BITS[i]) | _BUCKET_SMALL_CODES[i][v]
+  return key
+
+
+def bucket_small_unpack(key):
+  """
+  Inverse of bucket_small_pack. Use bucket_small_join(bucket_small_unpack(key)) to get a readable key.
+  """
+  b = [None for _ in BUCKET_SMALL_FIELDS]
+  for i in reversed(range(len(BUCKET_SMALL_FIELDS))):
+    b[i] = BUCKET_SMALL_FIELDS[i][key & ((1 << BUCKET_SMALL_BITS[i]) - 1)]
+    key >>= BUCKET_SMALL_BITS[i]
+  return b
+
+
+# The evs where bucket_small moves to the next hand strength field.
+BUCKET_SMALL_HS_THRESHOLDS = (0.4, 0.6, 0.8)
+
+
+def bucket_small_hs(ev):
+  """
+  The hand strength field of bucket_small, as an index into ('H0', 'H1', 'H2', 'H3').
+  """
+  if ev < BUCKET_SMALL_HS_THRESHOLDS[0]:
+    return 0
+  elif ev < BUCKET_SMALL_HS_THRESHOLDS[1]:
+    return 1
+  elif ev < BUCKET_SMALL_HS_THRESHOLDS[2]:
+    return 2
+  else:
+    return 3
+
+
+@functools.lru_cache(maxsize=BUCKET_SMALL_CACHE_SIZE)
+def _bucket_small_key_no_hs(player_position, street, bet_history_bytes):
+  bet_history_vec = torch.from_numpy(np.frombuffer(bet_history_bytes, dtype=np.float32).copy())
+  return bucket_small_pack(bucket_small(EvInfoSet(0, bet_history_vec, player_position, street)))
+
+
+def bucket_small_key(infoset):
+  """
+  The integer key that RegretMatchedStrategy stores regrets under.
+
+  The same betting histories come up over and over during training, so the bucket for each
+  (player position, street, betting history) is memoized in an LRU cache. The EV only changes the
+  hand strength field, so it is filled in afterwards and doesn't need to be part of the cache key.
+  The key is also saved on the infoset, since each node looks it up for both regrets and strategies.
+  """
+  if infoset.bucket_key is None:
+    bet_history_bytes = np.asarray(infoset.bet_history_vec, dtype=np.float32).tobytes()
+    key = _bucket_small_key_no_hs(int(infoset.player_position), int(infoset.street), bet_history_bytes)
+    infoset.bucket_key = key | (bucket_small_hs(infoset.ev) << _BUCKET_SMALL_SHIFTS[2])
+  return infoset.bucket_key
+
+
+def bucket_small_cache_info():
+  """
+  Returns: (functools._CacheInfo) with the hits, misses, maxsize, and currsize of the cache in
+           bucket_small_key. Each process has its own cache.
+  """
+  return _bucket_small_key_no_hs.cache_info()
+
+
+
+def bucket_small_batch(packed):
+  """
+  Vectorized version of bucket_small_key for many infosets at once. Each column of the bet history
+  is handled for all rows together, following the same steps as bucket_small.
+
+  packed (np.ndarray or torch.Tensor) : Shape (N, INFO_SET_SIZE), with rows from EvInfoSet.pack().
+
+  Returns: (np.ndarray) of N int64 keys, the same as bucket_small_key(unpack_ev_infoset(row)).
+  """
+  packed = np.asarray(packed, dtype=np.float32)
+  assert(packed.ndim == 2 and packed.shape[1] == Constants.INFO_SET_SIZE)
+  N = packed.shape[0]
+
+  position = packed[:,0].astype(np.int64)
+  ev = packed[:,1].astype(np.float64)
+  street = packed[:,2].astype(np.int64)
+  bet_history_vec = packed[:,3:]
+  cumul = np.cumsum(bet_history_vec, axis=1, dtype=np.float32)
+  num_bets = bet_history_vec.shape[1]
+
+  # Same field order as bucket_small, storing the index into BUCKET_SMALL_FIELDS.
+  codes = np.zeros((N, len(BUCKET_SMALL_FIELDS)), dtype=np.int64)
+  codes[:,0] = position != 0
+  codes[:,1] = street
+  codes[:,2] = np.digitize(ev, BUCKET_SMALL_HS_THRESHOLDS)
+
+  plyr_raised_offset = 3
+  opp_raised_offset = 7
+  street_actions_offset = 11
+  CK, CL, WP, HP, P1, P2 = [BUCKET_SMALL_FIELDS[street_actions_offset].index(v)
+                            for v in ('CK', 'CL', '?P', 'HP', '1P', '2P')]
+
+  # Rows stop being updated where the scalar version would break out of its loop.
+  alive = np.ones(N, dtype=bool)
+  pips = np.zeros((N, 2), dtype=np.float32)
+
+  for i in range(0, Constants.BET_HISTORY_SIZE+2):
+    is_new_street = (i == 0) or ((i - 2) % Constants.BET_ACTIONS_PER_STREET) == 0 and i > 2
+    if is_new_street:
+      pips[:] = 0
+
+    s = (i-2) // Constants.BET_ACTIONS_PER_STREET if i > 2 else 0
+    alive &= (s <= street)
+
+    amt = bet_history_vec[:,i]
+    opp_pips = pips[:,1 - (i % 2)]
+    amt_after_action = pips[:,i % 2] + amt
+    alive &= ~((amt_after_action < opp_pips) & (amt == 0))
+
+    if i >= 2:
+      is_player = (position == (i % 2)) if s == 0 else (position != (i % 2))
+      action_is_raise = alive & (amt_after_action > opp_pips)
+      codes[action_is_raise & is_player, plyr_raised_offset + s] = 1
+      codes[action_is_raise & ~is_player, opp_raised_offset + s] = 1
+
+      current = alive & (street == s)
+      action_offset = (i - 2) % Constants.BET_ACTIONS_PER_STREET
+      col = codes[:,street_actions_offset + action_offset] # A view, so writes go into codes.
+
+      bet_occurs_after = (bet_history_vec[:,i+1] > 0) if i < num_bets - 1 else np.zeros(N, dtype=bool)
+      check_ok = (~is_player | bet_occurs_after) if action_offset == 0 else np.zeros(N, dtype=bool)
+      action_is_check = current & (amt_after_action == opp_pips) & (amt == 0)
+      col[action_is_check & check_ok] = CK
+      alive &= ~(action_is_check & ~check_ok)
+
+      col[current & (amt_after_action == opp_pips) & (amt > 0)] = CL
+      col[current & (amt_after_action < opp_pips) & (amt > 0)] = WP
+
+      call_amt = np.abs(pips[:,0] - pips[:,1])
+      with np.errstate(divide="ignore", invalid="ignore"):
+        raise_amt = (amt - call_amt) / (cumul[:,i-1] + call_amt)
+      is_raise = current & (amt_after_action > opp_pips)
+      col[is_raise] = np.where(raise_amt <= 0.75, HP, np.where(raise_amt <= 1.5, P1, P2))[is_raise]
+
+    pips[:,i % 2] += amt
+
+  return (codes << np.array(_BUCKET_SMALL_SHIFTS, dtype=np.int64)).sum(axis=1)
@@ -0,0 +1,150 @@
+import itertools
+from math import comb
+
+
+RANKS = "23456789TJQKA"
+SUITS = "cdhs"
+NUM_RANKS = len(RANKS)
+
+_RANK_VALUE = {r: i for i, r in enumerate(RANKS)}
+_SUIT_VALUE = {s: i for i, s in enumerate(SUITS)}
+
+
+def _colex_rank(mask):
+  """
+  Rank of a set of ranks (as a 13 bit mask) among all sets of the same size, in colex order.
+  """
+  r, k = 0, 0
+  for bit in range(NUM_RANKS):
+    if (mask >> bit) & 1:
+      k += 1
+      r += comb(bit, k)
+  return r
+
+
+_COLEX_RANK = [_colex_rank(mask) for mask in range(1 << NUM_RANKS)]
+_POPCOUNT = [bin(mask).count("1") for mask in range(1 << NUM_RANKS)]
+
+
+def _remove_bits(mask, removed):
+  """
+  Squeezes the bits of removed out of mask, i.e the ranks left over after the hole cards.
+  """
+  for bit in reversed(range(NUM_RANKS)):
+    if (removed >> bit) & 1:
+      mask = (mask & ((1 << bit) - 1)) | ((mask >> (bit + 1)) << bit)
+  return mask
+
+
+def _num_suit_states(i, j):
+  """
+  Number of ways that one suit can have i hole cards and j board cards.
+  """
+  return comb(NUM_RANKS, i) * comb(NUM_RANKS - i, j)
+
+
+def _make_configurations(board_size):
+  """
+  A configuration is how many hole and board cards each suit has, sorted so that suits can be
+  relabelled. For each one, returns its offset into the dense index and the size of each group of
+  suits with the same counts.
+  """
+  per_suit = [(i, j) for i in range(3) for j in range(board_size + 1)]
+  configs = set()
+  for combo in itertools.combinations_with_replacement(per_suit, len(SUITS)):
+    if sum(c[0] for c in combo) == 2 and sum(c[1] for c in combo) == board_size:
+      configs.add(tuple(sorted(combo, reverse=True)))
+
+  out = {}
+  offset = 0
+  for config in sorted(configs, reverse=True):
+    groups = [(ij, len(list(g))) for ij, g in itertools.groupby(config)]
+    # Suits with the same counts are interchangeable, so each group is a multiset of suit states.
+    group_sizes = [comb(_num_suit_states(*ij) + m - 1, m) for ij, m in groups]
+    size = 1
+    for n in group_sizes:
+      size *= n
+    out[config] = (offset, groups, group_sizes)
+    offset += size
+  return out, offset
+
+
+_CONFIGURATIONS = {}
+NUM_CANONICAL_CLASSES = {}
+for _street, _board_size in ((0, 0), (3, 3), (4, 4), (5, 5)):
+  _CONFIGURATIONS[_board_size], NUM_CANONICAL_CLASSES[_street] = _make_configurations(_board_size)
+
+# Offsets that make canonical_index unique across all streets (see canonical_id).
+_STREET_OFFSETS = {0: 0}
+_STREET_OFFSETS[3] = _STREET_OFFSETS[0] + NUM_CANONICAL_CLASSES[0]
+_STREET_OFFSETS[4] = _STREET_OFFSETS[3] + NUM_CANONICAL_CLASSES[3]
+_STREET_OFFSETS[5] = _STREET_OFFSETS[4] + NUM_CANONICAL_CLASSES[4]
+NUM_CANONICAL_IDS = _STREET_OFFSETS[5] + NUM_CANONICAL_CLASSES[5]
+
+
+def _suit_states(hand, board):
+  """
+  Returns a list of (num hole cards, num board cards, index) for each suit, where the index
+  identifies which ranks the suit has among all suits with the same counts.
+  """
+  hand_masks = [0, 0, 0, 0]
+  board_masks = [0, 0, 0, 0]
+  for c in hand:
+    hand_masks[_SUIT_VALUE[c[1]]] |= 1 << _RANK_VALUE[c[0]]
+  for c in board:
+    board_masks[_SUIT_VALUE[c[1]]] |= 1 << _RANK_VALUE[c[0]]
+
+  states = []
+  for h, b in zip(hand_masks, board_masks):
+    i, j = _POPCOUNT[h], _POPCOUNT[b]
+    index = _COLEX_RANK[h] * comb(NUM_RANKS - i, j) + _COLEX_RANK[_remove_bits(b, h)]
+    states.append((i, j, index))
+  return states
+
+
+def canonical_index(hand, board):
+  """
+  Maps a hand and board to a dense index in [0, NUM_CANONICAL_CLASSES[street]). Two hands and boards
+  get the same index if and only if one is a suit relabelling of the other (the order of cards
+  within the hand and within the board doesn't matter either), so they have the same equity.
+
+  hand (list of str) : The hole cards, i.e ['Kd', 'As'].
+  board (list of str) : 0, 3, 4, or 5 board cards.
+  """
+  states = sorted(_suit_states(hand, board), reverse=True)
+  config = tuple((i, j) for i, j, _ in states)
+  offset, groups, group_sizes = _CONFIGURATIONS[len(board)][config]
+
+  index = 0
+  s = 0
+  for (ij, m), group_size in zip(groups, group_sizes):
+    # Rank of the multiset of suit states in this group (combinatorial number system).
+    indices = sorted(states[k][2] for k in range(s, s + m))
+    rank = 0
+    for k, a in enumerate(indices):
+      rank += comb(a + k, k + 1)
+    index = index * group_size + rank
+    s += m
+
+  return offset + index
+
+
+def canonical_id(hand, board):
+  """
+  Same as canonical_index, but unique across streets, in [0, NUM_CANONICAL_IDS).
+  """
+  return _STREET_OFFSETS[len(board)] + canonical_index(hand, board)
+
+
+def canonicalize(hand, board):
+  """
+  Relabels suits so that every suit-isomorphic hand and board comes out the same.
+
+  Returns: (list of str, list of str) the canonical hand and board, each in sorted order.
+  """
+  states = _suit_states(hand, board)
+  order = sorted(range(len(SUITS)), key=lambda s: states[s], reverse=True)
+  relabel = {SUITS[s]: SUITS[k] for k, s in enumerate(order)}
+  key = lambda c: (_RANK_VALUE[c[0]], _SUIT_VALUE[c[1]])
+  return sorted([c[0] + relabel[c[1]] for c in hand], key=key), \
+         sorted([c[0] + relabel[c[1]] for c in board], key=key)
@@ -0,0 +1,20 @@
+import pickle, argparse
+
+import numpy as np
+
+from pbots_calc import make_preflop_table, DEFAULT_PREFLOP_TABLE_PATH
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Converts a preflop_odds.pkl dict into the dense .npy "
+                                               "table that CalcWithLookup loads.")
+  parser.add_argument("--odds", type=str, default="preflop_odds.pkl", help="Pickle of preflop odds")
+  parser.add_argument("--out", type=str, default=DEFAULT_PREFLOP_TABLE_PATH, help="Where to write the table")
+  args = parser.parse_args()
+
+  with open(args.odds, "rb") as f:
+    preflop_odds = pickle.load(f)
+
+  table = make_preflop_table(preflop_odds)
+  np.save(args.out, table)
+  print("Wrote {} hand classes from {} hands to {}".format(len(table), len(preflop_odds), args.out))
@@ -6,7 +6,7 @@ import pandas as pd
 
 from constants import Constants
 # from infoset import InfoSet
-from infoset import EvInfoSet
+from infoset import EvInfoSet, unpack_ev_infoset_batch
 
 
 def get_buffer_manifest_path(folder, buffer_name):
@@ -82,6 +82,35 @@ class MemoryBuffer(object):
     self._weights[self._next_index] = weight
     self._next_index += 1
 
+  def add_batch(self, infosets, items, weights):
+    """
+    Add a whole EvInfoSetBatch and the corresponding items (N x item_size) and weights (N) at once.
+    Follows the same rules as add() when the buffer fills up partway through the batch.
+    """
+    packed = infosets.pack()
+    start = 0
+    while start < len(packed):
+      if self.full():
+        if self._autosave_params is not None:
+          self.save(self._autosave_params[0], self._autosave_params[1])
+          self.clear()
+        else:
+          return
+      n = min(len(packed) - start, self._infosets.shape[0] - self._next_index)
+      self._infosets[self._next_index:self._next_index+n] = packed[start:start+n]
+      self._items[self._next_index:self._next_index+n] = items[start:start+n]
+      self._weights[self._next_index:self._next_index+n] = weights[start:start+n]
+      self._next_index += n
+      start += n
+
+  def get_batch(self):
+    """
+    Returns: (EvInfoSetBatch, torch.Tensor, torch.Tensor) of the infosets, items, and weights that
+             have been added so far. These are views into the buffer, not copies.
+    """
+    n = self._next_index
+    return unpack_ev_infoset_batch(self._infosets[:n]), self._items[:n], self._weights[:n]
+
   def size(self):
     return self._next_index
 
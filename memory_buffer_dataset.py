@@ -2,7 +2,7 @@ import torch
 from torch.utils.data import Dataset
 
 from memory_buffer import *
-from infoset import unpack_ev_infoset
+from infoset import unpack_ev_infoset_batch
 
 
 class MemoryBufferDataset(Dataset):
@@ -26,6 +26,8 @@ class MemoryBufferDataset(Dataset):
     self._infosets = None
     self._weights = None
     self._items = None
+    self._ev_input = None
+    self._bets_input = None
     print(">> MemoryBufferDataset | folder={} | name={} | size(n)={} | total(N)={}".format(
       self._folder, self._buffer_name, self._n, self._N))
 
@@ -36,6 +38,8 @@ class MemoryBufferDataset(Dataset):
     self._infosets = None
     self._weights = None
     self._items = None
+    self._ev_input = None
+    self._bets_input = None
 
     # Sample indices between 0 and N, then total number of items in the dataset.
     idx = torch.randint(0, self._N, (self._n,)).long()
@@ -58,6 +62,11 @@ class MemoryBufferDataset(Dataset):
         self._items = torch.cat([self._items, d["items"][idx_this_file]], axis=0)
       cumul_idx += num_entries
 
+    # Make the network inputs for every sampled infoset at once, rather than one at a time.
+    infosets = unpack_ev_infoset_batch(self._infosets)
+    self._ev_input = infosets.get_ev_input_tensors()
+    self._bets_input = infosets.get_normalized_bet_input_tensors()
+
   def __len__(self):
     """
     # This dataset will hold at most "n" things, but maybe have fewer than that if the number of items
@@ -68,21 +77,20 @@ class MemoryBufferDataset(Dataset):
 
   def __getitem__(self, idx):
     # print("__getitem__:", idx)
-    infoset = unpack_ev_infoset(self._infosets[idx])
-    ev_input = infoset.get_ev_input_tensors()
-
-    # NOTE(milo): This function unsqueezes the first dim for traversal, but the DataLoader will
-    # add another batch dimension anyways.
-    bets_input, position_mask = infoset.get_bet_input_tensors()
-
-    # Normalize bets_input by the pot size.
-    cumul_pot = torch.cumsum(bets_input, dim=1)
-    cumul_pot[cumul_pot == 0] = 1
-    bets_input = bets_input * position_mask / cumul_pot
-
     return {
-      "ev_input": ev_input.squeeze(0),
-      "bets_input": bets_input.squeeze(0),
+      "ev_input": self._ev_input[idx],
+      "bets_input": self._bets_input[idx],
       "weights": self._weights[idx].unsqueeze(0),
       "target": self._items[idx]
     }
+
+  def get_batch(self, idx):
+    """
+    Same as __getitem__, but for a whole (long) tensor of indices at once.
+    """
+    return {
+      "ev_input": self._ev_input[idx],
+      "bets_input": self._bets_input[idx],
+      "weights": self._weights[idx].unsqueeze(1),
+      "target": self._items[idx]
+    }
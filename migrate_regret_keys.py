@@ -0,0 +1,25 @@
+import pickle, argparse
+
+from cfr import convert_bucket_keys
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Converts total_regrets_*.pkl and avg_strategy_*.pkl files "
+                                               "from string bucket keys to integer bucket keys.")
+  parser.add_argument("filenames", nargs="+", help="Pickle files to convert in place")
+  args = parser.parse_args()
+
+  for filename in args.filenames:
+    with open(filename, "rb") as f:
+      d = pickle.load(f)
+
+    converted = convert_bucket_keys(d)
+    if converted is d:
+      print("{} already has integer keys, skipping".format(filename))
+      continue
+
+    with open(filename, "wb") as f:
+      pickle.dump(converted, f)
+    print("Converted {} items in {}".format(len(converted), filename))
+
+  print("Done.")
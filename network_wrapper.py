@@ -2,6 +2,7 @@ import torch
 
 from constants import Constants
 from network import DeepEvModel
+from infoset import EvInfoSetBatch
 
 
 class NetworkWrapper(object):
@@ -24,32 +25,41 @@ class NetworkWrapper(object):
     Takes an infoset, passes it into the network, and returns the action probabilities predicted
     by the network.
     """
+    infosets = EvInfoSetBatch.from_infosets([infoset])
+    return self.get_action_probabilities_batch(infosets, valid_mask.unsqueeze(0))[0]
+
+  def get_action_probabilities_batch(self, infosets, valid_mask):
+    """
+    Batched version of get_action_probabilities.
+
+    infosets (EvInfoSetBatch) : A batch of N infosets.
+    valid_mask (torch.Tensor) : Shape (N x nactions).
+
+    Returns: (torch.Tensor) with shape (N x nactions).
+
+    NOTE: DeepEvModel normalizes its hidden layer over the whole batch, so each row's output depends
+    on the rest of the batch (just like during training).
+    """
     with torch.no_grad():
-      ev_input = infoset.get_ev_input_tensors().to(self._device)
+      ev_input = infosets.get_ev_input_tensors().to(self._device)
 
-      # Make the opponent bet actions negative, and ours positive.
-      bets_input, position_mask = infoset.get_bet_input_tensors()
-      
-      # Normalize bets_input by the pot size.
-      cumul_pot = torch.cumsum(bets_input, dim=1)
-      cumul_pot[cumul_pot == 0] = 1
-      bets_input = (bets_input * position_mask / cumul_pot).to(self._device)
-      # bets_input = (bets_input * position_mask).to(self._device)
+      # Make the opponent bet actions negative, and ours positive, normalized by the pot size.
+      bets_input = infosets.get_normalized_bet_input_tensors().to(self._device)
 
-      pred_regret = self._network(ev_input, bets_input)[0]
+      pred_regret = self._network(ev_input, bets_input)
 
       # Do regret matching on the predicted advantages.
       r_plus = torch.clamp(pred_regret, min=0)
+      r_plus_sum = r_plus.sum(dim=1, keepdim=True)
 
       # As advocated by Brown et. al., choose the action with highest advantage when all of them are
       # negative.
-      if r_plus.sum() < 1e-5:
-        pred_regret -= pred_regret.min()
-        pred_regret *= valid_mask.to(self._device)
-        r = torch.zeros_like(r_plus)
-        r[torch.argmax(pred_regret)] = 1.0
-      else:
-        r = r_plus / r_plus.sum()
+      pred_regret -= pred_regret.min(dim=1, keepdim=True)[0]
+      pred_regret *= valid_mask.to(self._device)
+      best = torch.zeros_like(r_plus)
+      best[torch.arange(len(best)), torch.argmax(pred_regret, dim=1)] = 1.0
+
+      r = torch.where(r_plus_sum < 1e-5, best, r_plus / r_plus_sum.clamp(min=1e-5))
 
       return r.cpu()
 
@@ -37,6 +37,77 @@ class Options(object):
                 type=int,
                 help="Print out debug statement after this many traversals",
                 default=500)
+    self.parser.add_argument("--EQUITY_CACHE_PATH",
+                type=str,
+                help="If set, postflop equities are cached in this memory-mapped file, which is shared by all workers and kept across runs",
+                default=None)
+    self.parser.add_argument("--EQUITY_CACHE_SLOTS",
+                type=int,
+                help="Capacity of a newly created equity cache (must be a power of 2)",
+                default=2**24)
+    self.parser.add_argument("--EV_CALC_THREADS",
+                type=int,
+                help="Number of threads each worker uses to compute the equities for a round",
+                default=1)
+    self.parser.add_argument("--EV_TARGET_SE",
+                type=float,
+                help="If set, postflop Monte Carlo stops once its standard error is this small, or sooner if the ev is far from every hand strength threshold",
+                default=None)
+    self.parser.add_argument("--PREFLOP_TABLE_PATH",
+                type=str,
+                help="Preflop equity table made by make_preflop_table.py (defaults to the one in the repo)",
+                default=None)
+    self.parser.add_argument("--DEAL_CORPUS_PATH",
+                type=str,
+                help="If set, traverse workers read deals and their equities from this corpus (see deal_corpus.py) instead of computing them. Each iteration and traverse player uses new rows, and evaluation never uses the corpus",
+                default=None)
+    self.parser.add_argument("--EV_PRODUCER_THREADS",
+                type=int,
+                help="If > 0, each traverse worker computes the equities of upcoming deals on this many background threads while it traverses",
+                default=0)
+    self.parser.add_argument("--EV_QUEUE_SIZE",
+                type=int,
+                help="Max number of deals the EV producer threads can get ahead of the traversal",
+                default=32)
+    self.parser.add_argument("--REGRET_TABLE_EXT",
+                type=str,
+                choices=[".pkl", ".npz", ".rtab"],
+                help="File format for the CFR regret and strategy tables (.npz is much smaller and faster to load than the legacy .pkl, .rtab is memory mapped so that rows are only read when used). Legacy .pkl checkpoints are still resumed from, and converted",
+                default=".npz")
+    self.parser.add_argument("--SHARED_REGRET_TABLES",
+                action="store_true",
+                help="Keep the CFR regret and strategy tables in shared memory, where every traverse worker updates them in place (no per-worker load and merge)")
+    self.parser.add_argument("--SHARED_TABLE_CAPACITY",
+                type=int,
+                help="Number of rows allocated for each shared table (must be a power of 2)",
+                default=2**21)
+    self.parser.add_argument("--MERGE_MODE",
+                type=str,
+                choices=["delta", "full"],
+                help="How CFR traverse workers hand back their tables: 'delta' saves only the changed rows, which are summed and applied once, 'full' merges each worker's whole table into the files",
+                default="delta")
+    self.parser.add_argument("--CHECKPOINT_SHARDS",
+                type=int,
+                help="Number of files that each regret/strategy checkpoint is split into by key hash, each merged under its own lock and loaded in parallel",
+                default=1)
+    self.parser.add_argument("--DEAL_SEED",
+                type=int,
+                help="If set, deal the cards from create_deals with this seed so that runs are reproducible",
+                default=None)
+    self.parser.add_argument("--ROUND_STATE_TYPE",
+                type=str,
+                help="Game state used by traversals (mutable states are walked in place with apply/undo)",
+                choices=["namedtuple", "mutable", "compact", "tree"],
+                default="mutable")
+    self.parser.add_argument("--TRAVERSE_ENGINE",
+                type=str,
+                help="CFR traversal implementation: 'iterative' uses an explicit stack and preallocated arrays, 'recursive' is the original (both give the same results)",
+                choices=["iterative", "recursive"],
+                default="iterative")
+    self.parser.add_argument("--BETTING_TREE_PATH",
+                type=str,
+                help="Folder where the precompiled betting tree is cached (for --ROUND_STATE_TYPE tree), defaults to betting_tree/ in the memory folder",
+                default=None)
     self.parser.add_argument("--EV_EMBED_DIM",
                 type=int,
                 help="Size of vector embedding for EV",
@@ -116,8 +187,11 @@ class Options(object):
     options.ADVT_BUFFER_FMT = "advt_mem_{}"
     options.STRT_BUFFER_FMT = "strt_mem"
 
-    options.REGRETS_FMT = os.path.join(options.MEMORY_FOLDER, "total_regrets_{}.pkl")
-    options.STRATEGIES_FMT = os.path.join(options.MEMORY_FOLDER, "avg_strategy_{}.pkl")
+    options.REGRETS_FMT = os.path.join(options.MEMORY_FOLDER, "total_regrets_{}" + options.REGRET_TABLE_EXT)
+    options.STRATEGIES_FMT = os.path.join(options.MEMORY_FOLDER, "avg_strategy_{}" + options.REGRET_TABLE_EXT)
+
+    if options.BETTING_TREE_PATH is None:
+      options.BETTING_TREE_PATH = os.path.join(options.MEMORY_FOLDER, "betting_tree")
 
   def parse(self):
     """
@@ -26,7 +26,16 @@ function provided by pbots_calc. Returns a Results object.
 import ctypes
 import ctypes.util
 import sys, os
-import pickle
+import fcntl
+import threading
+import itertools
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import eval7
+
+from isomorphism import canonical_index, canonical_id, NUM_CANONICAL_CLASSES, RANKS, SUITS
 
 # if 'LD_LIBRARY_PATH' not in os.environ:
 #     os.environ['LD_LIBRARY_PATH'] = os.path.dirname(os.path.abspath(__file__))
@@ -85,29 +94,457 @@ def calc(hands, board, dead, iters):
     return results
 
 
+# calc_many runs queries on a shared thread pool. The foreign calls release the GIL, so they run in
+# parallel, and each thread reuses one preallocated results struct. Every struct is kept in a
+# registry so they can all be freed when the pool shuts down (and at exit). Freeing bumps the
+# generation, so a thread that still remembers an old struct allocates a new one instead.
+_calc_threads = 1
+_calc_pool = None
+_thread_local = threading.local()
+_results_lock = threading.Lock()
+_results_registry = []
+_results_generation = 0
+
+
+def _thread_results():
+    cached = getattr(_thread_local, "res", None)
+    if cached is not None and cached[0] == _results_generation:
+        return cached[1]
+    res = pcalc.alloc_results()
+    with _results_lock:
+        _results_registry.append(res)
+        _thread_local.res = (_results_generation, res)
+    return res
+
+
+def _free_thread_results():
+    """
+    Frees every thread's results struct. Nothing may be running calc_many at the same time.
+    """
+    global _results_generation
+    with _results_lock:
+        for res in _results_registry:
+            pcalc.free_results(res)
+        _results_registry.clear()
+        _results_generation += 1
+
+
+atexit.register(_free_thread_results)
+
+
+def set_calc_threads(num_threads):
+    """
+    Sets the number of threads that calc_many uses (with 1, queries run in the calling thread).
+    """
+    global _calc_threads, _calc_pool
+    if _calc_pool is not None:
+        _calc_pool.shutdown(wait=True)
+        _calc_pool = None
+    _free_thread_results()
+    _calc_threads = max(1, int(num_threads))
+
+
+def calc_adaptive(hands, board, dead, max_iters, target_se, boundaries=(), min_iters=250, z=2.0):
+    """
+    Monte Carlo equity that stops as soon as the estimate is precise enough, instead of always
+    running max_iters.
+
+    pbots_calc seeds its generator on every call, so the samples of separate calls can't be pooled.
+    Instead it reruns with 4x the iters (ending at max_iters) until the standard error
+    (sqrt(ev * (1 - ev) / iters), an upper bound with ties) is at most target_se, or until ev is z
+    standard errors away from every boundary, since then more iters would not move it across one.
+    At most a third of the work is spent on the smaller runs.
+
+    hands, board, dead: same as calc
+    max_iters: never run more than this many iters (i.e the fixed iters calc would use)
+    target_se: the standard error to stop at
+    boundaries: evs where precision matters, i.e the hand strength thresholds of a bucketing
+
+    Returns: (ev, total iters run)
+    """
+    # Runs of max_iters / 4^k, ..., max_iters / 4, max_iters, starting from at least min_iters.
+    schedule = [max_iters]
+    while schedule[-1] // 4 >= min_iters:
+        schedule.append(schedule[-1] // 4)
+
+    res = _thread_results()
+    total_iters = 0
+    for iters in reversed(schedule):
+        err = pcalc.calc(hands, board, dead, iters, res)
+        if err <= 0:
+            print("error: could not parse input or something...")
+            return float("nan"), total_iters
+        ev = res[0].ev[0]
+        total_iters += res[0].iters
+
+        # Exact enumeration (MC == 0) has no error at all.
+        if res[0].MC == 0:
+            break
+        se = (ev * (1 - ev) / iters) ** 0.5
+        dist = min([abs(ev - b) for b in boundaries], default=0)
+        if se <= max(target_se, dist / z):
+            break
+    return ev, total_iters
+
+
+def _calc_ev(job):
+    """
+    Runs one calc_many job, and returns the ev of the first hand and the number of iters run.
+    """
+    hands, board, dead, iters, target_se, boundaries = job
+    if target_se is not None:
+        return calc_adaptive(hands, board, dead, iters, target_se, boundaries)
+
+    res = _thread_results()
+    err = pcalc.calc(hands, board, dead, iters, res)
+    if err > 0:
+        return res[0].ev[0], res[0].iters
+    print("error: could not parse input or something...")
+    return float("nan"), 0
+
+
+def _run_jobs(jobs):
+    if _calc_threads <= 1 or len(jobs) <= 1:
+        return [_calc_ev(job) for job in jobs]
+
+    global _calc_pool
+    if _calc_pool is None:
+        _calc_pool = ThreadPoolExecutor(_calc_threads)
+    return list(_calc_pool.map(_calc_ev, jobs))
+
+
+def calc_many(queries, iters, target_se=None, boundaries=()):
+    """
+    Runs many calc queries at once on the thread pool (see set_calc_threads).
+
+    queries: list of (hands, board, dead) bytes, the same as the arguments to calc
+    iters: an int, or a list with the iters for each query
+    target_se: if set, each query stops early with calc_adaptive (iters are then the max iters)
+    boundaries: passed to calc_adaptive
+
+    Returns an np.ndarray with the ev of the first hand in each query.
+    """
+    if isinstance(iters, int):
+        iters = [iters] * len(queries)
+    jobs = [(hands, board, dead, n, target_se, boundaries) for (hands, board, dead), n in zip(queries, iters)]
+    return np.array([ev for ev, _ in _run_jobs(jobs)], dtype=np.float64)
+
+
+def split_cards(cards):
+    """
+    cards: a string or bytes of concatenated cards, i.e b"2c3c4c"
+    """
+    if isinstance(cards, bytes):
+        cards = cards.decode()
+    return [cards[i:i+2] for i in range(0, len(cards), 2)]
+
+
+class _FileLock(object):
+    """
+    Holds an exclusive flock on an open file (shared across processes). Threads of one process share
+    the flock, so they also take a thread lock.
+    """
+    def __init__(self, f, thread_lock):
+        self._f = f
+        self._thread_lock = thread_lock
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+class EquityCache(object):
+    """
+    An open addressing hash table of hand vs. random equities, stored in a memory-mapped file so
+    that it survives across runs and is shared by every process that opens it.
+
+    Each slot is a (key, ev) pair. Keys are the suit-isomorphic isomorphism.canonical_id of the hand
+    and board plus one, and 0 marks an empty slot. Slot 0 holds a header with the format version.
+    Lookups don't take any locks: a slot's ev is written before its key, so a reader that sees a
+    key always sees its ev. Inserts are serialized across processes (and threads) with a lock file.
+    """
+    VERSION = 2
+    MAGIC = 0x4551434143484500  # "EQCACHE"
+    SLOT_DTYPE = np.dtype([("key", "<u8"), ("ev", "<f8")])
+    MAX_LOAD_FACTOR = 0.7
+    MAX_PROBES = 64
+
+    def __init__(self, filename, num_slots=2**24):
+        """
+        filename: path to the cache file, which is created if it doesn't exist.
+        num_slots: capacity of a new cache (a power of 2). An existing cache keeps its own size.
+        """
+        assert num_slots & (num_slots - 1) == 0, "num_slots must be a power of 2"
+        self.filename = filename
+        os.makedirs(os.path.abspath(os.path.dirname(filename)), exist_ok=True)
+        self._lock_file = open(filename + ".lock", "a")
+        self._thread_lock = threading.Lock()
+
+        with self._locked():
+            if not os.path.exists(filename):
+                table = np.memmap(filename, dtype=self.SLOT_DTYPE, mode="w+", shape=(num_slots,))
+                table[0] = (self.MAGIC, self.VERSION)
+                table.flush()
+                del table
+
+        self.table = np.memmap(filename, dtype=self.SLOT_DTYPE, mode="r+")
+        if self.table[0]["key"] != self.MAGIC or self.table[0]["ev"] != self.VERSION:
+            raise ValueError("{} is not a version {} EquityCache".format(filename, self.VERSION))
+
+        self._keys = self.table["key"]
+        self._evs = self.table["ev"]
+        self._bits = len(self.table).bit_length() - 1
+        self._mask = len(self.table) - 1
+        self._max_size = int(self.MAX_LOAD_FACTOR * len(self.table))
+        self._full = False
+        self.hits = 0
+        self.misses = 0
+
+    def _locked(self):
+        return _FileLock(self._lock_file, self._thread_lock)
+
+    @staticmethod
+    def key(hand, board):
+        """
+        hand: list of card strings, i.e ['Kd', 'As']
+        board: list of card strings (0, 3, 4, or 5 of them)
+        """
+        return canonical_id(hand, board) + 1
+
+    def _slot(self, key):
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self._bits)
+
+    def get(self, key):
+        """
+        Returns the cached ev for key, or None if it isn't in the cache.
+        """
+        i = self._slot(key)
+        for _ in range(self.MAX_PROBES):
+            k = int(self._keys[i])
+            if k == key:
+                self.hits += 1
+                return float(self._evs[i])
+            if k == 0:
+                break
+            i = (i + 1) & self._mask
+        self.misses += 1
+        return None
+
+    def put(self, key, ev):
+        """
+        Adds an ev to the cache. Does nothing once the cache reaches its max load factor.
+        """
+        if self._full:
+            return
+        with self._locked():
+            i = self._slot(key)
+            for _ in range(self.MAX_PROBES):
+                k = int(self._keys[i])
+                if k == key:
+                    return
+                if k == 0:
+                    self._evs[i] = ev
+                    self._keys[i] = key
+                    return
+                i = (i + 1) & self._mask
+
+            # Long probe sequences mean the table is getting full.
+            if np.count_nonzero(self._keys) > self._max_size:
+                print("[EquityCache] {} is full, not adding any more entries".format(self.filename))
+                self._full = True
+
+    def size(self):
+        return int(np.count_nonzero(self._keys)) - 1
+
+    def flush(self):
+        self.table.flush()
+
+
+_EVAL7_CARDS = {r + s: eval7.Card(r + s) for r in RANKS for s in SUITS}
+_EVAL7_ALL_HANDS = [(hand, 1.0) for hand in itertools.combinations(_EVAL7_CARDS.values(), 2)]
+# On the river the opponent has C(45, 2) possible hands, and each counts 1 for a win or 1/2 for a tie.
+_RIVER_EQUITY_DENOM = 2 * 45 * 44 // 2
+
+
+def river_equity(hand, board):
+    """
+    Exact equity of a hand against a uniformly random opponent hand on the river (win + tie / 2).
+
+    Every opponent hand that doesn't share a card with the hand or board is enumerated in one call
+    to eval7. The result comes back as a float32, so it is snapped back onto the exact fraction.
+
+    hand: list of cards strings, i.e ['Kd', 'As']
+    board: list of 5 card strings
+    """
+    ev = eval7.py_hand_vs_range_exact([_EVAL7_CARDS[c] for c in hand], _EVAL7_ALL_HANDS,
+                                      [_EVAL7_CARDS[c] for c in board])
+    return round(ev * _RIVER_EQUITY_DENOM) / _RIVER_EQUITY_DENOM
+
+
+DEFAULT_PREFLOP_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preflop_equity.npy")
+
+
+def make_preflop_table(preflop_odds):
+    """
+    Converts preflop odds (a dict from a frozenset of two card strings to ev) into a dense float32
+    array indexed by isomorphism.canonical_index, averaging the estimates for isomorphic hands.
+    """
+    totals = np.zeros(NUM_CANONICAL_CLASSES[0])
+    counts = np.zeros(NUM_CANONICAL_CLASSES[0])
+    for hand, ev in preflop_odds.items():
+        index = canonical_index(list(hand), [])
+        totals[index] += ev
+        counts[index] += 1
+    assert counts.min() > 0, "Preflop odds are missing some hand classes"
+    return (totals / counts).astype(np.float32)
+
+
+def load_preflop_table(path=DEFAULT_PREFLOP_TABLE_PATH):
+    table = np.load(path)
+    assert table.shape == (NUM_CANONICAL_CLASSES[0],), "Expected one preflop ev per hand class"
+    return table
+
+
 class CalcWithLookup(object):
-    def __init__(self):
-        with open("/home/milo/pokerbots-2020/preflop_odds.pkl", "rb") as f:
-            self.preflop_odds = pickle.load(f)
-        # self.preflop_odds = pickle.load(open('./preflop_odds.pkl','rb'))
-    
-    def calc(self, hand, board, dead, iters):
+    # Max number of postflop equities to remember in memory when there is no EquityCache.
+    MAX_MEMO_SIZE = 10**6
+
+    def __init__(self, cache_filename=None, cache_slots=2**24, preflop_path=DEFAULT_PREFLOP_TABLE_PATH):
         """
-        hand: list of cards strings, i.e ['Kd', 'As']
+        cache_filename: optional path to a persistent EquityCache for postflop equities.
+        preflop_path: the .npy table from make_preflop_table.py, loaded the first time it's needed.
+
+        Suit-isomorphic hands and boards have the same equity, so everything is looked up by its
+        isomorphism.canonical_index: the preflop table has one entry per 169 classes, and postflop
+        results are reused across isomorphic spots.
+        """
+        self.preflop_path = preflop_path
+        self._preflop_table = None
+
+        self._memo = {}
+        self.target_se = None
+        self.se_boundaries = ()
+        self.mc_calls = 0
+        self.mc_iters = 0
+        self.cache = None
+        if cache_filename is not None:
+            self.open_cache(cache_filename, cache_slots)
+
+    @property
+    def preflop_table(self):
+        if self._preflop_table is None:
+            self._preflop_table = load_preflop_table(self.preflop_path)
+        return self._preflop_table
+
+    def set_preflop_path(self, preflop_path):
+        self.preflop_path = preflop_path
+        self._preflop_table = None
+
+    def open_cache(self, cache_filename, cache_slots=2**24):
+        self.cache = EquityCache(cache_filename, num_slots=cache_slots)
+        print("[CalcWithLookup] Using equity cache {} with {} entries".format(cache_filename, self.cache.size()))
+
+    def set_adaptive(self, target_se, boundaries=()):
+        """
+        Makes Monte Carlo stop early (see calc_adaptive), using the iters passed to calc as the max.
+        Pass target_se=None to always run the full iters again.
+
+        target_se: the standard error to stop at, i.e 0.005
+        boundaries: evs where precision matters, i.e infoset.BUCKET_SMALL_HS_THRESHOLDS
+        """
+        self.target_se = target_se
+        self.se_boundaries = tuple(boundaries)
+
+    def _lookup(self, hand, board, dead):
+        """
+        Returns the cache key (None if it can't be cached) and the ev if it's known without running
+        Monte Carlo.
         """
         if len(board) == 0:
-            return self.preflop_odds[frozenset(hand)]
+            return None, float(self.preflop_table[canonical_index(hand, [])])
+
+        # Dead cards change the equity, so only cache the usual case without them.
+        if len(dead) > 0:
+            return None, None
+
+        # The river is enumerated exactly, which is cheaper than a cache lookup.
+        if len(board) == 10:
+            return None, river_equity(hand, split_cards(board))
+        key = EquityCache.key(hand, split_cards(board))
+        ev = self.cache.get(key) if self.cache is not None else None
+        return key, (ev if ev is not None else self._memo.get(key))
+
+    def _store(self, key, ev, full_precision=True):
+        """
+        Remembers an ev. Only evs from the full iters go into the EquityCache, since other runs will
+        read them back as full precision. Estimates that stopped early (see set_adaptive) are only
+        kept in memory for this process.
+        """
+        if key is None:
+            return
+        if self.cache is not None and full_precision:
+            self.cache.put(key, ev)
         else:
-            hands = str.encode("{}:xx".format("".join(hand)))
-            res = pcalc.alloc_results()
-            err = pcalc.calc(hands, board, dead, iters, res)
-            if err > 0:
-                results = Results(res[0])
+            if len(self._memo) >= self.MAX_MEMO_SIZE:
+                self._memo.clear()
+            self._memo[key] = ev
+
+    def calc(self, hand, board, dead, iters):
+        """
+        hand: list of cards strings, i.e ['Kd', 'As']
+        """
+        key, ev = self._lookup(hand, board, dead)
+        if ev is not None:
+            return ev
+
+        hands = str.encode("{}:xx".format("".join(hand)))
+        ev, n = _calc_ev((hands, board, dead, iters, self.target_se, self.se_boundaries))
+        self.mc_calls += 1
+        self.mc_iters += n
+
+        self._store(key, ev, full_precision=(n >= iters))
+        return ev
+
+    def calc_many(self, queries, iters):
+        """
+        Batched version of calc. Lookups are done first, and the remaining queries (without
+        duplicates) are run in parallel with calc_many.
+
+        queries: list of (hand, board, dead), the same as the arguments to calc
+        iters: an int, or a list with the iters for each query
+
+        Returns an np.ndarray of evs.
+        """
+        if isinstance(iters, int):
+            iters = [iters] * len(queries)
+
+        out = np.zeros(len(queries))
+        todo = {}
+        for i, (hand, board, dead) in enumerate(queries):
+            key, ev = self._lookup(hand, board, dead)
+            if ev is not None:
+                out[i] = ev
             else:
-                print("error: could not parse input or something...")
-                results = None
-            pcalc.free_results(res)
-            return results.ev[0]
+                todo.setdefault(key if key is not None else ("nocache", i), []).append(i)
+
+        jobs = list(todo.items())
+        mc_jobs = []
+        for _, indices in jobs:
+            hand, board, dead = queries[indices[0]]
+            mc_jobs.append((str.encode("{}:xx".format("".join(hand))), board, dead, iters[indices[0]],
+                            self.target_se, self.se_boundaries))
+        results = _run_jobs(mc_jobs)
+
+        for (key, indices), (ev, n) in zip(jobs, results):
+            out[indices] = ev
+            self._store(key if not isinstance(key, tuple) else None, ev, full_precision=(n >= iters[indices[0]]))
+            self.mc_calls += 1
+            self.mc_iters += n
+        return out
 
 
 if __name__ == "__main__":
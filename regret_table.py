@@ -0,0 +1,618 @@
+import os, sys, pickle
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import numpy as np
+
+from constants import Constants
+from infoset import bucket_small_pack, bucket_small_split
+
+
+def convert_bucket_keys(regrets):
+  """
+  Converts a regret dict saved with the old string keys (see infoset.bucket_small_join) to integer
+  keys (see infoset.bucket_small_pack). Dicts that already have integer keys are returned as is.
+  """
+  if all(isinstance(key, int) for key in regrets):
+    return regrets
+  return {(bucket_small_pack(bucket_small_split(key)) if isinstance(key, str) else key): value
+          for key, value in regrets.items()}
+
+
+class RegretTable(object):
+  def __init__(self, num_actions=Constants.NUM_ACTIONS, capacity=1024):
+    """
+    A table of float32 rows (one per bucket key) stored in one contiguous (capacity, num_actions)
+    array, plus a dict from key to row. Rows are updated in place and the array doubles in size
+    when it fills up.
+
+    num_actions (int) : The length of each row.
+    capacity (int) : The number of rows to allocate up front.
+    """
+    self.num_actions = num_actions
+    self._index = {}
+    self._keys = np.zeros(capacity, dtype=np.int64)
+    self._values = np.zeros((capacity, num_actions), dtype=np.float32)
+    self._delta_base = None
+
+  def __len__(self):
+    return len(self._index)
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def _grow(self, capacity):
+    keys = np.zeros(capacity, dtype=np.int64)
+    values = np.zeros((capacity, self.num_actions), dtype=np.float32)
+    keys[:len(self)] = self._keys[:len(self)]
+    values[:len(self)] = self._values[:len(self)]
+    self._keys, self._values = keys, values
+
+  def row(self, key):
+    """
+    Returns the row index for a key, adding a row of zeros if it isn't in the table yet.
+    """
+    i = self._index.get(key)
+    if i is None:
+      i = len(self)
+      if i == len(self._keys):
+        self._grow(2 * len(self._keys))
+      self._keys[i] = key
+      self._index[key] = i
+    return i
+
+  def get(self, key, create=False):
+    """
+    Returns a view of the row for a key. If it isn't in the table, returns None, or adds a row of
+    zeros with create=True.
+    """
+    i = self.row(key) if create else self._index.get(key)
+    return None if i is None else self._values[i]
+
+  def add(self, key, r, clip=False):
+    """
+    Adds r to the row for a key in place. With clip=True, negative entries are set to zero afterwards
+    (CFR+ regret matching).
+    """
+    i = self.row(key)
+    row = self._values[i]
+    if self._delta_base is not None and i not in self._delta_base:
+      self._delta_base[i] = row.copy()
+    row += r
+    if clip:
+      np.maximum(row, 0, out=row)
+
+  def add_rows(self, keys, values, clip=False):
+    """
+    Adds many rows at once (i.e another table's keys() and values()). The keys must be unique.
+    """
+    rows = np.array([self.row(key) for key in keys.tolist()], dtype=np.int64)
+    self._values[rows] += values
+    if clip:
+      self._values[rows] = np.maximum(self._values[rows], 0)
+
+  def track_changes(self):
+    """
+    Starts remembering the original value of every row that add changes, for delta.
+    """
+    self._delta_base = {}
+
+  def delta(self):
+    """
+    Returns: (keys, values) of only the rows changed since track_changes, as the change in each row.
+    """
+    if not self._delta_base:
+      return np.zeros(0, dtype=np.int64), np.zeros((0, self.num_actions), dtype=np.float32)
+    rows = np.fromiter(self._delta_base.keys(), dtype=np.int64, count=len(self._delta_base))
+    base = np.stack(list(self._delta_base.values()))
+    return self._keys[rows], self._values[rows] - base
+
+  def keys(self):
+    return self._keys[:len(self)]
+
+  def values(self):
+    return self._values[:len(self)]
+
+  def to_dict(self):
+    """
+    Returns: (dict) from key to a torch.Tensor row, the format of the old pickle files.
+    """
+    return {key: torch.from_numpy(self._values[i].copy()) for key, i in self._index.items()}
+
+  @staticmethod
+  def from_dict(d, num_actions=Constants.NUM_ACTIONS):
+    table = RegretTable(num_actions, capacity=max(1024, len(d)))
+    if len(d) > 0:
+      table.add_rows(np.array(list(d.keys()), dtype=np.int64),
+                     np.stack([np.asarray(v, dtype=np.float32) for v in d.values()]))
+    return table
+
+  def save(self, filename):
+    """
+    Saves the table, as arrays of keys and values if filename ends in .npz, or otherwise as the
+    legacy pickle of a dict of tensors.
+    """
+    os.makedirs(os.path.abspath(os.path.dirname(filename)), exist_ok=True)
+    if filename.endswith(MAPPED_EXT):
+      save_mapped(filename, self.keys(), self.values())
+    elif filename.endswith(".npz"):
+      np.savez(filename, keys=self.keys(), values=self.values())
+    else:
+      with open(filename, "wb") as f:
+        pickle.dump(self.to_dict(), f)
+
+  @staticmethod
+  def load(filename, num_actions=Constants.NUM_ACTIONS):
+    """
+    Loads a table from save (the format is chosen by the extension, like save). A .rtab file is
+    opened as a MappedRegretTable, which doesn't read any values until they're used.
+    """
+    if filename.endswith(MAPPED_EXT):
+      return MappedRegretTable(filename)
+    if filename.endswith(".npz"):
+      with np.load(filename) as d:
+        keys, values = d["keys"], d["values"]
+      table = RegretTable(values.shape[1], capacity=max(1024, len(keys)))
+      table._keys[:len(keys)] = keys
+      table._values[:len(keys)] = values
+      table._index = dict(zip(keys.tolist(), range(len(keys))))
+      return table
+
+    with open(filename, "rb") as f:
+      d = pickle.load(f)
+
+    # Older files use string bucket keys.
+    return RegretTable.from_dict(convert_bucket_keys(d), num_actions)
+
+
+MAPPED_EXT = ".rtab"
+MAPPED_MAGIC = b"RTAB0001"
+MAPPED_HEADER_BYTES = 64
+
+
+def save_mapped(filename, keys, values):
+  """
+  Writes a .rtab file: a 64 byte header (MAPPED_MAGIC, then the number of rows and num_actions as
+  int64), the keys as sorted int64, then the rows in the same order as one contiguous float32 array.
+  The file is written next to filename and moved over it, so processes that have the old file
+  mapped keep reading the old version.
+  """
+  order = np.argsort(keys, kind="stable")
+  keys = np.ascontiguousarray(keys[order], dtype=np.int64)
+  values = np.ascontiguousarray(values[order], dtype=np.float32)
+  header = np.zeros(MAPPED_HEADER_BYTES, dtype=np.uint8)
+  header[:8] = np.frombuffer(MAPPED_MAGIC, dtype=np.uint8)
+  header[8:24] = np.array([len(keys), values.shape[1]], dtype=np.int64).view(np.uint8)
+
+  os.makedirs(os.path.abspath(os.path.dirname(filename)), exist_ok=True)
+  tmp_filename = "{}.tmp{}".format(filename, os.getpid())
+  with open(tmp_filename, "wb") as f:
+    header.tofile(f)
+    keys.tofile(f)
+    values.tofile(f)
+  os.replace(tmp_filename, filename)
+
+
+class MappedRegretTable(object):
+  def __init__(self, filename):
+    """
+    A RegretTable opened from a .rtab file (see save_mapped) with np.memmap, so opening it only reads
+    the header, and rows are paged in from disk the first time they're used. Keys are found by binary
+    search over the sorted key array. The values are mapped copy-on-write: adding to a row changes
+    this process's copy of its page and never the file. Keys that aren't in the file go into an
+    ordinary RegretTable on the side.
+
+    filename (str) : A file from save_mapped.
+    """
+    with open(filename, "rb") as f:
+      header = f.read(MAPPED_HEADER_BYTES)
+    if header[:8] != MAPPED_MAGIC:
+      raise ValueError("{} isn't a {} file".format(filename, MAPPED_EXT))
+    num_rows, self.num_actions = (int(x) for x in np.frombuffer(header[8:24], dtype=np.int64))
+    self.filename = filename
+
+    if num_rows > 0:
+      self._base_keys = np.memmap(filename, dtype=np.int64, mode="r", offset=MAPPED_HEADER_BYTES,
+                                  shape=(num_rows,)).view(np.ndarray)
+      self._base_values = np.memmap(filename, dtype=np.float32, mode="c",
+                                    offset=MAPPED_HEADER_BYTES + 8 * num_rows,
+                                    shape=(num_rows, self.num_actions)).view(np.ndarray)
+    else:
+      self._base_keys = np.zeros(0, dtype=np.int64)
+      self._base_values = np.zeros((0, self.num_actions), dtype=np.float32)
+    self._rows = {}
+    self._extra = RegretTable(self.num_actions)
+    self._delta_base = None
+
+  def __len__(self):
+    return len(self._base_keys) + len(self._extra)
+
+  def __contains__(self, key):
+    return self._base_row(key) is not None or key in self._extra
+
+  def _base_row(self, key):
+    """
+    Returns the row of a key in the file, or None. Rows that have been looked up are remembered.
+    """
+    i = self._rows.get(key)
+    if i is None:
+      i = int(np.searchsorted(self._base_keys, key))
+      if i == len(self._base_keys) or self._base_keys[i] != key:
+        return None
+      self._rows[key] = i
+    return i
+
+  def get(self, key, create=False):
+    """
+    Returns a view of the row for a key. If it isn't in the table, returns None, or adds a row of
+    zeros with create=True.
+    """
+    i = self._base_row(key)
+    return self._extra.get(key, create=create) if i is None else self._base_values[i]
+
+  def add(self, key, r, clip=False):
+    """
+    Adds r to the row for a key in place. With clip=True, negative entries are set to zero afterwards
+    (CFR+ regret matching).
+    """
+    i = self._base_row(key)
+    if i is None:
+      self._extra.add(key, r, clip=clip)
+      return
+    row = self._base_values[i]
+    if self._delta_base is not None and i not in self._delta_base:
+      self._delta_base[i] = row.copy()
+    row += r
+    if clip:
+      np.maximum(row, 0, out=row)
+
+  def add_rows(self, keys, values, clip=False):
+    """
+    Adds many rows at once (i.e another table's keys() and values()). The keys must be unique.
+    """
+    rows = np.minimum(np.searchsorted(self._base_keys, keys), max(0, len(self._base_keys) - 1))
+    found = (self._base_keys[rows] == keys) if len(self._base_keys) > 0 else np.zeros(len(keys), dtype=bool)
+    rows = rows[found]
+    self._base_values[rows] += values[found]
+    if clip:
+      self._base_values[rows] = np.maximum(self._base_values[rows], 0)
+    self._extra.add_rows(keys[~found], values[~found], clip=clip)
+
+  def track_changes(self):
+    """
+    Starts remembering the original value of every row that add changes, for delta.
+    """
+    self._delta_base = {}
+    self._extra.track_changes()
+
+  def delta(self):
+    """
+    Returns: (keys, values) of only the rows changed since track_changes, as the change in each row.
+    """
+    extra_keys, extra_values = self._extra.delta()
+    if not self._delta_base:
+      return extra_keys, extra_values
+    rows = np.fromiter(self._delta_base.keys(), dtype=np.int64, count=len(self._delta_base))
+    base = np.stack(list(self._delta_base.values()))
+    return np.concatenate([self._base_keys[rows], extra_keys]), \
+           np.concatenate([self._base_values[rows] - base, extra_values])
+
+  def keys(self):
+    return np.concatenate([self._base_keys, self._extra.keys()])
+
+  def values(self):
+    return np.concatenate([self._base_values, self._extra.values()])
+
+  def to_table(self):
+    """
+    Returns: (RegretTable) an in-memory copy of this table (which reads every row).
+    """
+    table = RegretTable(self.num_actions, capacity=max(1024, len(self)))
+    table.add_rows(self.keys(), self.values())
+    return table
+
+  def to_dict(self):
+    return self.to_table().to_dict()
+
+  def save(self, filename):
+    if filename.endswith(MAPPED_EXT):
+      save_mapped(filename, self.keys(), self.values())
+    else:
+      self.to_table().save(filename)
+
+
+def shard_filenames(filename, num_shards):
+  """
+  The files of a checkpoint split into num_shards (just [filename] for 1 shard), i.e
+  total_regrets_0.shard002-of-008.npz for total_regrets_0.npz.
+  """
+  if num_shards == 1:
+    return [filename]
+  base, ext = os.path.splitext(filename)
+  return ["{}.shard{:03d}-of-{:03d}{}".format(base, k, num_shards, ext) for k in range(num_shards)]
+
+
+def shard_of(keys, num_shards):
+  """
+  Returns: (np.ndarray) the shard of each key, from a multiplicative hash (bucket keys are dense in
+           their low bits, so key % num_shards would be lopsided).
+  """
+  h = (keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(40)
+  return (h % np.uint64(num_shards)).astype(np.int64)
+
+
+def split_table(table, num_shards):
+  """
+  Returns: (list of RegretTable) the rows of each shard.
+  """
+  keys, values = table.keys(), table.values()
+  shards = shard_of(keys, num_shards)
+  out = []
+  for k in range(num_shards):
+    mask = shards == k
+    shard = RegretTable(table.num_actions, capacity=max(1024, int(mask.sum())))
+    shard.add_rows(keys[mask], values[mask])
+    out.append(shard)
+  return out
+
+
+def save_sharded(table, filename, num_shards=1, num_threads=8):
+  """
+  Saves a table as num_shards files (see shard_filenames), writing them in parallel.
+  """
+  if num_shards == 1:
+    table.save(filename)
+    return
+  with ThreadPoolExecutor(min(num_threads, num_shards)) as pool:
+    list(pool.map(lambda args: args[0].save(args[1]), zip(split_table(table, num_shards),
+                                                           shard_filenames(filename, num_shards))))
+
+
+def load_sharded(filename, num_shards=1, num_actions=Constants.NUM_ACTIONS, num_threads=8):
+  """
+  Loads the shards from save_sharded in parallel, and returns them as one RegretTable.
+  """
+  if num_shards == 1:
+    return RegretTable.load(filename, num_actions)
+  with ThreadPoolExecutor(min(num_threads, num_shards)) as pool:
+    shards = list(pool.map(lambda f: RegretTable.load(f, num_actions), shard_filenames(filename, num_shards)))
+
+  keys = np.concatenate([shard.keys() for shard in shards])
+  table = RegretTable(num_actions, capacity=max(1024, len(keys)))
+  table._keys[:len(keys)] = keys
+  table._values[:len(keys)] = np.concatenate([shard.values() for shard in shards])
+  table._index = dict(zip(keys.tolist(), range(len(keys))))
+  return table
+
+
+def checkpoint_exists(filename, num_shards=1):
+  return all(os.path.exists(f) for f in shard_filenames(filename, num_shards))
+
+
+LEGACY_EXT = ".pkl"
+
+
+def find_checkpoint(filename, num_shards=1):
+  """
+  The checkpoint to resume from: filename if it exists, or else the same checkpoint in the legacy
+  pickle format (i.e total_regrets_0.pkl for total_regrets_0.npz), so that runs started before the
+  default format changed can still be resumed. Returns None if neither exists.
+  """
+  if checkpoint_exists(filename, num_shards):
+    return filename
+  legacy = os.path.splitext(filename)[0] + LEGACY_EXT
+  if legacy != filename and checkpoint_exists(legacy, num_shards):
+    return legacy
+  return None
+
+
+def save_delta(filename, keys, values):
+  os.makedirs(os.path.abspath(os.path.dirname(filename)), exist_ok=True)
+  np.savez(filename, keys=keys, values=values)
+
+
+def load_delta(filename):
+  with np.load(filename) as d:
+    return d["keys"], d["values"]
+
+
+def sum_deltas(deltas):
+  """
+  Sums a list of (keys, values) deltas into one, adding up the rows of keys that appear more than once.
+  """
+  keys = np.concatenate([k for k, _ in deltas])
+  values = np.concatenate([v for _, v in deltas])
+  if len(keys) == 0:
+    return keys, values
+  order = np.argsort(keys, kind="stable")
+  keys, values = keys[order], values[order]
+  starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+  return keys[starts], np.add.reduceat(values, starts, axis=0)
+
+
+def apply_delta_files(table, filenames, num_threads=8, clip=True):
+  """
+  Loads deltas from save_delta files in parallel, sums them, and applies them to a table once.
+
+  Returns: (int) the number of rows updated.
+  """
+  with ThreadPoolExecutor(max(1, min(num_threads, len(filenames)))) as pool:
+    deltas = list(pool.map(load_delta, filenames))
+  keys, values = sum_deltas(deltas)
+  table.add_rows(keys, values, clip=clip)
+  return len(keys)
+
+
+def attach_untracked(name):
+  """
+  Attaches to existing shared memory without registering it with resource_tracker (track=False on
+  Python 3.13). Older versions register every attach, and a tracker started by the attaching process
+  (i.e one that isn't a multiprocessing child) unlinks the memory when that process exits, while the
+  owner still uses it. Unregistering afterwards isn't an option, since multiprocessing children share
+  the owner's tracker, and that would drop the owner's entry.
+
+  NOTE: Not thread safe before 3.13, since resource_tracker.register is swapped out during the attach.
+  """
+  if sys.version_info >= (3, 13):
+    return shared_memory.SharedMemory(name=name, track=False)
+  register = resource_tracker.register
+  resource_tracker.register = lambda name, rtype: None
+  try:
+    return shared_memory.SharedMemory(name=name)
+  finally:
+    resource_tracker.register = register
+
+
+class SharedRegretTable(object):
+  MAX_LOAD_FACTOR = 0.7
+
+  def __init__(self, capacity, num_actions, lock, name=None):
+    """
+    A RegretTable that lives in multiprocessing.shared_memory, so that every traverse worker updates
+    one copy in place instead of loading and merging its own. It's an open addressing hash table
+    with a fixed capacity: a row count, then the keys (stored plus one, so 0 marks an empty slot),
+    then the (capacity, num_actions) float32 values.
+
+    Race policy: adding to a row takes no lock (Hogwild). Two processes updating the same row at
+    the same time can lose one of the updates, which is rare and accepted, as in asynchronous SGD.
+    Inserting a key takes the lock, so a key never gets two rows. Slots never move once claimed,
+    so each process remembers the slots it has looked up.
+
+    capacity (int) : The number of slots (a power of 2). Inserting past MAX_LOAD_FACTOR raises.
+    lock (multiprocessing.Lock) : Shared by every process, from the spawn context.
+    name (str) : Attach to an existing table instead of creating one.
+    """
+    assert capacity & (capacity - 1) == 0, "capacity must be a power of 2"
+    self.capacity = capacity
+    self.num_actions = num_actions
+    self._lock = lock
+    self._owner = name is None
+
+    nbytes = 8 + 8 * capacity + 4 * capacity * num_actions
+    if self._owner:
+      self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    else:
+      self._shm = attach_untracked(name)
+    self._count = np.ndarray((1,), dtype=np.int64, buffer=self._shm.buf, offset=0)
+    self._keys = np.ndarray((capacity,), dtype=np.int64, buffer=self._shm.buf, offset=8)
+    self._values = np.ndarray((capacity, num_actions), dtype=np.float32, buffer=self._shm.buf,
+                              offset=8 + 8 * capacity)
+    if self._owner:
+      self._count[:] = 0
+      self._keys[:] = 0
+      self._values[:] = 0
+
+    self._bits = capacity.bit_length() - 1
+    self._max_size = int(self.MAX_LOAD_FACTOR * capacity)
+    self._slots = {}
+
+  @staticmethod
+  def from_table(table, capacity, lock):
+    shared = SharedRegretTable(capacity, table.num_actions, lock)
+    shared.add_rows(table.keys(), table.values())
+    return shared
+
+  def __getstate__(self):
+    # Processes attach to the same shared memory by name.
+    return {"capacity": self.capacity, "num_actions": self.num_actions, "lock": self._lock,
+            "name": self._shm.name}
+
+  def __setstate__(self, state):
+    self.__init__(state["capacity"], state["num_actions"], state["lock"], name=state["name"])
+
+  def __len__(self):
+    return int(self._count[0])
+
+  def __contains__(self, key):
+    return self._find(key)[1]
+
+  def _find(self, key):
+    """
+    Returns the slot of a key (or of the empty slot where it would go), and whether it was found.
+    """
+    stored = key + 1
+    i = ((stored * 11400714819323198485) & 0xFFFFFFFFFFFFFFFF) >> (64 - self._bits)
+    while True:
+      k = int(self._keys[i])
+      if k == stored or k == 0:
+        return i, k == stored
+      i = (i + 1) & (self.capacity - 1)
+
+  def row(self, key):
+    """
+    Returns the slot for a key, adding a row of zeros if it isn't in the table yet.
+    """
+    i = self._slots.get(key)
+    if i is not None:
+      return i
+    i, found = self._find(key)
+    if not found:
+      with self._lock:
+        # Another process may have inserted it (or taken the empty slot) in the meantime.
+        i, found = self._find(key)
+        if not found:
+          if len(self) >= self._max_size:
+            raise RuntimeError("SharedRegretTable is full ({} rows), use a bigger capacity".format(len(self)))
+          self._keys[i] = key + 1
+          self._count[0] += 1
+    self._slots[key] = i
+    return i
+
+  def get(self, key, create=False):
+    """
+    Returns a view of the row for a key. If it isn't in the table, returns None, or adds a row of
+    zeros with create=True.
+    """
+    if create:
+      return self._values[self.row(key)]
+    i, found = self._find(key)
+    return self._values[i] if found else None
+
+  def add(self, key, r, clip=False):
+    """
+    Adds r to the row for a key in place (without a lock, see the race policy). With clip=True,
+    negative entries are set to zero afterwards (CFR+ regret matching).
+    """
+    i = self.row(key)
+    row = self._values[i]
+    row += r
+    if clip:
+      np.maximum(row, 0, out=row)
+
+  def add_rows(self, keys, values, clip=False):
+    rows = np.array([self.row(key) for key in keys.tolist()], dtype=np.int64)
+    self._values[rows] += values
+    if clip:
+      self._values[rows] = np.maximum(self._values[rows], 0)
+
+  def to_table(self):
+    """
+    Returns: (RegretTable) a private copy of this table.
+    """
+    occupied = self._keys != 0
+    keys, values = self._keys[occupied] - 1, self._values[occupied]
+    table = RegretTable(self.num_actions, capacity=max(1024, len(keys)))
+    table.add_rows(keys, values)
+    return table
+
+  def keys(self):
+    return self._keys[self._keys != 0] - 1
+
+  def values(self):
+    return self._values[self._keys != 0]
+
+  def to_dict(self):
+    return self.to_table().to_dict()
+
+  def save(self, filename):
+    self.to_table().save(filename)
+
+  def close(self):
+    """
+    Detaches from the shared memory, and frees it if this process created the table.
+    """
+    del self._count, self._keys, self._values
+    self._shm.close()
+    if self._owner:
+      self._shm.unlink()
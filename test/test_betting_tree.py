@@ -0,0 +1,87 @@
+import unittest, random, tempfile, shutil, os, io, contextlib
+
+import torch
+import numpy as np
+
+from betting_tree import BettingTree
+from cfr import *
+from test_utils import build_small_betting_tree, small_tree_constants
+
+
+class BettingTreeTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    # The engine is compared against a small tree, so it uses the same action abstraction.
+    cls.folder = tempfile.mkdtemp()
+    cls.tree = build_small_betting_tree(cls.folder)
+    cls.constants = small_tree_constants()
+    cls.constants.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.constants.stop()
+    shutil.rmtree(cls.folder)
+
+  def test_save_load(self):
+    # The arrays are memory-mapped rather than read into each process.
+    for name in BettingTree.ARRAY_NAMES:
+      self.assertIsInstance(getattr(self.tree, name), np.memmap)
+      self.assertFalse(getattr(self.tree, name).flags.writeable)
+
+    # A saved tree is loaded instead of built again, unless saving it didn't finish.
+    folder = os.path.join(self.folder, "copy")
+    self.tree.save(folder)
+    for expected in ("Loaded", "Built"):
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        tree = BettingTree.load_or_build(folder)
+      self.assertIn(expected, output.getvalue())
+      for name in BettingTree.ARRAY_NAMES:
+        self.assertTrue(np.array_equal(getattr(tree, name), getattr(self.tree, name)))
+      os.remove(os.path.join(folder, "roots.npy"))
+
+  def test_roots(self):
+    for sb_index in (0, 1):
+      round_state = create_new_round(sb_index, state_type="tree", betting_tree=self.tree)
+      self.assertEqual(round_state.button, sb_index)
+      self.assertEqual(round_state.street, 0)
+      self.assertEqual(round_state.pips[sb_index], 1)
+      self.assertEqual(round_state.pips[1 - sb_index], 2)
+      self.assertEqual(round_state.stacks[sb_index], 199)
+      self.assertEqual(round_state.stacks[1 - sb_index], 198)
+
+  def test_matches_engine(self):
+    random.seed(123)
+    precomputed_ev = {0: [0.5, 0.5], 3: [0.5, 0.5], 4: [0.5, 0.5], 5: [0.5, 0.5]}
+
+    for k in range(500):
+      round_state = create_new_round(k % 2, state_type="compact")
+      tree_state = self.tree.root_state(round_state)
+
+      while True:
+        actions, mask = make_actions(round_state)
+        tree_actions, tree_mask = make_actions(tree_state)
+        self.assertEqual(actions, tree_actions)
+        self.assertTrue((mask == tree_mask).all())
+
+        self.assertEqual(round_state.button, tree_state.button)
+        self.assertEqual(round_state.street, tree_state.street)
+        self.assertEqual(list(round_state.pips), tree_state.pips)
+        self.assertEqual(list(round_state.stacks), tree_state.stacks)
+
+        infoset = make_infoset(round_state, 0, True, precomputed_ev)
+        tree_infoset = make_infoset(tree_state, 0, True, precomputed_ev)
+        self.assertTrue((infoset.bet_history_vec == tree_infoset.bet_history_vec).all())
+
+        action = random.choice([a for i, a in enumerate(actions) if mask[i] > 0])
+        round_state = round_state.proceed(action)
+        tree_state = tree_state.proceed(action)
+
+        if isinstance(round_state, TerminalState):
+          self.assertTrue(isinstance(tree_state, TerminalState))
+          self.assertEqual(round_state.deltas, tree_state.deltas)
+          break
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,10 +1,15 @@
-import unittest, shutil, os, random
+import unittest, shutil, os, random, threading, tempfile
 from constants import Constants
 from traverse import create_new_round, make_infoset, make_precomputed_ev
-from engine import CallAction
-from cfr import RegretMatchedStrategy, traverse_cfr
+from engine import CallAction, CheckAction
+from cfr import RegretMatchedStrategy, traverse_cfr, create_deals, round_state_from_deal, InfoSetBuilder, \
+                make_actions, make_bet_history_vec, PrecomputedEv, EV_CALCULATOR, traverse_cfr_iterative, \
+                TraverseScratch, thread_scratch
+from engine import TerminalState
+from test_utils import build_small_betting_tree
 
 import torch
+import numpy as np
 
 
 class CFRTest(unittest.TestCase):
@@ -44,6 +49,30 @@ class CFRTest(unittest.TestCase):
     rm.load(save_path)
     self.assertEqual(rm.size(), 2)
 
+  def test_merge_sharded(self):
+    if os.path.exists("./memory/test_cfr_sharded"):
+      shutil.rmtree("./memory/test_cfr_sharded")
+
+    random.seed(123)
+    infosets = [make_infoset(create_new_round(k % 2), k % 2, True) for k in range(20)]
+    rm = RegretMatchedStrategy()
+    for infoset in infosets:
+      rm.add_regret(infoset, torch.ones(Constants.NUM_ACTIONS))
+
+    # Two workers merge into the same sharded checkpoint, starting from different shards.
+    save_path = "./memory/test_cfr_sharded/regrets_0.npz"
+    locks = [threading.Lock() for _ in range(4)]
+    rm.merge_and_save(save_path, locks, num_shards=4, first_shard=0)
+    rm.merge_and_save(save_path, locks, num_shards=4, first_shard=3)
+
+    merged = RegretMatchedStrategy()
+    merged.load(save_path, num_shards=4)
+    self.assertEqual(merged.size(), rm.size())
+    for infoset in infosets:
+      self.assertTrue(torch.equal(merged.get_strategy(infoset, torch.ones(Constants.NUM_ACTIONS)),
+                                  rm.get_strategy(infoset, torch.ones(Constants.NUM_ACTIONS))))
+    self.assertEqual(merged._regrets.values().max(), 2 * rm._regrets.values().max())
+
   def test_traverse_cfr(self):
     regrets = {
       0: RegretMatchedStrategy(),
@@ -66,5 +95,157 @@ class CFRTest(unittest.TestCase):
         print("AVG STRATEGY:", avg_strategy.size())
 
 
+class TraverseCfrIterativeTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    # Tree states walk a small tree, which has the same kinds of nodes as the full one.
+    cls.folder = tempfile.mkdtemp()
+    cls.tree = build_small_betting_tree(cls.folder)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.folder)
+
+  def traverse(self, fn, state_type):
+    random.seed(5)
+    torch.manual_seed(5)
+    regrets = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
+    strategies = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
+    infos, ctr = [], [0]
+    for k, deal in enumerate(create_deals(33, 5)):
+      round_state = round_state_from_deal(deal, k % 2, state_type=state_type, betting_tree=self.tree)
+      do_external_sampling = k < 30
+      if not do_external_sampling:
+        # Full traversals are too big from the start, so check or call down to the turn first.
+        while round_state.street < 4:
+          actions, mask = make_actions(round_state)
+          round_state = round_state.apply(next(a for a, m in zip(actions, mask)
+                                               if m > 0 and isinstance(a, (CallAction, CheckAction))))
+      precomputed_ev = make_precomputed_ev(round_state)
+      info = fn(round_state, k % 2, k % 2, regrets, strategies, k, torch.ones(2), precomputed_ev, rctr=ctr,
+                do_external_sampling=do_external_sampling, skip_unreachable_actions=(k % 3 == 0))
+      infos.append(torch.stack([info.strategy_ev, info.best_response_ev, info.exploitability]))
+    return regrets, strategies, torch.stack(infos), ctr[0]
+
+  def test_matches_recursive(self):
+    for state_type in ("namedtuple", "mutable", "compact", "tree"):
+      expected = self.traverse(traverse_cfr, state_type)
+      actual = self.traverse(traverse_cfr_iterative, state_type)
+
+      # The same nodes are visited, with bit for bit the same values and table updates.
+      self.assertEqual(actual[3], expected[3])
+      self.assertTrue(torch.equal(actual[2], expected[2]))
+      for tables, expected_tables in zip(actual[:2], expected[:2]):
+        for plyr in (0, 1):
+          table, expected_table = tables[plyr]._regrets, expected_tables[plyr]._regrets
+          self.assertGreater(len(table), 0)
+          self.assertTrue(np.array_equal(table.keys(), expected_table.keys()))
+          self.assertTrue(np.array_equal(table.values(), expected_table.values()))
+
+  def test_scratch(self):
+    # Each thread gets its own scratch by default.
+    scratches = []
+    thread = threading.Thread(target=lambda: scratches.append(thread_scratch()))
+    thread.start()
+    thread.join()
+    self.assertIsNot(scratches[0], thread_scratch())
+    self.assertIs(thread_scratch(), thread_scratch())
+
+    # A scratch from the caller gives the same result, and is released afterwards.
+    round_state = round_state_from_deal(create_deals(1, 9)[0], 0)
+    precomputed_ev = make_precomputed_ev(round_state, lazy=False)
+    results = []
+    for scratch in (None, TraverseScratch(max_depth=2)):
+      torch.manual_seed(9)
+      random.seed(9)
+      regrets = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
+      strategies = { 0: RegretMatchedStrategy(), 1: RegretMatchedStrategy() }
+      info = traverse_cfr_iterative(round_state, 0, 0, regrets, strategies, 1, torch.ones(2), precomputed_ev,
+                                    scratch=scratch)
+      results.append(torch.stack([info.strategy_ev, info.best_response_ev, info.exploitability]))
+      if scratch is not None:
+        self.assertFalse(scratch.in_use)
+        self.assertGreater(scratch.max_depth, 2)
+    self.assertTrue(torch.equal(results[0], results[1]))
+
+    # A scratch can't be shared by two traversals at once.
+    scratch = TraverseScratch()
+    with scratch.use():
+      with self.assertRaises(AssertionError):
+        traverse_cfr_iterative(round_state, 0, 0, regrets, strategies, 1, torch.ones(2), precomputed_ev,
+                               scratch=scratch)
+    self.assertFalse(scratch.in_use)
+
+
+class PrecomputedEvTest(unittest.TestCase):
+  def test_lazy(self):
+    round_state = round_state_from_deal(create_deals(1, 3)[0], 0)
+    precomputed_ev = make_precomputed_ev(round_state)
+    self.assertEqual(precomputed_ev.num_computed, 0)
+
+    # Preflop infosets only need the preflop ev of the acting player.
+    infoset = make_infoset(round_state, 0, True, precomputed_ev)
+    self.assertEqual(precomputed_ev.num_computed, 1)
+    self.assertEqual(infoset.ev, EV_CALCULATOR.calc(precomputed_ev.hands[0], b"", b"", 1))
+    self.assertEqual(precomputed_ev[0][0], infoset.ev)
+    self.assertEqual(precomputed_ev.num_computed, 1)
+
+    river = str.encode("".join([str(c) for c in round_state.deck.peek(5)]))
+    self.assertEqual(precomputed_ev[5][1], EV_CALCULATOR.calc(precomputed_ev.hands[1], river, b"", 1326))
+    self.assertEqual(precomputed_ev.num_computed, 2)
+    self.assertEqual(precomputed_ev.num_skipped(), PrecomputedEv.NUM_ENTRIES - 2)
+
+    # Filling in the rest keeps what was already computed.
+    precomputed_ev.compute_all()
+    self.assertEqual(precomputed_ev.num_computed, PrecomputedEv.NUM_ENTRIES)
+    self.assertEqual(precomputed_ev[0][0], infoset.ev)
+    eager = make_precomputed_ev(round_state, lazy=False)
+    self.assertEqual(eager.num_skipped(), 0)
+    for player_idx in (0, 1):
+      self.assertEqual(eager[5][player_idx], precomputed_ev[5][player_idx])
+
+
+class CreateDealsTest(unittest.TestCase):
+  def test_create_deals(self):
+    deals = create_deals(1000, [7, 0])
+    self.assertEqual(deals.shape, (1000, 9))
+    self.assertTrue((deals == create_deals(1000, [7, 0])).all())
+    self.assertFalse((deals == create_deals(1000, [7, 1])).all())
+
+    # Every deal uses 9 different cards.
+    for deal in deals:
+      self.assertEqual(len(set(deal.tolist())), 9)
+
+  def test_round_state_from_deal(self):
+    for k, deal in enumerate(create_deals(100, 123)):
+      round_state = round_state_from_deal(deal, k % 2)
+      self.assertEqual(round_state.button, k % 2)
+      board = round_state.deck.peek(5)
+      self.assertEqual(len(round_state.deck.cards), 48)
+      self.assertEqual(len(set(round_state.hands[0] + round_state.hands[1] + board)), 9)
+      self.assertEqual(len(set(round_state.hands[0] + round_state.hands[1] + round_state.deck.cards)), 52)
+
+
+class InfoSetBuilderTest(unittest.TestCase):
+  def test_matches_bet_history(self):
+    random.seed(123)
+    for k in range(200):
+      round_state = create_new_round(k % 2, state_type=("namedtuple", "mutable", "compact")[k % 3])
+      builder = InfoSetBuilder(round_state)
+      path = []
+
+      while not isinstance(round_state, TerminalState):
+        self.assertTrue((builder.bet_history_vec == make_bet_history_vec(round_state.bet_history)).all())
+        actions, mask = make_actions(round_state)
+        action = random.choice([a for i, a in enumerate(actions) if mask[i] > 0])
+        path.append((round_state, builder.bet_history_vec.clone()))
+        round_state = builder.apply(round_state, action)
+
+      # Undoing every action restores the vector at each node along the way.
+      for parent, bet_history_vec in reversed(path):
+        builder.undo(parent)
+        self.assertTrue((builder.bet_history_vec == bet_history_vec).all())
+
+
 if __name__ == "__main__":
   unittest.main()
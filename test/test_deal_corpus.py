@@ -0,0 +1,142 @@
+import unittest, os, shutil, io, contextlib, threading, argparse
+
+import numpy as np
+
+from cfr import create_deals, round_state_from_deal, make_infoset, PrecomputedEv, EV_CALCULATOR
+from pbots_calc import river_equity
+from deal_corpus import build_deal_corpus, DealCorpus, DealProducer, WorkerDeals, deal_evs
+
+
+CORPUS_FOLDER = "./memory/test_deal_corpus/"
+
+
+class DealCorpusTest(unittest.TestCase):
+  def setUp(self):
+    if os.path.exists(CORPUS_FOLDER):
+      shutil.rmtree(CORPUS_FOLDER)
+
+  def test_build_and_read(self):
+    filename = os.path.join(CORPUS_FOLDER, "corpus.npy")
+    build_deal_corpus(filename, 25, seed=4, num_procs=2, chunk_size=10)
+
+    corpus = DealCorpus(filename)
+    self.assertEqual(len(corpus), 25)
+    for chunk_idx, start in enumerate((0, 10, 20)):
+      deals = create_deals(min(10, 25 - start), [4, chunk_idx])
+      self.assertTrue((corpus.rows["deal"][start:start+len(deals)] == deals).all())
+
+    for row in corpus.rows:
+      round_state = round_state_from_deal(row["deal"], 0)
+      precomputed_ev = PrecomputedEv.from_array(round_state, row["ev"])
+      hand = [str(c) for c in round_state.hands[1]]
+      board = [str(c) for c in round_state.deck.peek(5)]
+      self.assertAlmostEqual(precomputed_ev[5][1], river_equity(hand, board), places=6)
+      self.assertAlmostEqual(precomputed_ev[0][1], EV_CALCULATOR.calc(hand, b"", b"", 1), places=6)
+      self.assertEqual(make_infoset(round_state, 1, False, precomputed_ev).ev, precomputed_ev[0][1])
+      # Nothing is computed when the equities come from the corpus.
+      self.assertEqual(precomputed_ev.num_computed, 0)
+
+    # Workers get disjoint slices, and wrap around within their own slice.
+    self.assertEqual(corpus.worker_slice(0, 2), (0, 12))
+    self.assertEqual(corpus.worker_slice(1, 2), (12, 25))
+    rows = corpus.read(1, 2, 10, 5)
+    self.assertTrue((rows["deal"] == corpus.rows["deal"][[22, 23, 24, 12, 13]]).all())
+
+    # Reading past the end of the slice warns that deals are being reused.
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      corpus.read(1, 2, 0, 13)
+    self.assertEqual(output.getvalue(), "")
+    with contextlib.redirect_stdout(output):
+      corpus.read(1, 2, 10, 5)
+    self.assertIn("WARNING", output.getvalue())
+
+
+class DealProducerTest(unittest.TestCase):
+  def test_in_order(self):
+    deals = create_deals(20, 5)
+    producer = DealProducer(deals, 2, 4)
+    for deal in deals:
+      evs = producer.get()
+      self.assertLessEqual(producer.queue_depth(), 4)
+      # Preflop and river equities are deterministic.
+      expected = deal_evs(deal)
+      self.assertTrue(np.array_equal(evs[[0, 3]], expected[[0, 3]]))
+    self.assertGreaterEqual(producer.stall_time, 0)
+    producer.close()
+
+  def test_close_early(self):
+    # Closing while the feeder is blocked on a full queue stops it cleanly.
+    errors = []
+    hook, threading.excepthook = threading.excepthook, errors.append
+    try:
+      producer = DealProducer(create_deals(50, 6), 1, 2)
+      producer.get()
+      producer.close()
+    finally:
+      threading.excepthook = hook
+    self.assertFalse(producer._feeder.is_alive())
+    self.assertEqual(producer.queue_depth(), 0)
+    self.assertEqual(errors, [])
+
+
+class WorkerDealsTest(unittest.TestCase):
+  def make_opt(self, **kwargs):
+    opt = dict(DEAL_CORPUS_PATH=None, DEAL_SEED=None, EV_PRODUCER_THREADS=0, EV_QUEUE_SIZE=4,
+               NUM_TRAVERSE_WORKERS=2, ROUND_STATE_TYPE="namedtuple")
+    opt.update(kwargs)
+    return argparse.Namespace(**opt)
+
+  def test_corpus(self):
+    if os.path.exists(CORPUS_FOLDER):
+      shutil.rmtree(CORPUS_FOLDER)
+    filename = os.path.join(CORPUS_FOLDER, "corpus.npy")
+    build_deal_corpus(filename, 40, seed=4, num_procs=1, chunk_size=40)
+    corpus = DealCorpus(filename)
+
+    # Pass (t=1, player 1) of worker 1 reads rows 3 * 4 to 4 * 4 of its slice.
+    opt = self.make_opt(DEAL_CORPUS_PATH=filename, EV_PRODUCER_THREADS=2)
+    with WorkerDeals(opt, 1, 1, 1, 4, first_sb_player=1) as rounds:
+      self.assertIsNone(rounds.producer)
+      played = list(rounds)
+    self.assertEqual([sb for sb, _, _ in played], [1, 0, 1, 0])
+    for i, (sb, round_state, precomputed_ev) in enumerate(played):
+      row = corpus.rows[20 + 12 + i]
+      self.assertEqual(round_state.hands, round_state_from_deal(row["deal"], sb).hands)
+      self.assertEqual(precomputed_ev.num_computed, 0)
+
+    # Without the corpus, the same pass is dealt from the seed.
+    with WorkerDeals(opt, 1, 1, 1, 4, use_corpus=False, seed_extra=(1,)) as rounds:
+      self.assertIsNone(rounds.corpus_rows)
+      self.assertIsNotNone(rounds.producer)
+
+  def test_seeded(self):
+    opt = self.make_opt(DEAL_SEED=3, EV_PRODUCER_THREADS=2)
+    with WorkerDeals(opt, 0, 2, 0, 6) as rounds:
+      played = list(rounds)
+      self.assertEqual(rounds.queue_depth(), 0)
+      self.assertGreaterEqual(rounds.stall_time(), 0)
+    deals = create_deals(6, [3, 2, 0, 0])
+    for k, (sb, round_state, precomputed_ev) in enumerate(played):
+      self.assertEqual(sb, k % 2)
+      self.assertEqual(round_state.hands, round_state_from_deal(deals[k], sb).hands)
+      # River equity is deterministic.
+      self.assertTrue(np.array_equal(precomputed_ev.to_array()[3], deal_evs(deals[k])[3]))
+
+    # Without the producer, the traversal computes the equities itself.
+    with WorkerDeals(self.make_opt(DEAL_SEED=3), 0, 2, 0, 2) as rounds:
+      self.assertIsNone(rounds.producer)
+      _, round_state, precomputed_ev = next(iter(rounds))
+      self.assertEqual(round_state.hands, round_state_from_deal(deals[0], 0).hands)
+
+  def test_closes_on_error(self):
+    opt = self.make_opt(EV_PRODUCER_THREADS=1, EV_QUEUE_SIZE=2)
+    with self.assertRaises(RuntimeError):
+      with WorkerDeals(opt, 0, 0, 0, 50) as rounds:
+        next(iter(rounds))
+        raise RuntimeError()
+    self.assertFalse(rounds.producer._feeder.is_alive())
+
+
+if __name__ == "__main__":
+  unittest.main()
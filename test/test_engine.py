@@ -0,0 +1,145 @@
+import unittest, random
+
+import eval7
+
+from engine import *
+
+
+def make_round_state(sb_index):
+  deck = eval7.Deck()
+  deck.shuffle()
+  hands = [deck.deal(2), deck.deal(2)]
+  pips = [SMALL_BLIND, BIG_BLIND]
+  stacks = [STARTING_STACK - SMALL_BLIND, STARTING_STACK - BIG_BLIND]
+  if sb_index == 1:
+    pips.reverse()
+    stacks.reverse()
+  return RoundState(sb_index, 0, pips, stacks, hands, deck, None, [[1, 2]], sb_index)
+
+
+def random_action(round_state):
+  legal = list(round_state.legal_actions())
+  action_type = legal[random.randint(0, len(legal) - 1)]
+  if action_type == RaiseAction:
+    min_raise, max_raise = round_state.raise_bounds()
+    return RaiseAction(random.randint(min_raise, max_raise))
+  return action_type()
+
+
+def same_state(a, b):
+  return a.button == b.button and a.street == b.street and list(a.pips) == list(b.pips) and \
+         list(a.stacks) == list(b.stacks) and \
+         [list(actions) for actions in a.bet_history] == [list(actions) for actions in b.bet_history]
+
+
+class MutableRoundStateTest(unittest.TestCase):
+  def test_apply_matches_proceed(self):
+    random.seed(123)
+    for k in range(500):
+      round_state = make_round_state(k % 2)
+      mutable = MutableRoundState.from_round_state(round_state)
+      num_applied = 0
+
+      while True:
+        action = random_action(round_state)
+        round_state = round_state.copy().proceed(action)
+        next_mutable = mutable.apply(action)
+        num_applied += 1
+
+        if isinstance(round_state, TerminalState):
+          self.assertTrue(isinstance(next_mutable, TerminalState))
+          self.assertEqual(round_state.deltas, next_mutable.deltas)
+          break
+
+        self.assertTrue(next_mutable is mutable)
+        self.assertTrue(same_state(round_state, mutable))
+
+      # Rolling back every action should bring us back to the start of the round.
+      for _ in range(num_applied):
+        mutable.undo()
+      self.assertTrue(same_state(make_round_state(k % 2), mutable))
+
+  def test_undo_restores_parent(self):
+    random.seed(456)
+    mutable = MutableRoundState.from_round_state(make_round_state(0))
+    mutable.apply(CallAction())
+    snapshot = mutable.to_round_state()
+
+    for _ in range(100):
+      child = mutable.apply(random_action(mutable))
+      mutable.undo()
+      self.assertTrue(same_state(snapshot, mutable))
+
+  def test_original_is_untouched(self):
+    round_state = make_round_state(1)
+    mutable = MutableRoundState.from_round_state(round_state)
+    mutable.apply(CallAction())
+    mutable.apply(CheckAction())
+    self.assertEqual(round_state.bet_history, [[1, 2]])
+    self.assertEqual(round_state.pips, [2, 1])
+
+
+class ShowdownWinnerTest(unittest.TestCase):
+  def test_cached_winner_matches_evaluator(self):
+    random.seed(321)
+    for k in range(300):
+      round_state = make_round_state(k % 2)
+      winner = get_showdown_winner(round_state.hands, round_state.deck.peek(5))
+      cached = round_state._replace(showdown_winner=winner)
+
+      # Check down to the showdown, with and without the cached winner.
+      for state in (round_state, cached, MutableRoundState.from_round_state(cached),
+                    CompactRoundState.from_round_state(cached)):
+        state = state.apply(CallAction())
+        while not isinstance(state, TerminalState):
+          state = state.apply(CheckAction())
+        self.assertEqual(state.deltas, [2 * winner, -2 * winner])
+
+
+class CompactRoundStateTest(unittest.TestCase):
+  def test_proceed_matches_round_state(self):
+    random.seed(789)
+    for k in range(500):
+      round_state = make_round_state(k % 2)
+      compact = CompactRoundState.from_round_state(round_state)
+
+      while True:
+        action = random_action(round_state)
+        round_state = round_state.copy().proceed(action)
+        parent = compact
+        parent_key = parent._key()
+        compact = compact.proceed(action)
+
+        # The parent state is never modified.
+        self.assertEqual(parent_key, parent._key())
+
+        if isinstance(round_state, TerminalState):
+          self.assertTrue(isinstance(compact, TerminalState))
+          self.assertEqual(round_state.deltas, compact.deltas)
+          break
+
+        self.assertTrue(same_state(round_state, compact))
+        self.assertTrue(compact.previous_state is None)
+
+  def test_keep_previous(self):
+    compact = CompactRoundState.from_round_state(make_round_state(0), keep_previous=True)
+    child = compact.proceed(CallAction())
+    self.assertTrue(child.previous_state is compact)
+    self.assertTrue(child.proceed(CheckAction()).previous_state.previous_state is child)
+
+  def test_hash(self):
+    a = CompactRoundState.from_round_state(make_round_state(0))
+    b = CompactRoundState.from_round_state(make_round_state(0))
+    self.assertEqual(hash(a), hash(b))
+    self.assertEqual(a, b)
+    self.assertEqual(len({a.proceed(CallAction()), b.proceed(CallAction()), a.proceed(RaiseAction(4))}), 2)
+
+    # The cards (and the showdown winner that comes from them) don't matter.
+    c = CompactRoundState.from_round_state(make_round_state(0)._replace(showdown_winner=0))
+    d = CompactRoundState.from_round_state(make_round_state(0)._replace(showdown_winner=1))
+    self.assertEqual(hash(c), hash(d))
+    self.assertEqual(c, d)
+
+
+if __name__ == "__main__":
+  unittest.main()
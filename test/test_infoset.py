@@ -3,7 +3,9 @@ import time, unittest, random
 import torch
 
 from memory_buffer import MemoryBuffer
-from infoset import EvInfoSet, unpack_ev_infoset, bucket_small, bucket_small_join
+from infoset import EvInfoSet, unpack_ev_infoset, bucket_small, bucket_small_join, bucket_small_split, \
+                    bucket_small_pack, bucket_small_unpack, bucket_small_key, bucket_small_batch, \
+                    bucket_small_cache_info, EvInfoSetBatch, unpack_ev_infoset_batch
 from cfr import *
 from utils import encode_cards_rank_suit
 
@@ -394,7 +396,140 @@ class BucketTest(unittest.TestCase):
     infoset = make_infoset(round_state, 0, False)
     bucket = bucket_small(infoset)
     print(bucket_small_join(bucket))
-    
+
+
+
+class EvInfoSetBatchTest(unittest.TestCase):
+  def test_matches_infosets(self):
+    random.seed(123)
+    infosets = []
+    for k in range(20):
+      round_state = create_new_round(k % 2)
+      round_state = round_state.proceed(CallAction())
+      round_state = round_state.proceed(RaiseAction(random.randint(2, 20)))
+      infosets.append(make_infoset(round_state, k % 2, k % 2 == 0, {0: [0.3, 0.7]}))
+
+    batch = EvInfoSetBatch.from_infosets(infosets)
+    self.assertEqual(len(batch), 20)
+    self.assertEqual(batch.get_ev_input_tensors().shape, (20, 1))
+
+    bets_input, position_mask = batch.get_bet_input_tensors()
+    normalized = batch.get_normalized_bet_input_tensors()
+    for i, infoset in enumerate(infosets):
+      self.assertTrue(torch.allclose(batch.get_ev_input_tensors()[i], infoset.get_ev_input_tensors()[0]))
+      row_bets, row_mask = infoset.get_bet_input_tensors()
+      self.assertTrue((bets_input[i] == row_bets[0]).all())
+      self.assertTrue((position_mask[i] == row_mask).all())
+
+      cumul_pot = torch.cumsum(row_bets, dim=1)
+      cumul_pot[cumul_pot == 0] = 1
+      self.assertTrue(torch.allclose(normalized[i], (row_bets * row_mask / cumul_pot)[0]))
+
+  def test_pack_unpack(self):
+    infosets = [EvInfoSet(0.25 * i, torch.arange(2 + Constants.BET_HISTORY_SIZE).float(), i % 2, i % 4)
+                for i in range(4)]
+    packed = EvInfoSetBatch.from_infosets(infosets).pack()
+    self.assertEqual(packed.shape, (4, Constants.INFO_SET_SIZE))
+
+    for i, infoset in enumerate(infosets):
+      self.assertTrue((packed[i] == infoset.pack()).all())
+      unpacked = unpack_ev_infoset(packed[i])
+      self.assertEqual(unpacked.street, infoset.street)
+      self.assertEqual(unpacked.player_position, infoset.player_position)
+
+    batch = unpack_ev_infoset_batch(packed)
+    self.assertTrue((batch[1:3].pack() == packed[1:3]).all())
+
+
+class BucketSmallKeyTest(unittest.TestCase):
+  def test_pack_unpack(self):
+    random.seed(123)
+    keys = {}
+
+    for k in range(200):
+      round_state = create_new_round(k % 2)
+      precomputed_ev = {s: [random.random(), random.random()] for s in (0, 3, 4, 5)}
+
+      while not isinstance(round_state, TerminalState):
+        active_plyr_idx = round_state.button % 2
+        infoset = make_infoset(round_state, active_plyr_idx, active_plyr_idx == k % 2, precomputed_ev)
+        bucket = bucket_small(infoset)
+        bstring = bucket_small_join(bucket)
+        key = bucket_small_pack(bucket)
+
+        self.assertEqual(bucket_small_unpack(key), bucket)
+        self.assertEqual(bucket_small_split(bstring), bucket)
+        self.assertLess(key, 1 << 25)
+
+        # Different buckets never share a key.
+        self.assertEqual(keys.setdefault(key, bstring), bstring)
+
+        actions, mask = make_actions(round_state)
+        round_state = round_state.proceed(random.choice([a for i, a in enumerate(actions) if mask[i] > 0]))
+
+  def test_cached_key(self):
+    random.seed(456)
+    round_state = create_new_round(0)
+
+    for ev in (0.1, 0.45, 0.7, 0.95):
+      infoset = make_infoset(round_state, 0, True, {0: [ev, ev]})
+      self.assertEqual(bucket_small_key(infoset), bucket_small_pack(bucket_small(infoset)))
+
+    # Only the EV changed, so every lookup after the first is a hit.
+    hits = bucket_small_cache_info().hits
+    for _ in range(10):
+      infoset = make_infoset(round_state, 0, True, {0: [random.random(), 0]})
+      self.assertEqual(bucket_small_key(infoset), bucket_small_pack(bucket_small(infoset)))
+    self.assertEqual(bucket_small_cache_info().hits, hits + 10)
+
+  def test_convert_bucket_keys(self):
+    bstring = "SB.F.H2|x.R.x.x|x.x.x.x|CK.HP.x.x"
+    regrets = convert_bucket_keys({bstring: torch.ones(Constants.NUM_ACTIONS)})
+    key = bucket_small_pack(bucket_small_split(bstring))
+    self.assertEqual(list(regrets.keys()), [key])
+    self.assertTrue(convert_bucket_keys(regrets) is regrets)
+
+
+class BucketSmallBatchTest(unittest.TestCase):
+  def test_matches_scalar(self):
+    random.seed(123)
+    packed = []
+
+    # Random raise sizes (not just the abstract ones) so that wrapped raises and folds show up too.
+    for k in range(300):
+      round_state = create_new_round(k % 2)
+      precomputed_ev = {s: [random.random(), random.random()] for s in (0, 3, 4, 5)}
+
+      while not isinstance(round_state, TerminalState):
+        active_plyr_idx = round_state.button % 2
+        infoset = make_infoset(round_state, active_plyr_idx, active_plyr_idx == k % 2, precomputed_ev)
+        packed.append(infoset.pack())
+
+        legal = list(round_state.legal_actions())
+        action_type = random.choice(legal)
+        if action_type == RaiseAction:
+          min_raise, max_raise = round_state.raise_bounds()
+          action = RaiseAction(random.randint(min_raise, min(max_raise, min_raise + 20)))
+        else:
+          action = action_type()
+        round_state = round_state.proceed(action)
+
+    packed = torch.stack(packed)
+    keys = bucket_small_batch(packed)
+    self.assertEqual(keys.shape, (len(packed),))
+
+    for i in range(len(packed)):
+      self.assertEqual(int(keys[i]), bucket_small_key(unpack_ev_infoset(packed[i])))
+
+  def test_bucket_boundaries(self):
+    round_state = create_new_round(0)
+    packed = []
+    for ev in (0.0, 0.39, 0.4, 0.59, 0.6, 0.79, 0.8, 1.0):
+      packed.append(make_infoset(round_state, 0, True, {0: [ev, ev]}).pack())
+    packed = torch.stack(packed)
+    expected = [bucket_small_key(unpack_ev_infoset(p)) for p in packed]
+    self.assertEqual(bucket_small_batch(packed).tolist(), expected)
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,63 @@
+import unittest, random, itertools
+
+from isomorphism import *
+
+
+DECK = [r + s for r in RANKS for s in SUITS]
+
+
+def relabel(cards, perm):
+  return [c[0] + SUITS[perm[SUITS.index(c[1])]] for c in cards]
+
+
+class IsomorphismTest(unittest.TestCase):
+  def test_num_classes(self):
+    # Known counts for 2 hole cards and a board of 0, 3, 4, or 5 cards.
+    self.assertEqual(NUM_CANONICAL_CLASSES[0], 169)
+    self.assertEqual(NUM_CANONICAL_CLASSES[3], 1286792)
+    self.assertEqual(NUM_CANONICAL_CLASSES[4], 13960050)
+    self.assertEqual(NUM_CANONICAL_CLASSES[5], 123156254)
+
+  def test_preflop_dense(self):
+    indices = set(canonical_index(list(hand), []) for hand in itertools.combinations(DECK, 2))
+    self.assertEqual(indices, set(range(169)))
+
+  def test_invariant_to_suits_and_order(self):
+    rng = random.Random(123)
+    for _ in range(2000):
+      board_size = rng.choice([0, 3, 4, 5])
+      cards = rng.sample(DECK, 2 + board_size)
+      hand, board = cards[:2], cards[2:]
+      perm = list(range(4))
+      rng.shuffle(perm)
+      hand2, board2 = relabel(hand, perm), relabel(board, perm)
+      rng.shuffle(hand2)
+      rng.shuffle(board2)
+
+      index = canonical_index(hand, board)
+      self.assertTrue(0 <= index < NUM_CANONICAL_CLASSES[{0: 0, 3: 3, 4: 4, 5: 5}[board_size]])
+      self.assertEqual(index, canonical_index(hand2, board2))
+      self.assertEqual(canonicalize(hand, board), canonicalize(hand2, board2))
+
+  def test_index_matches_canonical_form(self):
+    # Two spots share an index exactly when they have the same canonical form.
+    rng = random.Random(456)
+    for board_size in (3, 4, 5):
+      by_index, by_form = {}, {}
+      for _ in range(5000):
+        # Only a few ranks, so that plenty of spots collide.
+        cards = rng.sample([r + s for r in "2345" for s in SUITS], 2 + board_size)
+        hand, board = cards[:2], cards[2:]
+        index = canonical_index(hand, board)
+        form = str(canonicalize(hand, board))
+        self.assertEqual(by_index.setdefault(index, form), form)
+        self.assertEqual(by_form.setdefault(form, index), index)
+
+  def test_canonical_id(self):
+    self.assertEqual(canonical_id(["Ac", "Ad"], []), canonical_index(["Ac", "Ad"], []))
+    self.assertEqual(canonical_id(["Ac", "Ad"], ["2c", "3c", "4c"]), 169 + canonical_index(["Ac", "Ad"], ["2c", "3c", "4c"]))
+    self.assertLess(canonical_id(["Ac", "Ad"], ["2c", "3c", "4c", "5c", "6c"]), NUM_CANONICAL_IDS)
+
+
+if __name__ == "__main__":
+  unittest.main()
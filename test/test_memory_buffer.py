@@ -5,6 +5,8 @@ from sys import getsizeof
 from memory_buffer import MemoryBuffer
 from utils import *
 from test_utils import make_dummy_ev_infoset
+from constants import Constants
+from infoset import EvInfoSetBatch
 
 import torch
 
@@ -42,7 +44,7 @@ class MemoryBufferTest(unittest.TestCase):
     # Make sure the folder doesn't exist so the manifest has to be created.
     if os.path.exists("./memory/memory_buffer_test/"):
       shutil.rmtree("./memory/memory_buffer_test/")
-    info_set_size = 1 + 1 + 24
+    info_set_size = Constants.INFO_SET_SIZE
     item_size = 64
     max_size = int(1e3)
 
@@ -57,6 +59,29 @@ class MemoryBufferTest(unittest.TestCase):
     # This should trigger the save and reset.
     mb.add(make_dummy_ev_infoset(), torch.zeros(item_size), 1234)
 
+  def test_add_batch(self):
+    info_set_size = Constants.INFO_SET_SIZE
+    item_size = 6
+    mb = MemoryBuffer(info_set_size, item_size, max_size=100)
+
+    infosets = EvInfoSetBatch.from_infosets([make_dummy_ev_infoset() for _ in range(30)])
+    mb.add_batch(infosets, torch.ones(30, item_size), torch.arange(30).float())
+    mb.add(make_dummy_ev_infoset(), torch.ones(item_size), 30)
+    self.assertEqual(mb.size(), 31)
+
+    batch, items, weights = mb.get_batch()
+    self.assertEqual(len(batch), 31)
+    self.assertTrue((batch.pack() == mb._infosets[:31]).all())
+    self.assertTrue((batch.pack()[0] == make_dummy_ev_infoset().pack()).all())
+    self.assertTrue((weights == torch.arange(31).float()).all())
+
+    # Without autosave, whatever doesn't fit is dropped.
+    mb.add_batch(infosets[:20], torch.ones(20, item_size), torch.ones(20))
+    mb.add_batch(infosets, torch.ones(30, item_size), torch.ones(30))
+    mb.add_batch(infosets, torch.ones(30, item_size), torch.ones(30))
+    self.assertEqual(mb.size(), 100)
+    self.assertTrue(mb.full())
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -4,12 +4,13 @@ import unittest, os, shutil
 from memory_buffer import MemoryBuffer
 from memory_buffer_dataset import MemoryBufferDataset
 from infoset import EvInfoSet
+from constants import Constants
 
 def make_dummy_ev_infoset():
   ev = 0.43
-  bet_history_vec = torch.ones(16)
+  bet_history_vec = torch.ones(2 + Constants.BET_HISTORY_SIZE)
   bet_history_vec[3:7] = 0
-  infoset = EvInfoSet(ev, bet_history_vec, 1)
+  infoset = EvInfoSet(ev, bet_history_vec, 1, 1)
   return infoset
 
 
@@ -19,7 +20,7 @@ class MemoryBufferDatasetTest(unittest.TestCase):
       shutil.rmtree("./memory/memory_buffer_test/")
 
     # Make a few saved memory buffers.
-    info_set_size = 1 + 1 + 16
+    info_set_size = Constants.INFO_SET_SIZE
     item_size = 6
     max_size = int(1e4)
     mb = MemoryBuffer(info_set_size, item_size, max_size=max_size)
@@ -63,6 +64,17 @@ class MemoryBufferDatasetTest(unittest.TestCase):
 
     print(dataset._weights)
 
+    # The batched inputs match the per-infoset ones.
+    infoset = make_dummy_ev_infoset()
+    bets_input, position_mask = infoset.get_bet_input_tensors()
+    cumul_pot = torch.cumsum(bets_input, dim=1)
+    cumul_pot[cumul_pot == 0] = 1
+    batch = dataset.get_batch(torch.arange(10))
+    self.assertEqual(batch["ev_input"].shape, (10, 1))
+    self.assertTrue(torch.allclose(batch["ev_input"][0], infoset.get_ev_input_tensors()[0]))
+    self.assertTrue(torch.allclose(batch["bets_input"][0], (bets_input * position_mask / cumul_pot)[0]))
+    self.assertTrue(torch.allclose(dataset[3]["bets_input"], batch["bets_input"][3]))
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -3,7 +3,8 @@ import torch
 
 from network import DeepEvModel
 from network_wrapper import NetworkWrapper
-from infoset import EvInfoSet
+from infoset import EvInfoSet, EvInfoSetBatch
+from constants import Constants
 from utils import *
 from test_utils import make_dummy_ev_infoset
 
@@ -17,6 +18,25 @@ class NetworkWrapperTest(unittest.TestCase):
     p = wrap.get_action_probabilities(infoset, valid_mask)
     self.assertEqual(p.shape, (4,))
 
+  def test_get_action_probabilities_batch(self):
+    nbets = 2 + Constants.BET_HISTORY_SIZE
+    wrap = NetworkWrapper(nbets, 4, ev_embed_dim=16, bet_embed_dim=64, device=torch.device("cpu"))
+
+    infosets = [make_dummy_ev_infoset() for _ in range(8)]
+    for i, infoset in enumerate(infosets):
+      infoset.ev = i / 8.0
+    valid_mask = torch.ones(8, 4)
+    valid_mask[::2, 0] = 0
+
+    p = wrap.get_action_probabilities_batch(EvInfoSetBatch.from_infosets(infosets), valid_mask)
+    self.assertEqual(p.shape, (8, 4))
+    for i in range(8):
+      self.assertAlmostEqual(p[i].sum().item(), 1.0, places=5)
+
+    # DeepEvModel normalizes over the whole batch, so only a batch of one matches the unbatched call.
+    p = wrap.get_action_probabilities_batch(EvInfoSetBatch.from_infosets(infosets[:1]), valid_mask[:1])
+    self.assertTrue(torch.allclose(p[0], wrap.get_action_probabilities(infosets[0], valid_mask[0])))
+
 
 class DeepEvModelTest(unittest.TestCase):
   def test_forward(self):
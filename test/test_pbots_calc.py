@@ -0,0 +1,224 @@
+import unittest, os, shutil, random, pickle
+import multiprocessing as mp
+
+import numpy as np
+
+import pbots_calc
+
+from pbots_calc import EquityCache, CalcWithLookup, calc, calc_many, set_calc_threads, river_equity, \
+                      calc_adaptive, make_preflop_table
+from isomorphism import RANKS, SUITS
+
+
+CACHE_FOLDER = "./memory/test_pbots_calc/"
+
+
+def random_hand_and_board(rng, board_size):
+  cards = rng.sample([r + s for r in RANKS for s in SUITS], 2 + board_size)
+  return cards[:2], cards[2:]
+
+
+def fill_cache(worker_id):
+  cache = EquityCache(os.path.join(CACHE_FOLDER, "shared.cache"), num_slots=2**12)
+  rng = random.Random(worker_id)
+  for _ in range(200):
+    hand, board = random_hand_and_board(rng, 3)
+    key = cache.key(hand, board)
+    cache.put(key, (key % 1000) / 1000.0)
+
+
+class EquityCacheTest(unittest.TestCase):
+  def setUp(self):
+    if os.path.exists(CACHE_FOLDER):
+      shutil.rmtree(CACHE_FOLDER)
+
+  def test_get_put(self):
+    filename = os.path.join(CACHE_FOLDER, "equity.cache")
+    cache = EquityCache(filename, num_slots=2**12)
+    rng = random.Random(123)
+    entries = {}
+    for _ in range(1000):
+      hand, board = random_hand_and_board(rng, rng.choice([3, 4, 5]))
+      key = cache.key(hand, board)
+      entries[key] = rng.random()
+      cache.put(key, entries[key])
+
+    # The key doesn't depend on card order or suit labels.
+    self.assertEqual(cache.key(["Kd", "As"], ["2c", "3c", "4c"]), cache.key(["As", "Kd"], ["4c", "2c", "3c"]))
+    self.assertEqual(cache.key(["Kd", "As"], ["2c", "3c", "4c"]), cache.key(["Kh", "Ac"], ["2s", "3s", "4s"]))
+    self.assertNotEqual(cache.key(["Kd", "As"], ["2c", "3c", "4c"]), cache.key(["Kd", "2c"], ["As", "3c", "4c"]))
+
+    # Entries survive reopening the file.
+    del cache
+    cache = EquityCache(filename)
+    self.assertEqual(cache.size(), len(entries))
+    for key, ev in entries.items():
+      self.assertEqual(cache.get(key), ev)
+    self.assertEqual(cache.get(cache.key(["Kd", "As"], ["2c", "3c", "4c", "5c", "6c"])), None)
+
+  def test_shared_by_processes(self):
+    with mp.Pool(4) as pool:
+      pool.map(fill_cache, range(4))
+
+    cache = EquityCache(os.path.join(CACHE_FOLDER, "shared.cache"))
+    expected = {}
+    for worker_id in range(4):
+      rng = random.Random(worker_id)
+      for _ in range(200):
+        hand, board = random_hand_and_board(rng, 3)
+        key = cache.key(hand, board)
+        expected[key] = (key % 1000) / 1000.0
+    self.assertEqual(cache.size(), len(expected))
+    for key, ev in expected.items():
+      self.assertEqual(cache.get(key), ev)
+
+  def test_calc_with_lookup(self):
+    calculator = CalcWithLookup(os.path.join(CACHE_FOLDER, "equity.cache"), cache_slots=2**12)
+    ev = calculator.calc(["Ac", "Ad"], b"2c3c4c", b"", 1000)
+    self.assertEqual(calculator.cache.misses, 1)
+
+    # Same hand and board in a different order, or with the suits relabelled, hits the cache.
+    self.assertEqual(calculator.calc(["Ad", "Ac"], b"3c4c2c", b"", 1000), ev)
+    self.assertEqual(calculator.calc(["As", "Ah"], b"2h3h4h", b"", 1000), ev)
+    self.assertEqual(calculator.cache.hits, 2)
+
+  def test_preflop_isomorphic(self):
+    calculator = CalcWithLookup()
+    self.assertIsNone(calculator._preflop_table)
+    self.assertEqual(calculator.calc(["Ac", "Kc"], b"", b"", 1), calculator.calc(["Kh", "Ah"], b"", b"", 1))
+    self.assertGreater(calculator.calc(["Ac", "Ad"], b"", b"", 1), calculator.calc(["7c", "2d"], b"", b"", 1))
+
+  def test_preflop_table(self):
+    os.makedirs(CACHE_FOLDER)
+    with open(os.path.join(os.path.dirname(__file__), "..", "preflop_odds.pkl"), "rb") as f:
+      preflop_odds = pickle.load(f)
+    table = make_preflop_table(preflop_odds)
+    self.assertEqual(table.dtype, np.float32)
+    self.assertEqual(table.shape, (169,))
+
+    # The table in the repo is up to date with the odds.
+    calculator = CalcWithLookup()
+    self.assertTrue(np.array_equal(calculator.preflop_table, table))
+
+    filename = os.path.join(CACHE_FOLDER, "preflop.npy")
+    np.save(filename, np.full(169, 0.25, dtype=np.float32))
+    calculator.set_preflop_path(filename)
+    self.assertEqual(calculator.calc(["Ac", "Ad"], b"", b"", 1), 0.25)
+
+
+class RiverEquityTest(unittest.TestCase):
+  def test_matches_enumeration(self):
+    # pbots_calc enumerates every opponent hand on the river once iters >= 990.
+    rng = random.Random(9)
+    for _ in range(100):
+      hand, board = random_hand_and_board(rng, 5)
+      expected = calc(str.encode("".join(hand) + ":xx"), str.encode("".join(board)), b"", 1326).ev[0]
+      self.assertEqual(river_equity(hand, board), expected)
+
+  def test_edge_cases(self):
+    # A royal flush on the board is always a tie.
+    self.assertEqual(river_equity(["2c", "3d"], ["As", "Ks", "Qs", "Js", "Ts"]), 0.5)
+    self.assertEqual(river_equity(["As", "Ks"], ["Qs", "Js", "Ts", "2c", "3d"]), 1.0)
+
+  def test_calc_with_lookup(self):
+    calculator = CalcWithLookup()
+    self.assertEqual(calculator.calc(["As", "Ks"], b"QsJsTs2c3d", b"", 1326), 1.0)
+    evs = calculator.calc_many([(["As", "Ks"], b"QsJsTs2c3d", b""), (["2c", "3d"], b"AsKsQsJsTs", b"")], 1326)
+    self.assertTrue(np.array_equal(evs, [1.0, 0.5]))
+
+
+class CalcAdaptiveTest(unittest.TestCase):
+  def test_stops_early(self):
+    # A clear favorite far from every boundary stops after the first run.
+    ev, iters = calc_adaptive(b"AcAd:xx", b"As7h2d", b"", 5000, 0.005, boundaries=(0.4, 0.6, 0.8))
+    self.assertGreater(ev, 0.9)
+    self.assertLess(iters, 5000)
+
+    # Without boundaries, it runs until the target standard error or max_iters.
+    ev, iters = calc_adaptive(b"AcAd:xx", b"As7h2d", b"", 5000, 0.0001)
+    self.assertEqual(iters, 312 + 1250 + 5000)
+
+  def test_calc_with_lookup(self):
+    calculator = CalcWithLookup()
+    calculator.set_adaptive(0.005, (0.4, 0.6, 0.8))
+    ev = calculator.calc(["Ac", "Ad"], b"As7h2d", b"", 5000)
+    self.assertGreater(ev, 0.9)
+    self.assertEqual(calculator.mc_calls, 1)
+    self.assertLess(calculator.mc_iters, 5000)
+
+    calculator.calc_many([(["Kc", "Kd"], b"As7h2d", b""), (["Kc", "Kd"], b"As7h2d8c", b"")], [5000, 4000])
+    self.assertEqual(calculator.mc_calls, 3)
+
+
+  def test_cache_only_full_precision(self):
+    if os.path.exists(CACHE_FOLDER):
+      shutil.rmtree(CACHE_FOLDER)
+    calculator = CalcWithLookup(os.path.join(CACHE_FOLDER, "equity.cache"), cache_slots=2**12)
+    calculator.set_adaptive(0.005, (0.4, 0.6, 0.8))
+
+    # An estimate that stopped early is only remembered in memory.
+    ev = calculator.calc(["Ac", "Ad"], b"As7h2d", b"", 5000)
+    self.assertEqual(calculator.cache.size(), 0)
+    self.assertEqual(calculator.calc(["Ac", "Ad"], b"As7h2d", b"", 5000), ev)
+    self.assertEqual(calculator.mc_calls, 1)
+
+    # A run that went to the full iters is cached.
+    calculator.calc_many([(["Kc", "Qc"], b"Jc9h2d", b"")], 250)
+    self.assertEqual(calculator.cache.size(), 1)
+
+
+class CalcManyTest(unittest.TestCase):
+  def tearDown(self):
+    set_calc_threads(1)
+
+  def test_calc_many(self):
+    rng = random.Random(7)
+    queries = []
+    for _ in range(20):
+      hand, board = random_hand_and_board(rng, 5)
+      queries.append((str.encode("".join(hand) + ":xx"), str.encode("".join(board)), b""))
+
+    # River equities are enumerated exactly, so they match calc no matter how many threads run them.
+    expected = np.array([calc(*q, 1000).ev[0] for q in queries])
+    for num_threads in (1, 4):
+      set_calc_threads(num_threads)
+      evs = calc_many(queries, 1000)
+      self.assertIsInstance(evs, np.ndarray)
+      self.assertTrue(np.array_equal(evs, expected))
+
+  def test_results_reused_and_freed(self):
+    queries = [(b"AcAd:xx", b"2c3c4c5d6d", b""), (b"KcKd:xx", b"2c3c4c5d6d", b"")] * 8
+    set_calc_threads(4)
+    calc_many(queries, 1000)
+    # One struct per pool thread (not per query), all freed when the pool is replaced.
+    self.assertLessEqual(len(pbots_calc._results_registry), 4)
+    set_calc_threads(2)
+    self.assertEqual(len(pbots_calc._results_registry), 0)
+    evs = calc_many(queries, 1000)
+    self.assertTrue(np.array_equal(evs, calc_many(queries[:2], 1000).tolist() * 8))
+
+  def test_calc_with_lookup_many(self):
+    set_calc_threads(4)
+    calculator = CalcWithLookup()
+    rng = random.Random(8)
+    queries = []
+    for board_size in (0, 3, 4, 5):
+      for _ in range(5):
+        hand, board = random_hand_and_board(rng, board_size)
+        queries.append((hand, str.encode("".join(board)), b""))
+    # Duplicates and isomorphic queries are only computed once.
+    queries.append((["As", "Ah"], b"2h3h4h5d6d", b""))
+    queries.append((["Ac", "Ad"], b"2c3c4c5h6h", b""))
+
+    evs = calculator.calc_many(queries, [1000] * len(queries))
+    self.assertEqual(len(evs), len(queries))
+    self.assertEqual(evs[-1], evs[-2])
+    for (hand, board, dead), ev in zip(queries, evs):
+      if len(board) in (0, 10):
+        self.assertEqual(calculator.calc(hand, board, dead, 1000), ev)
+      else:
+        self.assertTrue(0 <= ev <= 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,276 @@
+import unittest, os, sys, shutil, pickle, subprocess, tempfile
+import multiprocessing as mp
+
+import torch
+import numpy as np
+
+from constants import Constants
+from regret_table import RegretTable, SharedRegretTable, MappedRegretTable, sum_deltas, save_delta, apply_delta_files, \
+                         shard_filenames, shard_of, save_sharded, load_sharded, checkpoint_exists, \
+                         find_checkpoint
+from infoset import bucket_small_join, bucket_small_pack, BUCKET_SMALL_FIELDS
+
+
+TABLE_FOLDER = "./memory/test_regret_table/"
+
+
+class RegretTableTest(unittest.TestCase):
+  def setUp(self):
+    if os.path.exists(TABLE_FOLDER):
+      shutil.rmtree(TABLE_FOLDER)
+
+  def test_add(self):
+    table = RegretTable(Constants.NUM_ACTIONS, capacity=2)
+    for key in range(10):
+      table.add(key, np.full(Constants.NUM_ACTIONS, key, dtype=np.float32))
+    self.assertEqual(len(table), 10)
+    self.assertTrue((table.keys() == np.arange(10)).all())
+    self.assertTrue((table.get(7) == 7).all())
+    self.assertIsNone(table.get(10))
+    self.assertTrue((table.get(10, create=True) == 0).all())
+    self.assertEqual(len(table), 11)
+
+    # CFR+ clips the total at zero.
+    table.add(3, np.array([-5, 1, 0, 0, 0, -1], dtype=np.float32), clip=True)
+    self.assertTrue((table.get(3) == np.array([0, 4, 3, 3, 3, 2])).all())
+
+    table.add_rows(np.array([3, 100]), np.ones((2, Constants.NUM_ACTIONS), dtype=np.float32))
+    self.assertTrue((table.get(3) == np.array([1, 5, 4, 4, 4, 3])).all())
+    self.assertTrue((table.get(100) == 1).all())
+
+  def test_save_load(self):
+    table = RegretTable(Constants.NUM_ACTIONS)
+    rows = np.random.rand(3000, Constants.NUM_ACTIONS).astype(np.float32)
+    table.add_rows(np.arange(3000) * 13, rows)
+
+    for ext in (".npz", ".pkl"):
+      filename = os.path.join(TABLE_FOLDER, "table" + ext)
+      table.save(filename)
+      loaded = RegretTable.load(filename)
+      self.assertEqual(len(loaded), 3000)
+      self.assertTrue((loaded.keys() == table.keys()).all())
+      self.assertTrue((loaded.values() == rows).all())
+
+    # The legacy .pkl is a dict of tensors.
+    with open(os.path.join(TABLE_FOLDER, "table.pkl"), "rb") as f:
+      d = pickle.load(f)
+    self.assertTrue(torch.equal(d[13], torch.from_numpy(rows[1])))
+
+  def test_mapped(self):
+    table = RegretTable(Constants.NUM_ACTIONS)
+    rows = np.random.rand(3000, Constants.NUM_ACTIONS).astype(np.float32)
+    table.add_rows(np.arange(3000)[::-1] * 13, rows)
+
+    # Converts to and from the legacy pickle.
+    table.save(os.path.join(TABLE_FOLDER, "table.pkl"))
+    filename = os.path.join(TABLE_FOLDER, "table.rtab")
+    RegretTable.load(os.path.join(TABLE_FOLDER, "table.pkl")).save(filename)
+    mapped = RegretTable.load(filename)
+    self.assertIsInstance(mapped, MappedRegretTable)
+    self.assertEqual(len(mapped), 3000)
+    self.assertTrue((mapped.get(13) == rows[2998]).all())
+    self.assertIsNone(mapped.get(14))
+    self.assertEqual(mapped.to_dict().keys(), table.to_dict().keys())
+
+    # Changes (to existing and new keys) stay in memory until saved.
+    mapped.track_changes()
+    mapped.add(13, np.full(Constants.NUM_ACTIONS, -10, dtype=np.float32), clip=True)
+    mapped.add(14, np.ones(Constants.NUM_ACTIONS, dtype=np.float32))
+    mapped.add_rows(np.array([26, 15]), np.ones((2, Constants.NUM_ACTIONS), dtype=np.float32))
+    self.assertEqual(len(mapped), 3002)
+    self.assertTrue((mapped.get(13) == 0).all())
+    self.assertTrue((mapped.get(26) == rows[2997] + 1).all())
+    self.assertTrue((RegretTable.load(filename).get(13) == rows[2998]).all())
+    keys, values = mapped.delta()
+    self.assertEqual(sorted(keys.tolist()), [13, 14])
+    self.assertTrue((values[keys.tolist().index(13)] == -rows[2998]).all())
+
+    # Saving over the file that's mapped is safe.
+    mapped.save(filename)
+    loaded = RegretTable.load(filename)
+    self.assertEqual(len(loaded), 3002)
+    self.assertTrue((loaded.get(15) == 1).all())
+    self.assertTrue((loaded.get(26) == rows[2997] + 1).all())
+    loaded.save(os.path.join(TABLE_FOLDER, "back.pkl"))
+    self.assertEqual(len(RegretTable.load(os.path.join(TABLE_FOLDER, "back.pkl"))), 3002)
+
+    # An empty table.
+    RegretTable(Constants.NUM_ACTIONS).save(filename)
+    self.assertEqual(len(RegretTable.load(filename)), 0)
+
+  def test_load_string_keys(self):
+    key = bucket_small_pack([fields[-1] for fields in BUCKET_SMALL_FIELDS])
+    filename = os.path.join(TABLE_FOLDER, "old.pkl")
+    os.makedirs(TABLE_FOLDER)
+    with open(filename, "wb") as f:
+      pickle.dump({bucket_small_join([fields[-1] for fields in BUCKET_SMALL_FIELDS]): torch.ones(Constants.NUM_ACTIONS)}, f)
+    table = RegretTable.load(filename)
+    self.assertTrue((table.get(key) == 1).all())
+
+  def test_delta(self):
+    master = RegretTable(Constants.NUM_ACTIONS)
+    master.add_rows(np.arange(100), np.ones((100, Constants.NUM_ACTIONS), dtype=np.float32))
+    master.save(os.path.join(TABLE_FOLDER, "master.npz"))
+
+    # Two workers start from the master and each change a few rows.
+    filenames = []
+    for worker_id in range(2):
+      table = RegretTable.load(os.path.join(TABLE_FOLDER, "master.npz"))
+      table.track_changes()
+      table.get(500, create=True)
+      for key in (5, 50 + worker_id, 200 + worker_id):
+        table.add(key, np.full(Constants.NUM_ACTIONS, 2, dtype=np.float32))
+      table.add(5, np.full(Constants.NUM_ACTIONS, -10, dtype=np.float32), clip=True)
+
+      keys, values = table.delta()
+      self.assertEqual(sorted(keys.tolist()), sorted([5, 50 + worker_id, 200 + worker_id]))
+      self.assertTrue((values[keys.tolist().index(5)] == -1).all())
+      filenames.append(os.path.join(TABLE_FOLDER, "delta_{}.npz".format(worker_id)))
+      save_delta(filenames[-1], keys, values)
+
+    self.assertEqual(apply_delta_files(master, filenames), 5)
+    self.assertEqual(len(master), 102)
+    self.assertTrue((master.get(5) == 0).all())
+    self.assertTrue((master.get(50) == 3).all())
+    self.assertTrue((master.get(51) == 3).all())
+    self.assertTrue((master.get(201) == 2).all())
+    self.assertIsNone(master.get(500))
+
+  def test_sharded(self):
+    table = RegretTable(Constants.NUM_ACTIONS)
+    rows = np.random.rand(3000, Constants.NUM_ACTIONS).astype(np.float32)
+    table.add_rows(np.arange(3000) * 13, rows)
+
+    filename = os.path.join(TABLE_FOLDER, "table.npz")
+    self.assertEqual(shard_filenames(filename, 1), [filename])
+    self.assertEqual(os.path.basename(shard_filenames(filename, 4)[2]), "table.shard002-of-004.npz")
+
+    # Keys are spread roughly evenly over the shards.
+    counts = np.bincount(shard_of(table.keys(), 4), minlength=4)
+    self.assertTrue((counts > 600).all())
+
+    for num_shards in (1, 4):
+      self.assertFalse(checkpoint_exists(filename, num_shards))
+      save_sharded(table, filename, num_shards)
+      self.assertTrue(checkpoint_exists(filename, num_shards))
+      loaded = load_sharded(filename, num_shards)
+      self.assertEqual(len(loaded), 3000)
+      order = np.argsort(loaded.keys())
+      self.assertTrue((loaded.keys()[order] == table.keys()).all())
+      self.assertTrue((loaded.values()[order] == rows).all())
+      self.assertTrue((loaded.get(13) == rows[1]).all())
+
+  def test_find_legacy_checkpoint(self):
+    filename = os.path.join(TABLE_FOLDER, "total_regrets_0.npz")
+    legacy = os.path.join(TABLE_FOLDER, "total_regrets_0.pkl")
+    table = RegretTable(2)
+    table.add(7, np.array([1, 2]))
+
+    for num_shards in (1, 2):
+      self.assertIsNone(find_checkpoint(filename, num_shards))
+
+      # A checkpoint from before .npz was the default is resumed from.
+      save_sharded(table, legacy, num_shards)
+      self.assertEqual(find_checkpoint(filename, num_shards), legacy)
+      self.assertTrue((load_sharded(find_checkpoint(filename, num_shards), num_shards, 2).get(7) == [1, 2]).all())
+
+      # Once converted, the new file is used.
+      save_sharded(table, filename, num_shards)
+      self.assertEqual(find_checkpoint(filename, num_shards), filename)
+      self.assertEqual(find_checkpoint(legacy, num_shards), legacy)
+      shutil.rmtree(TABLE_FOLDER)
+
+  def test_sum_deltas(self):
+    keys, values = sum_deltas([(np.array([3, 1]), np.ones((2, 2))), (np.array([1, 2]), 2 * np.ones((2, 2))),
+                               (np.zeros(0, dtype=np.int64), np.zeros((0, 2)))])
+    self.assertEqual(keys.tolist(), [1, 2, 3])
+    self.assertEqual(values.tolist(), [[3, 3], [2, 2], [1, 1]])
+
+
+def update_shared_table(worker_id, table):
+  # Every worker inserts the same keys, and adds to its own rows.
+  for key in range(100):
+    table.row(key)
+  for key in range(1000 + 100 * worker_id, 1100 + 100 * worker_id):
+    table.add(key, np.full(Constants.NUM_ACTIONS, worker_id + 1, dtype=np.float32), clip=True)
+
+
+SHARED_WORKER_SCRIPT = """
+import multiprocessing as mp
+import numpy as np
+from regret_table import SharedRegretTable
+
+def worker(table):
+  table.add(1, np.ones(2, dtype=np.float32))
+  table.close()
+
+if __name__ == "__main__":
+  ctx = mp.get_context("spawn")
+  table = SharedRegretTable(16, 2, ctx.Lock())
+  p = ctx.Process(target=worker, args=(table,))
+  p.start()
+  p.join()
+  print(p.exitcode, table.get(1).tolist())
+  table.close()
+"""
+
+
+class SharedRegretTableTest(unittest.TestCase):
+  def test_shared_by_processes(self):
+    ctx = mp.get_context("spawn")
+    table = SharedRegretTable(2**12, Constants.NUM_ACTIONS, ctx.Lock())
+    table.add(5, np.ones(Constants.NUM_ACTIONS, dtype=np.float32))
+
+    procs = [ctx.Process(target=update_shared_table, args=(i, table)) for i in range(3)]
+    for p in procs:
+      p.start()
+    for p in procs:
+      p.join()
+      self.assertEqual(p.exitcode, 0)
+
+    self.assertEqual(len(table), 100 + 300)
+    self.assertTrue((table.get(5) == 1).all())
+    for worker_id in range(3):
+      self.assertTrue((table.get(1000 + 100 * worker_id) == worker_id + 1).all())
+    self.assertIsNone(table.get(99999))
+
+    copy = table.to_table()
+    self.assertEqual(len(copy), len(table))
+    self.assertTrue((copy.get(1250) == 3).all())
+    table.close()
+
+  def test_attach_untracked(self):
+    # A spawned worker attaches, updates, and closes the table, and nothing is reported as leaked.
+    folder = tempfile.mkdtemp()
+    script = os.path.join(folder, "worker.py")
+    with open(script, "w") as f:
+      f.write(SHARED_WORKER_SCRIPT)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, script], capture_output=True, text=True, env=env)
+    shutil.rmtree(folder)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertEqual(result.stdout.split(), ["0", "[1.0,", "1.0]"])
+    self.assertNotIn("resource_tracker", result.stderr)
+    self.assertNotIn("Traceback", result.stderr)
+
+    # A process that isn't a multiprocessing child doesn't unlink the table when it exits.
+    table = SharedRegretTable(16, 2, mp.Lock())
+    table.row(3)
+    code = "import numpy as np; from regret_table import SharedRegretTable; " \
+           "t = SharedRegretTable(16, 2, None, name={!r}); t.add(3, np.ones(2)); t.close()".format(table._shm.name)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertNotIn("resource_tracker", result.stderr)
+    self.assertTrue((table.get(3) == 1).all())
+    table.close()
+
+  def test_full(self):
+    table = SharedRegretTable(16, Constants.NUM_ACTIONS, mp.Lock())
+    with self.assertRaises(RuntimeError):
+      for key in range(16):
+        table.row(key)
+    table.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,12 +1,37 @@
+import os
+from unittest import mock
+
 import torch
 
 from utils import encode_cards_rank_suit
 from infoset import EvInfoSet
+from constants import Constants
 
 
 def make_dummy_ev_infoset():
   ev = 0.43
-  bet_history_vec = torch.ones(24)
+  bet_history_vec = torch.ones(2 + Constants.BET_HISTORY_SIZE)
   bet_history_vec[3:7] = 0
-  infoset = EvInfoSet(ev, bet_history_vec, 1)
+  infoset = EvInfoSet(ev, bet_history_vec, 1, 1)
   return infoset
+
+
+# With 2 bet actions per street the betting tree has under 2000 nodes, so tests can build their own
+# in a moment instead of the full tree (which takes minutes).
+SMALL_TREE_BET_ACTIONS = 2
+
+
+def small_tree_constants():
+  """
+  Patches Constants to the smaller action abstraction of build_small_betting_tree.
+  """
+  return mock.patch.object(Constants, "BET_ACTIONS_PER_STREET", SMALL_TREE_BET_ACTIONS)
+
+
+def build_small_betting_tree(folder):
+  """
+  Builds a BettingTree with SMALL_TREE_BET_ACTIONS, saves it in folder, and loads it back.
+  """
+  from betting_tree import BettingTree
+  with small_tree_constants():
+    return BettingTree.load_or_build(os.path.join(folder, "betting_tree"))
@@ -11,11 +11,15 @@ from tensorboardX import SummaryWriter
 
 from constants import Constants
 from utils import *
-from traverse import traverse, make_actions, make_infoset, create_new_round, make_precomputed_ev
+from traverse import traverse, make_actions, make_infoset, create_new_round, make_precomputed_ev, \
+                     create_deals, round_state_from_deal
 from memory_buffer import MemoryBuffer
 from infoset import EvInfoSet
 from memory_buffer_dataset import MemoryBufferDataset
 from network_wrapper import NetworkWrapper
+from betting_tree import BettingTree
+from cfr import configure_ev_calculator, PrecomputedEv
+from deal_corpus import WorkerDeals
 
 
 def traverse_worker(worker_id, traverse_player_idx, strategies, save_lock, opt, t, eval_mode,
@@ -44,22 +48,26 @@ def traverse_worker(worker_id, traverse_player_idx, strategies, save_lock, opt,
   else:
     num_traversals_per_worker = int(opt.NUM_TRAVERSALS_PER_ITER / opt.NUM_TRAVERSE_WORKERS)
   
-  t0 = time.time()
-  for k in range(num_traversals_per_worker):
-    ctr = [0]
-
-    # Generate a random initialization, alternating the SB player each time.
-    sb_player_idx = k % 2
-    round_state = create_new_round(sb_player_idx)
+  betting_tree = BettingTree.load(opt.BETTING_TREE_PATH) if opt.ROUND_STATE_TYPE == "tree" else None
+  configure_ev_calculator(opt)
 
-    precomputed_ev = make_precomputed_ev(round_state)
-    info = traverse(round_state, make_actions, make_infoset, traverse_player_idx, sb_player_idx,
-                    strategies, advt_mem, strt_mem, t, precomputed_ev, recursion_ctr=ctr)
+  t0 = time.time()
+  ev_computed = 0
+  # Generate a random initialization, alternating the SB player each time. Evaluation doesn't use the
+  # corpus, so that it never runs on the deals that were trained on.
+  with WorkerDeals(opt, worker_id, t, traverse_player_idx, num_traversals_per_worker, first_sb_player=0,
+                   betting_tree=betting_tree, use_corpus=not eval_mode, seed_extra=(int(eval_mode),)) as rounds:
+    for k, (sb_player_idx, round_state, precomputed_ev) in enumerate(rounds):
+      ctr = [0]
+      info = traverse(round_state, make_actions, make_infoset, traverse_player_idx, sb_player_idx,
+                      strategies, advt_mem, strt_mem, t, precomputed_ev, recursion_ctr=ctr)
+      ev_computed += precomputed_ev.num_computed
 
-    if (k % opt.TRAVERSE_DEBUG_PRINT_HZ) == 0 and eval_mode == False:
-      elapsed = time.time() - t0
-      print("[WORKER #{}] done with {}/{} traversals | recursion depth={} | advt={} strt={} | elapsed={} sec".format(
-            worker_id, k, num_traversals_per_worker, ctr[0], advt_mem.size(), strt_mem.size(), elapsed))
+      if (k % opt.TRAVERSE_DEBUG_PRINT_HZ) == 0 and eval_mode == False:
+        elapsed = time.time() - t0
+        print("[WORKER #{}] done with {}/{} traversals | recursion depth={} | advt={} strt={} | ev computed={}/{} | ev queue={} stall={} sec | elapsed={} sec".format(
+              worker_id, k, num_traversals_per_worker, ctr[0], advt_mem.size(), strt_mem.size(),
+              ev_computed, (k + 1) * PrecomputedEv.NUM_ENTRIES, rounds.queue_depth(), rounds.stall_time(), elapsed))
 
   # Save all the buffers one last time.
   print("[WORKER #{}] Final autosave ...".format(worker_id))
@@ -92,6 +100,10 @@ class Trainer(object):
     for mode in ["train", "cfr"]:
       self.writers[mode] = SummaryWriter(os.path.join(opt.TRAIN_LOG_FOLDER, mode))
 
+    # Build the betting tree up front so that the traverse workers only have to load it.
+    self.betting_tree = BettingTree.load_or_build(opt.BETTING_TREE_PATH) if opt.ROUND_STATE_TYPE == "tree" else None
+    configure_ev_calculator(opt)
+
   def main(self):
     eval_t = 0
     for t in range(self.opt.NUM_CFR_ITERS):
@@ -346,9 +358,19 @@ class Trainer(object):
       1: self.strategy_network
     }
 
+    # When seeded, every evaluation uses the same deals so that steps are directly comparable.
+    deals = None
+    if self.opt.DEAL_SEED is not None:
+      deals = create_deals(self.opt.NUM_TRAVERSALS_EVAL, self.opt.DEAL_SEED)
+
     for k in range(self.opt.NUM_TRAVERSALS_EVAL):
       sb_player_idx = k % 2
-      round_state = create_new_round(sb_player_idx)
+      if deals is not None:
+        round_state = round_state_from_deal(deals[k], sb_player_idx, state_type=self.opt.ROUND_STATE_TYPE,
+                                            betting_tree=self.betting_tree)
+      else:
+        round_state = create_new_round(sb_player_idx, state_type=self.opt.ROUND_STATE_TYPE,
+                                       betting_tree=self.betting_tree)
       precomputed_ev = make_precomputed_ev(round_state)
       info = traverse(round_state, make_actions, make_infoset, 0, sb_player_idx,
                       strategies, None, None, 0, precomputed_ev)
@@ -384,9 +406,19 @@ class Trainer(object):
     t0 = time.time()
     exploits = []
 
+    # When seeded, every evaluation uses the same deals so that steps are directly comparable.
+    deals = None
+    if self.opt.DEAL_SEED is not None:
+      deals = create_deals(self.opt.NUM_TRAVERSALS_EVAL, self.opt.DEAL_SEED)
+
     for k in range(self.opt.NUM_TRAVERSALS_EVAL):
       sb_player_idx = k % 2
-      round_state = create_new_round(sb_player_idx)
+      if deals is not None:
+        round_state = round_state_from_deal(deals[k], sb_player_idx, state_type=self.opt.ROUND_STATE_TYPE,
+                                            betting_tree=self.betting_tree)
+      else:
+        round_state = create_new_round(sb_player_idx, state_type=self.opt.ROUND_STATE_TYPE,
+                                       betting_tree=self.betting_tree)
       precomputed_ev = make_precomputed_ev(round_state)
       info = traverse(round_state, make_actions, make_infoset, traverse_player_idx, sb_player_idx,
                       self.value_networks, None, None, t, precomputed_ev)
@@ -8,10 +8,20 @@ from utils import *
 from constants import Constants
 from utils import sample_uniform_action
 from infoset import EvInfoSet
+from engine import TerminalState
+from cfr import TreeNodeInfo, make_actions, make_infoset, create_new_round, make_precomputed_ev, \
+                create_deals, round_state_from_deal, InfoSetBuilder
 
 
 def traverse(round_state, action_generator, infoset_generator, traverse_player_idx, sb_player_idx,
-             strategies, advt_mem, strt_mem, t, precomputed_ev, recursion_ctr=[0]):
+             strategies, advt_mem, strt_mem, t, precomputed_ev, recursion_ctr=[0], infoset_builder=None):
+  """
+  NOTE: infoset_generator is passed the bet history vector that infoset_builder keeps up to date
+  as actions are applied and undone (see cfr.InfoSetBuilder).
+  """
+  if infoset_builder is None:
+    infoset_builder = InfoSetBuilder(round_state)
+
   with torch.no_grad():
     node_info = TreeNodeInfo()
 
@@ -32,7 +42,8 @@ def traverse(round_state, action_generator, infoset_generator, traverse_player_i
 
     #============== TRAVERSE PLAYER ACTION ===============
     if is_traverse_player_action:
-      infoset = infoset_generator(round_state, traverse_player_idx, traverse_player_idx == sb_player_idx, precomputed_ev)
+      infoset = infoset_generator(round_state, traverse_player_idx, traverse_player_idx == sb_player_idx, precomputed_ev,
+                                  bet_history_vec=infoset_builder.bet_history_vec)
       actions, mask = action_generator(round_state)
 
       # Do regret matching to get action probabilities.
@@ -54,12 +65,13 @@ def traverse(round_state, action_generator, infoset_generator, traverse_player_i
       for i, a in enumerate(actions):
         if mask[i] <= 0:
           continue
-        next_round_state = round_state.copy().proceed(a)
+        next_round_state = infoset_builder.apply(round_state, a)
         # print("TRAVERSE ACTION:", a)
         child_node_info = traverse(next_round_state,
                                    action_generator, infoset_generator,
                                    traverse_player_idx, sb_player_idx, strategies, advt_mem, strt_mem, t,
-                                   precomputed_ev, recursion_ctr=recursion_ctr)
+                                   precomputed_ev, recursion_ctr=recursion_ctr, infoset_builder=infoset_builder)
+        infoset_builder.undo(round_state)
         
         # Expected value of the acting player taking this action and then continuing according to their strategy.
         action_values[:,i] = child_node_info.strategy_ev
@@ -102,7 +114,8 @@ def traverse(round_state, action_generator, infoset_generator, traverse_player_i
 
     #================== NON-TRAVERSE PLAYER ACTION =================
     else:
-      infoset = infoset_generator(round_state, other_player_idx, other_player_idx == sb_player_idx, precomputed_ev)
+      infoset = infoset_generator(round_state, other_player_idx, other_player_idx == sb_player_idx, precomputed_ev,
+                                  bet_history_vec=infoset_builder.bet_history_vec)
 
       # External sampling: choose a random action for the non-traversing player.
       actions, mask = action_generator(round_state)
@@ -119,10 +132,13 @@ def traverse(round_state, action_generator, infoset_generator, traverse_player_i
 
       # EXTERNAL SAMPLING: choose only ONE action for the non-traversal player.
       action = actions[torch.multinomial(action_probs, 1).item()]
-      next_round_state = round_state.copy().proceed(action)
+      next_round_state = infoset_builder.apply(round_state, action)
 
       # print("NON-TRAVERSE ACTION:", action)
 
-      return traverse(next_round_state,
-                      action_generator, infoset_generator, traverse_player_idx, sb_player_idx,
-                      strategies, advt_mem, strt_mem, t, precomputed_ev, recursion_ctr=recursion_ctr)
+      child_node_info = traverse(next_round_state,
+                                 action_generator, infoset_generator, traverse_player_idx, sb_player_idx,
+                                 strategies, advt_mem, strt_mem, t, precomputed_ev, recursion_ctr=recursion_ctr,
+                                 infoset_builder=infoset_builder)
+      infoset_builder.undo(round_state)
+      return child_node_info